@@ -0,0 +1,103 @@
+'''Load generator for the greeting server'''
+import asyncio
+import sys
+import time
+
+from client import HOST, PORT
+
+MODES = ('connect', 'persistent')
+PERCENTILES = (50, 90, 99)
+
+
+async def greet_once(name: bytes, expected: int) -> float:
+    '''Open a fresh connection, send one name and wait for the greeting'''
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(HOST, PORT)
+    writer.write(name)
+    await reader.readexactly(expected)
+    writer.close()
+    await writer.wait_closed()
+    return time.perf_counter() - start
+
+
+async def connect_worker(name: bytes, count: int, latencies: list) -> None:
+    '''Connection-per-request mode, the way client.main() talks to the server'''
+    expected = len(b'Hello, ') + len(name)
+    for _ in range(count):
+        latencies.append(await greet_once(name, expected))
+
+
+async def persistent_worker(name: bytes, count: int, latencies: list) -> None:
+    '''Send all requests of this worker over a single connection'''
+    expected = len(b'Hello, ') + len(name)
+    reader, writer = await asyncio.open_connection(HOST, PORT)
+    try:
+        for _ in range(count):
+            start = time.perf_counter()
+            writer.write(name)
+            await reader.readexactly(expected)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+def percentile(ordered: list, pct: float) -> float:
+    '''Nearest-rank percentile of an already sorted list'''
+    rank = max(int(round(pct / 100 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def histogram(ordered: list) -> list:
+    '''Count latencies into power-of-two millisecond buckets'''
+    buckets = []
+    bound = 0.125
+    i = 0
+    while i < len(ordered):
+        count = 0
+        while i < len(ordered) and ordered[i] * 1000 < bound:
+            count += 1
+            i += 1
+        if count:
+            buckets.append((bound, count))
+        bound *= 2
+    return buckets
+
+
+def report(mode: str, connections: int, elapsed: float, latencies: list) -> None:
+    '''Print throughput, percentiles and the latency histogram'''
+    ordered = sorted(latencies)
+    print('Mode: {}, connections: {}'.format(mode, connections))
+    print('Requests: {} in {:.3f}s ({:.0f} req/s)'.format(len(ordered), elapsed, len(ordered) / elapsed))
+    for pct in PERCENTILES:
+        print('p{}: {:.3f} ms'.format(pct, percentile(ordered, pct) * 1000))
+    print('max: {:.3f} ms'.format(ordered[-1] * 1000))
+    width = max(count for _, count in histogram(ordered))
+    for bound, count in histogram(ordered):
+        bar = '#' * max(int(40 * count / width), 1)
+        print('< {:>9.3f} ms {:>8} {}'.format(bound, count, bar))
+
+
+async def run(mode: str, connections: int, requests: int, name: str = 'bench') -> tuple:
+    '''Spread the requests across concurrent workers and time them'''
+    worker = connect_worker if mode == 'connect' else persistent_worker
+    latencies = []
+    per_worker = [requests // connections + (1 if i < requests % connections else 0)
+                  for i in range(connections)]
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(name.encode(), n, latencies) for n in per_worker if n))
+    return time.perf_counter() - start, latencies
+
+
+def main(argv: list):
+    '''Main function'''
+    if len(argv) < 4 or len(argv) > 5 or argv[1] not in MODES:
+        print('Proper use: python3 loadgen.py <connect|persistent> <connections> <requests> [name]')
+        exit()
+    mode, connections, requests = argv[1], int(argv[2]), int(argv[3])
+    elapsed, latencies = asyncio.run(run(mode, connections, requests, *argv[4:]))
+    report(mode, connections, elapsed, latencies)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
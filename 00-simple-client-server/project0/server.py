@@ -1,8 +1,14 @@
 '''Simple server program'''
+import selectors
 import socket
+import sys
 
 HOST = '127.0.0.1'
 PORT = 4300
+BACKLOG = 1024
+RECV_SIZE = 1024
+# Stop reading from a client once this many reply bytes are waiting for it.
+MAX_PENDING = 64 * 1024
 
 
 def main():
@@ -25,5 +31,109 @@ def main():
                 conn.sendall("Hello, {}".format(data.decode()).encode())
 
 
+class Connection:
+    '''State kept for one client of the event loop'''
+    __slots__ = ('sock', 'pending', 'events')
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.pending = bytearray()
+        self.events = selectors.EVENT_READ
+
+
+def greet(data: bytes) -> bytes:
+    '''Build the reply for one received chunk'''
+    return b'Hello, ' + data
+
+
+def accept(sel: selectors.BaseSelector, listener: socket.socket) -> None:
+    '''Accept every connection waiting in the backlog'''
+    while True:
+        try:
+            sock, _ = listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sel.register(sock, selectors.EVENT_READ, Connection(sock))
+
+
+def close(sel: selectors.BaseSelector, conn: Connection) -> None:
+    '''Forget a client and close its socket'''
+    sel.unregister(conn.sock)
+    conn.sock.close()
+
+
+def update_events(sel: selectors.BaseSelector, conn: Connection) -> None:
+    '''Read while there is room for replies, write while replies are pending'''
+    events = 0
+    if len(conn.pending) < MAX_PENDING:
+        events |= selectors.EVENT_READ
+    if conn.pending:
+        events |= selectors.EVENT_WRITE
+    if events != conn.events:
+        conn.events = events
+        sel.modify(conn.sock, events, conn)
+
+
+def flush(conn: Connection) -> None:
+    '''Send as much of the pending output as the socket accepts'''
+    try:
+        sent = conn.sock.send(conn.pending)
+    except (BlockingIOError, InterruptedError):
+        return
+    del conn.pending[:sent]
+
+
+def handle(sel: selectors.BaseSelector, conn: Connection, mask: int) -> None:
+    '''Service one ready client'''
+    try:
+        if mask & selectors.EVENT_READ:
+            try:
+                data = conn.sock.recv(RECV_SIZE)
+            except (BlockingIOError, InterruptedError):
+                data = None
+            if data == b'':
+                close(sel, conn)
+                return
+            if data:
+                conn.pending += greet(data)
+        if conn.pending:
+            flush(conn)
+    except OSError:
+        close(sel, conn)
+        return
+    update_events(sel, conn)
+
+
+def serve_forever(host: str = HOST, port: int = PORT) -> None:
+    '''Serve any number of clients at once from a single event loop'''
+    sel = selectors.DefaultSelector()
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((host, port))
+        s.listen(BACKLOG)
+        s.setblocking(False)
+        sel.register(s, selectors.EVENT_READ, None)
+        print('Listening on port {} (event loop)'.format(port))
+        try:
+            while True:
+                for key, mask in sel.select():
+                    if key.data is None:
+                        accept(sel, s)
+                    else:
+                        handle(sel, key.data, mask)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for key in list(sel.get_map().values()):
+                if key.data is not None:
+                    key.data.sock.close()
+            sel.close()
+
+
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == '--loop':
+        serve_forever()
+    else:
+        main()
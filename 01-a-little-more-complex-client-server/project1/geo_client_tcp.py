@@ -3,10 +3,47 @@ GEO TCP Client
 '''
 #!/usr/bin/env python3
 
-from socket import socket, AF_INET, SOCK_STREAM
+import asyncio
+import queue
+import selectors
+import sys
+import threading
+from collections import OrderedDict
+from socket import socket, create_connection, AF_INET, SOCK_STREAM
 
 HOST = 'localhost'
 PORT = 4300
+HELLO = b'\x1eGEO/1\n'
+FRAME_END = b'\n'
+FIELD_SEP = '\t'
+POOL_SIZE = 4
+TIMEOUT = 2.0
+RETRIES = 1
+CACHE_SIZE = 256
+
+
+class GeoProtocolError(ConnectionError):
+    '''The replies on a connection are out of step with its requests'''
+
+
+def check_names(countries: list) -> None:
+    '''Refuse names that would split a frame into several'''
+    for country in countries:
+        if FIELD_SEP in country or FRAME_END.decode() in country:
+            raise ValueError("Country name contains a separator: {!r}".format(country))
+
+
+def encode_frame(countries: list) -> bytes:
+    '''One request frame holding a batch of countries'''
+    check_names(countries)
+    return FIELD_SEP.join(countries).encode() + FRAME_END
+
+
+def check_reply(countries: list, reply: list) -> list:
+    '''The reply, if it holds one capital per country asked'''
+    if len(reply) != len(countries):
+        raise GeoProtocolError("Asked for {} countries, got {} replies".format(len(countries), len(reply)))
+    return reply
 
 
 def client():
@@ -29,10 +66,275 @@ def client():
         s.close()
         print('Connection closed')
 
-def main():
+
+class FramedConnection:
+    '''Connection speaking the framed, pipelined protocol'''
+
+    def __init__(self, host: str = HOST, port: int = PORT, timeout: float = None):
+        self.sock = create_connection((host, port), timeout)
+        self.sock.sendall(HELLO)
+        self.buffer = bytearray()
+
+    def send(self, countries: list) -> None:
+        '''Send one frame holding a batch of countries'''
+        self.sock.sendall(encode_frame(countries))
+
+    def take_reply(self) -> list:
+        '''The oldest complete reply line already received, or None'''
+        end = self.buffer.find(FRAME_END)
+        if end < 0:
+            return None
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end + 1]
+        return line.decode().split(FIELD_SEP)
+
+    def fill(self) -> None:
+        '''Append the bytes the server sent next to the buffer'''
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionError("Server closed the connection")
+        self.buffer += data
+
+    def receive(self) -> list:
+        '''Read the reply line to the oldest outstanding frame'''
+        while True:
+            reply = self.take_reply()
+            if reply is not None:
+                return reply
+            self.fill()
+
+    def pipeline(self, batches: list) -> list:
+        '''Send every batch without waiting for replies, reading them as they arrive
+
+        Replies are read while the frames are still being written: the
+        server stops reading once MAX_PENDING bytes of replies wait for us.
+        '''
+        out = memoryview(b''.join([encode_frame(b) for b in batches]))
+        replies = []
+        timeout = self.sock.gettimeout()
+        self.sock.setblocking(False)
+        try:
+            with selectors.DefaultSelector() as sel:
+                sel.register(self.sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+                while len(replies) < len(batches):
+                    events = sel.select(timeout)
+                    if not events:
+                        raise TimeoutError("No reply within {} seconds".format(timeout))
+                    mask = events[0][1]
+                    if mask & selectors.EVENT_WRITE:
+                        out = out[self.sock.send(out):]
+                        if not out:
+                            sel.modify(self.sock, selectors.EVENT_READ)
+                    if mask & selectors.EVENT_READ:
+                        self.fill()
+                        reply = self.take_reply()
+                        while reply is not None:
+                            replies.append(reply)
+                            reply = self.take_reply()
+        finally:
+            self.sock.settimeout(timeout)
+        return replies
+
+    def close(self) -> None:
+        '''Close the socket'''
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class LRUCache:
+    '''Thread-safe map that forgets the least recently used entries'''
+
+    def __init__(self, size: int = CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> str:
+        '''Cached value for key, or None'''
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: str) -> None:
+        '''Remember a value, evicting the oldest entry when full'''
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class GeoClient:
+    '''Blocking client that reuses a pool of framed connections'''
+
+    def __init__(self, host: str = HOST, port: int = PORT, pool_size: int = POOL_SIZE,
+                 timeout: float = TIMEOUT, retries: int = RETRIES, cache_size: int = CACHE_SIZE):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.cache = LRUCache(cache_size)
+        self.idle = queue.LifoQueue()
+        # One slot per connection that may exist at the same time.
+        self.slots = threading.BoundedSemaphore(pool_size)
+
+    def request(self, countries: list) -> list:
+        '''Send one frame over a pooled connection, reconnecting on reset'''
+        check_names(countries)
+        if not self.slots.acquire(timeout=self.timeout):
+            raise TimeoutError("No free connection in the pool")
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    conn = self.idle.get_nowait()
+                except queue.Empty:
+                    conn = FramedConnection(self.host, self.port, self.timeout)
+                try:
+                    conn.send(countries)
+                    reply = check_reply(countries, conn.receive())
+                except (ConnectionError, OSError):
+                    # Timed out, reset or a reply of the wrong size: the stream is out of step, drop the connection.
+                    conn.close()
+                    if attempt == self.retries:
+                        raise
+                    continue
+                self.idle.put(conn)
+                return reply
+        finally:
+            self.slots.release()
+
+    def lookup_many(self, countries: list) -> list:
+        '''Capitals of several countries, asking the server only for uncached ones'''
+        capitals = [self.cache.get(c) for c in countries]
+        missing = [c for c, capital in zip(countries, capitals) if capital is None]
+        if missing:
+            found = dict(zip(missing, self.request(missing)))
+            for country, capital in found.items():
+                self.cache.put(country, capital)
+            capitals = [found[c] if capital is None else capital for c, capital in zip(countries, capitals)]
+        return capitals
+
+    def lookup(self, country: str) -> str:
+        '''Capital of one country'''
+        return self.lookup_many([country])[0]
+
+    def close(self) -> None:
+        '''Close every idle connection'''
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncGeoClient:
+    '''asyncio client that reuses a pool of framed connections'''
+
+    def __init__(self, host: str = HOST, port: int = PORT, pool_size: int = POOL_SIZE,
+                 timeout: float = TIMEOUT, retries: int = RETRIES, cache_size: int = CACHE_SIZE):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.cache = LRUCache(cache_size)
+        self.idle = []
+        self.slots = asyncio.Semaphore(pool_size)
+
+    async def connect(self) -> tuple:
+        '''Open a new framed connection'''
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        writer.write(HELLO)
+        return reader, writer
+
+    async def exchange(self, conn: tuple, countries: list) -> list:
+        '''Send one frame and read its reply line, closing the connection if it is cut short'''
+        reader, writer = conn
+        writer.write(encode_frame(countries))
+        try:
+            line = await reader.readuntil(FRAME_END)
+        except (asyncio.LimitOverrunError, asyncio.IncompleteReadError) as err:
+            writer.close()
+            raise GeoProtocolError("Unreadable reply: {}".format(err)) from err
+        return check_reply(countries, line[:-1].decode().split(FIELD_SEP))
+
+    async def request(self, countries: list) -> list:
+        '''Send one frame over a pooled connection, reconnecting on reset'''
+        check_names(countries)
+        async with self.slots:
+            for attempt in range(self.retries + 1):
+                conn = self.idle.pop() if self.idle else None
+                try:
+                    if conn is None:
+                        conn = await asyncio.wait_for(self.connect(), self.timeout)
+                    reply = await asyncio.wait_for(self.exchange(conn, countries), self.timeout)
+                except (ConnectionError, OSError, asyncio.TimeoutError):
+                    if conn is not None:
+                        conn[1].close()
+                    if attempt == self.retries:
+                        raise
+                    continue
+                self.idle.append(conn)
+                return reply
+
+    async def lookup_many(self, countries: list) -> list:
+        '''Capitals of several countries, asking the server only for uncached ones'''
+        capitals = [self.cache.get(c) for c in countries]
+        missing = [c for c, capital in zip(countries, capitals) if capital is None]
+        if missing:
+            found = dict(zip(missing, await self.request(missing)))
+            for country, capital in found.items():
+                self.cache.put(country, capital)
+            capitals = [found[c] if capital is None else capital for c, capital in zip(countries, capitals)]
+        return capitals
+
+    async def lookup(self, country: str) -> str:
+        '''Capital of one country'''
+        return (await self.lookup_many([country]))[0]
+
+    async def close(self) -> None:
+        '''Close every idle connection'''
+        while self.idle:
+            _, writer = self.idle.pop()
+            writer.close()
+            await writer.wait_closed()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+def batch(countries: list) -> list:
+    '''Look up all countries in a single round trip'''
+    with FramedConnection() as conn:
+        conn.send(countries)
+        return check_reply(countries, conn.receive())
+
+
+def main(argv: list):
     '''Main function'''
-    client()
+    if len(argv) > 2 and argv[1] == '--batch':
+        for country, capital in zip(argv[2:], batch(argv[2:])):
+            print('+{}: {}'.format(country, capital))
+    else:
+        client()
 
 
 if __name__ == "__main__":
-    main()
+    main(sys.argv)
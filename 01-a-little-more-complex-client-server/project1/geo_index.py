@@ -0,0 +1,121 @@
+'''
+Index over world territories and their capitals
+'''
+#!/usr/bin/env python3
+
+import unicodedata
+from bisect import bisect_left
+
+NO_SUCH_COUNTRY = b"There is no such country."
+PREFIX_MARK = '*'
+FUZZY_MARK = '~'
+PREFIX_LIMIT = 10
+MAX_EDITS = 2
+
+
+def normalize(name: str) -> str:
+    '''Case-fold, strip accents and collapse whitespace'''
+    decomposed = unicodedata.normalize('NFKD', name.casefold())
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(stripped.split())
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    '''Levenshtein distance between a and b, or limit + 1 once it exceeds limit
+
+    Only the diagonal band of width 2 * limit + 1 is stored and filled in,
+    so the cost is O(len(a) * limit) instead of O(len(a) * len(b)).
+    Cell k of a row holds column j = i + k - limit.
+    '''
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    over = limit + 1
+    width = 2 * limit + 1
+    previous = [k - limit if 0 <= k - limit <= len(b) else over for k in range(width)]
+    for i in range(1, len(a) + 1):
+        current = [over] * width
+        best = over
+        for k in range(max(0, limit - i), min(width, len(b) - i + limit + 1)):
+            if k == limit - i:
+                value = i
+            else:
+                cost = 0 if a[i - 1] == b[i + k - limit - 1] else 1
+                value = previous[k] + cost
+                if k + 1 < width and previous[k + 1] + 1 < value:
+                    value = previous[k + 1] + 1
+                if k and current[k - 1] + 1 < value:
+                    value = current[k - 1] + 1
+            current[k] = value
+            if value < best:
+                best = value
+        if best > limit:
+            return over
+        previous = current
+    return min(previous[len(b) - len(a) + limit], over)
+
+
+class GeoIndex:
+    '''Lookup structures built once when the dataset is loaded
+
+    * exact:  dict keyed by the normalized country name, O(1).
+    * prefix: sorted array of normalized names searched with bisect,
+              O(log n + k) for k matches.
+    * fuzzy:  banded edit distance against names of a close length,
+              O(n * m * d) for a query of length m and at most d edits.
+
+    Every reply is encoded to bytes here so the reply path only joins bytes.
+    '''
+
+    def __init__(self, world: dict):
+        self.capitals = {}
+        self.entries = {}
+        for country, capital in world.items():
+            key = normalize(country)
+            self.capitals[key] = capital.encode()
+            self.entries[key] = '{} - {}'.format(country, capital).encode()
+        self.keys = sorted(self.capitals)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def exact(self, country: str) -> bytes:
+        '''Capital of a country, ignoring case, accents and extra spaces'''
+        return self.capitals.get(normalize(country), NO_SUCH_COUNTRY)
+
+    def prefix(self, start: str, limit: int = PREFIX_LIMIT) -> list:
+        '''Normalized names of up to `limit` countries starting with `start`'''
+        start = normalize(start)
+        i = bisect_left(self.keys, start)
+        found = []
+        while i < len(self.keys) and len(found) < limit and self.keys[i].startswith(start):
+            found.append(self.keys[i])
+            i += 1
+        return found
+
+    def fuzzy(self, country: str, max_edits: int = MAX_EDITS) -> str:
+        '''Normalized name closest to `country` within `max_edits` edits, or None'''
+        target = normalize(country)
+        if target in self.capitals:
+            return target
+        best, best_distance = None, max_edits + 1
+        for key in self.keys:
+            distance = edit_distance(target, key, best_distance - 1)
+            if distance < best_distance:
+                best, best_distance = key, distance
+                if distance == 1:
+                    break
+        return best
+
+    def lookup(self, query: str) -> bytes:
+        '''Answer an exact, prefix ("Fran*") or fuzzy ("~Frnace") query'''
+        if query.endswith(PREFIX_MARK):
+            keys = self.prefix(query[:-1])
+            if not keys:
+                return NO_SUCH_COUNTRY
+            return b' | '.join(self.entries[k] for k in keys)
+        if query.startswith(FUZZY_MARK):
+            key = self.fuzzy(query[1:])
+            if key is None:
+                return NO_SUCH_COUNTRY
+            return self.capitals[key]
+        return self.exact(query)
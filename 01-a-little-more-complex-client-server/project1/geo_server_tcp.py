@@ -3,12 +3,35 @@ GEO TCP Server
 '''
 #!/usr/bin/env python3
 
+import mmap
+import os
+import selectors
+import sys
+import threading
 import time
-from socket import socket, AF_INET, SOCK_STREAM
+from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, IPPROTO_TCP, TCP_NODELAY
+
+from geo_index import GeoIndex
 
 FILE_NAME = 'geo_world.txt'
 HOST = 'localhost'
 PORT = 4300
+BACKLOG = 1024
+RECV_SIZE = 1024
+MAX_PENDING = 64 * 1024
+# Log one query out of LOG_SAMPLE and write the log at most every LOG_FLUSH seconds.
+LOG_SAMPLE = 100
+LOG_FLUSH = 1.0
+# Framed clients open with HELLO, then send newline-terminated frames of
+# tab-separated countries and get one line of tab-separated capitals back.
+HELLO = b'\x1eGEO/1\n'
+FRAME_END = b'\n'
+FIELD_SEP = b'\t'
+MAX_FRAME = 64 * 1024
+# Files at least this large are parsed through a memory map.
+MMAP_THRESHOLD = 16 * 1024 * 1024
+# Seconds between checks of the dataset file for changes.
+RELOAD_INTERVAL = 2.0
 
 
 def read_file(filename: str) -> dict:
@@ -25,9 +48,82 @@ def read_file(filename: str) -> dict:
     return world
 
 
+def read_file_mmap(filename: str) -> dict:
+    '''Read world territories and their capitals through a memory map'''
+    world = dict()
+    print("Mapping a file...")
+    start = time.time()
+    if os.path.getsize(filename) > 0:
+        with open(filename, "rb") as infile, mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            pos, size = 0, len(data)
+            while pos < size:
+                end = data.find(b"\n", pos)
+                if end < 0:
+                    end = size
+                sep = data.find(b" - ", pos, end)
+                if sep < 0:
+                    raise ValueError("Malformed line at byte {}".format(pos))
+                world[data[pos:sep].decode()] = data[sep+3:end].decode().rstrip("\r")
+                pos = end + 1
+    end = time.time()
+    print("Read in {:.4f} sec".format(end-start))
+    return world
+
+
+def load_world(filename: str) -> dict:
+    '''Read the dataset, through a memory map when the file is large'''
+    if os.path.getsize(filename) >= MMAP_THRESHOLD:
+        return read_file_mmap(filename)
+    return read_file(filename)
+
+
+class DatasetWatcher:
+    '''Poll the dataset file and rebuild the index off the event loop when it changes'''
+
+    def __init__(self, filename: str, interval: float = RELOAD_INTERVAL):
+        self.filename = filename
+        self.interval = interval
+        self.stamp = self.stat()
+        self.last_poll = time.monotonic()
+        self.loader = None
+        self.ready = None
+
+    def stat(self) -> tuple:
+        '''Modification time and size of the file, or None if it is missing'''
+        try:
+            info = os.stat(self.filename)
+        except OSError:
+            return None
+        return (info.st_mtime_ns, info.st_size)
+
+    def build(self) -> None:
+        '''Parse the file and index it, in the loader thread'''
+        try:
+            self.ready = GeoIndex(load_world(self.filename))
+        except (OSError, ValueError, IndexError) as err:
+            print("Reload failed: {}".format(err))
+
+    def poll(self) -> GeoIndex:
+        '''Return a freshly built index once one is ready, otherwise None'''
+        if self.ready is not None:
+            index, self.ready = self.ready, None
+            return index
+        now = time.monotonic()
+        if now - self.last_poll < self.interval or (self.loader and self.loader.is_alive()):
+            return None
+        self.last_poll = now
+        stamp = self.stat()
+        if stamp is not None and stamp != self.stamp:
+            self.stamp = stamp
+            self.loader = threading.Thread(target=self.build, daemon=True)
+            self.loader.start()
+        return None
+
+
 def server(world: dict) -> None:
     '''Main server loop'''
     # TODO: Implement server-side tasks
+    index = GeoIndex(world)
     with socket(AF_INET, SOCK_STREAM) as s:
         s.bind((HOST, PORT))
         s.listen(1)
@@ -42,18 +138,218 @@ def server(world: dict) -> None:
                     break
                 country = data.decode()
                 print("User query: {}".format(country))
-                if country not in world:
-                    conn.sendall("{}".format("There is no such country.").encode())
+                conn.sendall(index.lookup(country))
+
+
+class QueryLog:
+    '''Sampled, buffered query log that stays off the reply path'''
+
+    def __init__(self, sample: int = LOG_SAMPLE, interval: float = LOG_FLUSH, out=sys.stdout):
+        self.sample = sample
+        self.interval = interval
+        self.out = out
+        self.seen = 0
+        self.lines = []
+        self.last_flush = time.monotonic()
+
+    def record(self, country: str) -> None:
+        '''Count a query and keep one out of every `sample`'''
+        self.seen += 1
+        if self.sample and self.seen % self.sample == 0:
+            self.lines.append("User query: {}\n".format(country))
+
+    def tick(self) -> None:
+        '''Write the buffered lines if the flush interval has passed'''
+        now = time.monotonic()
+        if now - self.last_flush >= self.interval:
+            self.flush(now)
+
+    def flush(self, now: float = None) -> None:
+        '''Write the buffered lines in one call'''
+        if self.lines:
+            self.out.write("".join(self.lines))
+            self.out.flush()
+            self.lines.clear()
+        self.last_flush = time.monotonic() if now is None else now
+
+
+class Connection:
+    '''State kept for one client of the event loop'''
+    __slots__ = ('sock', 'pending', 'events', 'framed', 'inbuf')
+
+    def __init__(self, sock: socket):
+        self.sock = sock
+        self.pending = bytearray()
+        self.events = selectors.EVENT_READ
+        # None until the first byte tells a framed client from a legacy one.
+        self.framed = None
+        self.inbuf = bytearray()
+
+
+def answer_frame(index: GeoIndex, frame: bytes, log: QueryLog) -> bytes:
+    '''Answer every country of one frame, in order, as one reply line'''
+    capitals = []
+    for country in frame.decode().split(FIELD_SEP.decode()):
+        log.record(country)
+        capitals.append(index.lookup(country))
+    return FIELD_SEP.join(capitals) + FRAME_END
+
+
+def receive(conn: Connection, data: bytes, index: GeoIndex, log: QueryLog) -> None:
+    '''Queue the replies for newly received bytes'''
+    if conn.framed is None:
+        conn.framed = data[:1] == HELLO[:1]
+    if not conn.framed:
+        # Legacy clients send one bare country per message.
+        country = data.decode()
+        log.record(country)
+        conn.pending += index.lookup(country)
+        return
+    conn.inbuf += data
+    start = 0
+    while True:
+        end = conn.inbuf.find(FRAME_END, start)
+        if end < 0:
+            break
+        frame = bytes(conn.inbuf[start:end])
+        start = end + 1
+        if frame == HELLO[:-1]:
+            continue
+        conn.pending += answer_frame(index, frame, log)
+    del conn.inbuf[:start]
+    if len(conn.inbuf) > MAX_FRAME:
+        raise ValueError("Frame too long")
+
+
+def accept(sel: selectors.BaseSelector, listener: socket) -> None:
+    '''Accept every connection waiting in the backlog'''
+    while True:
+        try:
+            sock, _ = listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(False)
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        sel.register(sock, selectors.EVENT_READ, Connection(sock))
+
+
+def close(sel: selectors.BaseSelector, conn: Connection) -> None:
+    '''Forget a client and close its socket'''
+    sel.unregister(conn.sock)
+    conn.sock.close()
+
+
+def handle(sel: selectors.BaseSelector, conn: Connection, mask: int, index: GeoIndex, log: QueryLog) -> None:
+    '''Service one ready client'''
+    try:
+        if mask & selectors.EVENT_READ:
+            try:
+                data = conn.sock.recv(RECV_SIZE)
+            except (BlockingIOError, InterruptedError):
+                data = None
+            if data == b'':
+                close(sel, conn)
+                return
+            if data:
+                receive(conn, data, index, log)
+        if conn.pending:
+            try:
+                sent = conn.sock.send(conn.pending)
+                del conn.pending[:sent]
+            except (BlockingIOError, InterruptedError):
+                pass
+    except (OSError, ValueError):
+        close(sel, conn)
+        return
+    events = 0
+    if len(conn.pending) < MAX_PENDING:
+        events |= selectors.EVENT_READ
+    if conn.pending:
+        events |= selectors.EVENT_WRITE
+    if events != conn.events:
+        conn.events = events
+        sel.modify(conn.sock, events, conn)
+
+
+def listen(host: str, port: int, reuse_port: bool) -> socket:
+    '''Create the non-blocking listening socket'''
+    s = socket(AF_INET, SOCK_STREAM)
+    s.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    if reuse_port:
+        from socket import SO_REUSEPORT
+        s.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    s.bind((host, port))
+    s.listen(BACKLOG)
+    s.setblocking(False)
+    return s
+
+
+def event_loop(index: GeoIndex, listener: socket, log: QueryLog, watcher: DatasetWatcher = None) -> None:
+    '''Serve every client of one listening socket'''
+    sel = selectors.DefaultSelector()
+    sel.register(listener, selectors.EVENT_READ, None)
+    timeout = min(log.interval, watcher.interval) if watcher else log.interval
+    try:
+        while True:
+            for key, mask in sel.select(timeout):
+                if key.data is None:
+                    accept(sel, listener)
                 else:
-                    capital = world[country]
-                    conn.sendall("{}".format(capital).encode())
+                    handle(sel, key.data, mask, index, log)
+            log.tick()
+            if watcher:
+                fresh = watcher.poll()
+                if fresh is not None:
+                    # Swapped between events: every reply uses either the old or the new index.
+                    index = fresh
+                    print("Swapped in {} countries".format(len(index)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log.flush()
+        for key in list(sel.get_map().values()):
+            key.fileobj.close()
+        sel.close()
+
+
+def serve_forever(world: dict, workers: int = 1, host: str = HOST, port: int = PORT,
+                  filename: str = None) -> None:
+    '''Serve many clients at once, optionally from several processes
+
+    When filename is given, each process reloads it whenever it changes.
+    '''
+    index = GeoIndex(world)
+    if workers <= 1:
+        print('Listening on {}:{} (event loop)'.format(host, port))
+        event_loop(index, listen(host, port, False), QueryLog(), filename and DatasetWatcher(filename))
+        return
+    # The index is built before forking so workers share its pages.
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                event_loop(index, listen(host, port, True), QueryLog(), filename and DatasetWatcher(filename))
+            finally:
+                os._exit(0)
+        children.append(pid)
+    print('Listening on {}:{} ({} workers)'.format(host, port, workers))
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in children:
+            os.waitpid(pid, 0)
 
 
-def main():
+def main(argv: list):
     '''Main function'''
-    world = read_file(FILE_NAME)
-    server(world)
+    if len(argv) > 1 and argv[1] == '--loop':
+        world = load_world(FILE_NAME)
+        serve_forever(world, int(argv[2]) if len(argv) > 2 else 1, filename=FILE_NAME)
+    else:
+        server(read_file(FILE_NAME))
 
 
 if __name__ == "__main__":
-    main()
+    main(sys.argv)
@@ -0,0 +1,111 @@
+'''
+Testing the pooled geo clients against the event-loop server
+'''
+#!/usr/bin/python3
+
+
+import asyncio
+import threading
+from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_RCVBUF, SO_SNDBUF
+import pytest
+from geo_client_tcp import FramedConnection
+from geo_client_tcp import GeoClient
+from geo_client_tcp import AsyncGeoClient
+from geo_client_tcp import GeoProtocolError
+from geo_server_tcp import event_loop
+from geo_server_tcp import listen
+from geo_server_tcp import load_world
+from geo_server_tcp import QueryLog
+from geo_server_tcp import FILE_NAME
+from geo_server_tcp import MAX_PENDING
+from geo_index import GeoIndex
+
+HOST = '127.0.0.1'
+SMALL_BUFFER = 16384
+
+
+def geo_server(buffer_size: int = None) -> int:
+    '''Port of an event-loop server over the whole dataset, with small socket buffers if given'''
+    listener = listen(HOST, 0, False)
+    if buffer_size:
+        # Accepted sockets inherit the sizes, so the kernel cannot hide a stalled reader.
+        listener.setsockopt(SOL_SOCKET, SO_RCVBUF, buffer_size)
+        listener.setsockopt(SOL_SOCKET, SO_SNDBUF, buffer_size)
+    index = GeoIndex(load_world(FILE_NAME))
+    threading.Thread(target=event_loop, args=(index, listener, QueryLog(sample=0)), daemon=True).start()
+    return listener.getsockname()[1]
+
+
+@pytest.fixture(scope='module')
+def geo_port():
+    '''Port of a server running for the whole module'''
+    return geo_server()
+
+
+def misbehaving_server(reply: bytes) -> int:
+    '''Port of a server answering every frame with the same raw bytes'''
+    listener = socket(AF_INET, SOCK_STREAM)
+    listener.bind((HOST, 0))
+    listener.listen(1)
+
+    def serve():
+        while True:
+            conn, _ = listener.accept()
+            with conn:
+                try:
+                    while conn.recv(65536):
+                        conn.sendall(reply)
+                except OSError:
+                    continue
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+class TestGeoClient:
+    '''Testing the geo clients'''
+
+    def test_separator_refused(self, geo_port):
+        '''A name holding a separator is refused instead of desynchronizing the connection'''
+        with GeoClient(HOST, geo_port, pool_size=1) as geo:
+            for name in ('France\nGermany', 'France\tGermany'):
+                with pytest.raises(ValueError):
+                    geo.lookup(name)
+            assert geo.lookup('Japan') == 'Tokyo'
+            assert geo.lookup('Peru') == 'Lima'
+            assert geo.lookup_many(['France', 'Germany']) == ['Paris', 'Berlin']
+
+    def test_reply_count_mismatch(self):
+        '''A reply with the wrong number of fields drops the connection and is not cached'''
+        with GeoClient(HOST, misbehaving_server(b'Paris\tBerlin\n'), retries=0) as geo:
+            with pytest.raises(GeoProtocolError):
+                geo.lookup('France')
+            assert geo.cache.get('France') is None
+            assert geo.idle.empty()
+
+    def test_async_unreadable_reply(self):
+        '''A reply line over the stream limit closes the connection with the client's error'''
+        port = misbehaving_server(b'x' * 100000)
+
+        async def test():
+            async with AsyncGeoClient(HOST, port, retries=0) as geo:
+                with pytest.raises(GeoProtocolError):
+                    await geo.lookup('France')
+                assert not geo.idle
+                with pytest.raises(ValueError):
+                    await geo.lookup('France\nGermany')
+        asyncio.run(test())
+
+    def test_pipeline_past_max_pending(self):
+        '''A pipeline whose replies outgrow the server's output queue completes'''
+        batches = [['France', 'Japan', 'Peru'] * 10] * 2000
+        with FramedConnection(HOST, geo_server(SMALL_BUFFER), timeout=5.0) as conn:
+            conn.sock.setsockopt(SOL_SOCKET, SO_RCVBUF, SMALL_BUFFER)
+            conn.sock.setsockopt(SOL_SOCKET, SO_SNDBUF, SMALL_BUFFER)
+            replies = conn.pipeline(batches)
+        assert sum(len('\t'.join(reply)) + 1 for reply in replies) > 4 * MAX_PENDING
+        assert replies == [['Paris', 'Tokyo', 'Lima'] * 10] * 2000
+
+
+if __name__ == '__main__':
+    pytest.main(['test_geo_client_tcp.py'])
@@ -0,0 +1,97 @@
+'''
+Concurrent batch resolution over asyncio
+'''
+#!/usr/bin/env python3
+
+import asyncio
+import sys
+import time
+from collections import namedtuple
+
+from resolver import DNS_TYPES, PORT, decode_message
+from transport import DNSTransport
+
+WINDOW = 100
+TIMEOUT = 2.0
+RETRIES = 2
+
+Result = namedtuple('Result', 'qtype domain message error elapsed')
+
+
+async def resolve_one(transport: DNSTransport, q_type: str, domain: str, server: str, port: int,
+                      timeout: float, retries: int) -> Result:
+    '''Resolve one (type, domain) pair, capturing any failure in the result'''
+    start = time.perf_counter()
+    try:
+        reply = await transport.query(DNS_TYPES[q_type], domain.rstrip('.').split('.'),
+                                      server, port, timeout, retries)
+        return Result(q_type, domain, decode_message(reply), None, time.perf_counter() - start)
+    except (OSError, ValueError, KeyError, IndexError, asyncio.TimeoutError) as err:
+        return Result(q_type, domain, None, err, time.perf_counter() - start)
+
+
+async def resolve_many(queries, server: str, port: int = PORT, window: int = WINDOW,
+                       timeout: float = TIMEOUT, retries: int = RETRIES):
+    '''Resolve an iterable of (type, domain) pairs, yielding results as they complete
+
+    At most `window` queries are in flight, all sharing one UDP socket;
+    the iterable is consumed lazily. `server` must be an IPv4 address.
+    '''
+    queries = iter(queries)
+    pending = set()
+    transport = await DNSTransport.open()
+    try:
+        while True:
+            for q_type, domain in queries:
+                pending.add(asyncio.ensure_future(
+                    resolve_one(transport, q_type, domain, server, port, timeout, retries)))
+                if len(pending) >= window:
+                    break
+            if not pending:
+                return
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        transport.close()
+
+
+def read_queries(filename: str):
+    '''Yield (type, domain) pairs from a file with one "TYPE domain" per line'''
+    with open(filename) as infile:
+        for line in infile:
+            fields = line.split()
+            if len(fields) >= 2 and not fields[0].startswith('#'):
+                yield fields[0].upper(), fields[1]
+
+
+async def run(filename: str, server: str, port: int) -> None:
+    '''Resolve every query in the file and print each result as it arrives'''
+    start = time.time()
+    count = failed = 0
+    async for result in resolve_many(read_queries(filename), server, port):
+        count += 1
+        if result.error is not None:
+            failed += 1
+            print('{} {}: failed ({})'.format(result.qtype, result.domain, type(result.error).__name__))
+            continue
+        addresses = [a.rdata for a in result.message.answers if a.rtype == DNS_TYPES[result.qtype]]
+        print('{} {}: {} ({:.1f} ms)'.format(result.qtype, result.domain,
+                                            ', '.join(addresses) or 'no records', result.elapsed * 1000))
+    end = time.time()
+    print("Resolved {} names ({} failed) in {:.3f}s".format(count, failed, end-start))
+
+
+def main(*argv):
+    '''Main function'''
+    if len(argv[0]) < 3 or len(argv[0]) > 4:
+        print('Proper use: python3 batch.py <query_file> <server> [port]')
+        exit()
+    port = int(argv[0][3]) if len(argv[0]) == 4 else PORT
+    asyncio.run(run(argv[0][1], argv[0][2], port))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
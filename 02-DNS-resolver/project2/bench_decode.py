@@ -0,0 +1,51 @@
+'''
+Decodes per second of parse_response against decode_message
+'''
+#!/usr/bin/env python3
+
+import contextlib
+import os
+import sys
+import timeit
+
+from resolver import parse_response, decode_message
+
+RESPONSES = {
+    'A luther.edu': b'\xc7D\x81\x80\x00\x01\x00\x01\x00\x00\x00\x00\x06luther\x03edu\x00\x00\x01' +
+                    b'\x00\x01\xc0\x0c\x00\x01\x00\x01\x00\x00\x01,\x00\x04\xae\x81\x19\xaa',
+    'A yahoo.com (labels)': b'r\xd4\x81\x80\x00\x01\x00\x06\x00\x00\x00\x00\x05yahoo\x03com' +
+                            b'\x00\x00\x01\x00\x01' +
+                            b''.join(b'\x05yahoo\x03com\x00\x00\x01\x00\x01\x00\x00\x00\x05\x00\x04' + ip
+                                     for ip in (b'b\x89\xf6\x07', b'H\x1e#\t', b'H\x1e#\n',
+                                                b'b\x8a\xdb\xe7', b'b\x89\xf6\x08', b'b\x8a\xdb\xe8')),
+    'AAAA yahoo.com (pointers)': b'k\xfb\x81\x80\x00\x01\x00\x06\x00\x00\x00\x00\x05yahoo\x03com' +
+                                 b'\x00\x00\x1c\x00\x01' +
+                                 b''.join(b'\xc0\x0c\x00\x1c\x00\x01\x00\x00\x04T\x00\x10 \x01I\x98' + tail
+                                          for tail in (b'\x00X\x186\x00\x00\x00\x00\x00\x00\x00\x11',
+                                                       b'\x00X\x186\x00\x00\x00\x00\x00\x00\x00\x10',
+                                                       b'\x00D\x04\x1d\x00\x00\x00\x00\x00\x00\x00\x04',
+                                                       b'\x00D\x04\x1d\x00\x00\x00\x00\x00\x00\x00\x03',
+                                                       b'\x00\x0c\x10#\x00\x00\x00\x00\x00\x00\x00\x05',
+                                                       b'\x00\x0c\x10#\x00\x00\x00\x00\x00\x00\x00\x04')),
+}
+
+
+def rate(func, data: bytes, number: int) -> float:
+    '''Calls per second, best of three runs'''
+    return number / min(timeit.repeat(lambda: func(data), number=number, repeat=3))
+
+
+def main(*argv):
+    '''Main function'''
+    number = int(argv[0][1]) if len(argv[0]) > 1 else 20000
+    print('{:<28}{:>16}{:>16}{:>9}'.format('response', 'parse_response', 'decode_message', 'speedup'))
+    for label, data in RESPONSES.items():
+        # parse_answers prints its progress for label-encoded answers; keep that off the terminal.
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            old = rate(parse_response, data, number)
+        new = rate(decode_message, data, number)
+        print('{:<28}{:>14,.0f}/s{:>14,.0f}/s{:>8.1f}x'.format(label, old, new, new / old))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
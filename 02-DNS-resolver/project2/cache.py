@@ -0,0 +1,212 @@
+'''
+TTL-aware DNS answer cache
+'''
+#!/usr/bin/env python3
+
+import json
+import os
+import time
+from collections import OrderedDict, namedtuple
+
+CACHE_SIZE = 10000
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+TYPE_SOA = 6
+# Popular entries are refreshed during the last PREFETCH_FRACTION of their TTL.
+PREFETCH_FRACTION = 0.1
+PREFETCH_MIN_HITS = 3
+PREFETCH_QPS = 10
+
+Entry = namedtuple('Entry', 'expires rcode records')
+# A resource record as decoded by resolver.decode_message, which imports it from here.
+Record = namedtuple('Record', 'name rtype rclass ttl rdata')
+
+
+def cache_key(name: str, qtype: int) -> tuple:
+    '''Names are case-insensitive and may be written with a trailing dot'''
+    return (name.lower().rstrip('.'), qtype)
+
+
+def negative_ttl(authority: list) -> int:
+    '''TTL of a negative answer: the smaller of the SOA TTL and its MINIMUM field
+
+    Without an SOA it is 0, so the answer is not cached (RFC 2308 section 5).
+    '''
+    for record in authority:
+        if record.rtype == TYPE_SOA and isinstance(record.rdata, tuple):
+            return min(record.ttl, record.rdata[-1])
+    return 0
+
+
+def is_negative(message) -> bool:
+    '''NXDOMAIN, or NOERROR without answers (NODATA)'''
+    rcode = message.flags & 0xF
+    return rcode == RCODE_NXDOMAIN or (rcode == RCODE_NOERROR and not message.answers)
+
+
+class DNSCache:
+    '''LRU-bounded cache of answers keyed by (name, type), expiring on record TTLs
+
+    Negative entries (NXDOMAIN or NODATA) are kept too and carry no records.
+    Records may be any namedtuple with a `ttl` field. `on_drop` is called
+    with the key of every entry that expires or is evicted.
+    '''
+
+    def __init__(self, size: int = CACHE_SIZE, clock=time.time, on_drop=None):
+        self.size = size
+        self.clock = clock
+        self.on_drop = on_drop
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def drop(self, key: tuple) -> None:
+        '''Remove an entry'''
+        del self.entries[key]
+        if self.on_drop is not None:
+            self.on_drop(key)
+
+    def get(self, name: str, qtype: int) -> Entry:
+        '''Live entry with record TTLs counted down, or None'''
+        key = cache_key(name, qtype)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        now = self.clock()
+        if entry.expires <= now:
+            self.drop(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        left = int(entry.expires - now)
+        return entry._replace(records=[r._replace(ttl=min(r.ttl, left)) for r in entry.records])
+
+    def put(self, name: str, qtype: int, records: list, rcode: int = RCODE_NOERROR, ttl: int = None) -> None:
+        '''Cache records for their smallest TTL, or a negative answer for ttl seconds'''
+        if ttl is None:
+            ttl = min((r.ttl for r in records), default=0)
+        if ttl <= 0 or self.size <= 0:
+            return
+        key = cache_key(name, qtype)
+        self.entries[key] = Entry(self.clock() + ttl, rcode, list(records))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def store(self, name: str, qtype: int, message) -> None:
+        '''Cache a decoded response to the question (name, qtype)'''
+        rcode = message.flags & 0xF
+        records = [r for r in message.answers if r.rtype == qtype]
+        if is_negative(message):
+            self.put(name, qtype, [], rcode, negative_ttl(message.authority))
+        elif rcode == RCODE_NOERROR and records:
+            self.put(name, qtype, records)
+
+    def stats(self) -> dict:
+        '''Counters since the cache was created'''
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+    def save(self, filename: str) -> None:
+        '''Write the live entries to a JSON file'''
+        now = self.clock()
+        rows = []
+        for (name, qtype), entry in self.entries.items():
+            if entry.expires > now:
+                rows.append([name, qtype, entry.expires, entry.rcode,
+                             [list(r[:4]) + [encode_rdata(r.rdata)] for r in entry.records]])
+        temp = filename + '.tmp'
+        with open(temp, 'w') as outfile:
+            json.dump(rows, outfile)
+        os.replace(temp, filename)
+
+    def load(self, filename: str) -> int:
+        '''Read entries written by save, skipping those that expired since'''
+        with open(filename) as infile:
+            rows = json.load(infile)
+        now = self.clock()
+        loaded = 0
+        for name, qtype, expires, rcode, records in rows:
+            if expires > now:
+                records = [Record(*r[:4], decode_rdata(r[4])) for r in records]
+                self.entries[(name, qtype)] = Entry(expires, rcode, records)
+                loaded += 1
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return loaded
+
+
+class Prefetcher:
+    '''Pick popular cache entries to refresh before they expire
+
+    Hits are counted per key since the entry was last stored. An entry hit at
+    least `min_hits` times is due once less than `fraction` of its TTL is
+    left; refreshes are limited to `max_qps` per second by a token bucket.
+    '''
+
+    def __init__(self, fraction: float = PREFETCH_FRACTION, min_hits: int = PREFETCH_MIN_HITS,
+                 max_qps: float = PREFETCH_QPS, clock=time.monotonic):
+        self.fraction = fraction
+        self.min_hits = min_hits
+        self.max_qps = max_qps
+        self.clock = clock
+        self.hits = {}
+        self.pending = set()
+        self.tokens = max_qps
+        self.updated = clock()
+        self.prefetched = 0
+        self.throttled = 0
+
+    def due(self, key: tuple, stored: float, expires: float) -> bool:
+        '''Count a hit on an entry and tell whether to refresh it now'''
+        hits = self.hits.get(key, 0) + 1
+        self.hits[key] = hits
+        now = self.clock()
+        if key in self.pending or hits < self.min_hits or expires - now > self.fraction * (expires - stored):
+            return False
+        self.tokens = min(self.tokens + (now - self.updated) * self.max_qps, self.max_qps)
+        self.updated = now
+        if self.tokens < 1:
+            self.throttled += 1
+            return False
+        self.tokens -= 1
+        self.pending.add(key)
+        self.prefetched += 1
+        return True
+
+    def forget(self, key: tuple) -> None:
+        '''The entry was stored again, refreshed or dropped: start counting afresh'''
+        self.hits.pop(key, None)
+        self.pending.discard(key)
+
+
+def encode_rdata(rdata):
+    '''Make record data JSON-friendly'''
+    if isinstance(rdata, bytes):
+        return {'hex': rdata.hex()}
+    if isinstance(rdata, tuple):
+        return {'tuple': list(rdata)}
+    return rdata
+
+
+def decode_rdata(value):
+    '''Undo encode_rdata'''
+    if isinstance(value, dict):
+        if 'hex' in value:
+            return bytes.fromhex(value['hex'])
+        return tuple(value['tuple'])
+    return value
@@ -0,0 +1,77 @@
+'''
+Helpers shared by the resolver tests
+'''
+#!/usr/bin/python3
+
+
+import os
+import sys
+import threading
+from socket import socket, timeout, SOCK_DGRAM, AF_INET
+
+NAMESERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '03-DNS-server', 'project3')
+sys.path.append(NAMESERVER_DIR)
+import nameserver
+
+
+class Clock:
+    '''Hand-driven clock'''
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class ZooZone:
+    '''cs430.luther.edu served by the 03-DNS-server request handling'''
+
+    def __init__(self):
+        self.origin, self.zone = nameserver.read_zone_file(os.path.join(NAMESERVER_DIR, 'zoo.zone'))
+
+    def answer(self, request: bytes) -> bytes:
+        '''Answer one query the way nameserver.run() does'''
+        trans_id, domain, qry_type, qry = nameserver.parse_request(self.origin, request)
+        return bytes(nameserver.format_response(self.zone, trans_id, domain, qry_type, qry))
+
+
+class LoopbackServer:
+    '''Answers UDP queries for one zone on a loopback address, after delay seconds or never when it is None'''
+
+    def __init__(self, address: str, port: int, zone, delay: float = 0):
+        self.zone = zone
+        self.delay = delay
+        self.queries = 0
+        self.sckt = socket(AF_INET, SOCK_DGRAM)
+        self.sckt.bind((address, port))
+        self.sckt.settimeout(0.05)
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self) -> None:
+        '''Receive queries and reply, or schedule the delayed replies'''
+        while self.running:
+            try:
+                request, client = self.sckt.recvfrom(512)
+            except timeout:
+                continue
+            self.queries += 1
+            if self.delay is None:
+                continue
+            if self.delay:
+                threading.Timer(self.delay, self.reply, (request, client)).start()
+            else:
+                self.reply(request, client)
+
+    def reply(self, request: bytes, client: tuple) -> None:
+        '''Send the zone's answer unless the server was closed meanwhile'''
+        if self.running:
+            self.sckt.sendto(self.zone.answer(request), client)
+
+    def close(self) -> None:
+        '''Stop serving'''
+        self.running = False
+        self.thread.join()
+        self.sckt.close()
@@ -0,0 +1,362 @@
+'''
+Caching DNS forwarder serving local zones authoritatively
+'''
+#!/usr/bin/env python3
+
+import asyncio
+import os
+import struct
+import sys
+import time
+from collections import deque, namedtuple
+
+from cache import CACHE_SIZE, DNSCache, Prefetcher, cache_key, is_negative, negative_ttl
+from resolver import (HEADER, PORT, PUBLIC_DNS_SERVER, QUESTION, RR_FIXED, TYPE_OPT, UINT16,
+                      decode_message, read_name)
+from transport import DNSTransport, question_key
+from upstream import UpstreamSelector, RCODE_REFUSED, RCODE_SERVFAIL
+
+NAMESERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '03-DNS-server', 'project3')
+sys.path.append(NAMESERVER_DIR)
+import nameserver
+
+HOST = '127.0.0.1'
+LISTEN_PORT = 5353
+TIMEOUT = 2.0
+# Servers asked, best first, before a query is answered with SERVFAIL.
+UPSTREAM_TRIES = 2
+DEFAULT_UDP_SIZE = 512
+MAX_UDP_SIZE = 4096
+FLAG_TC = 0x02
+RCODE_NOERROR = 0
+LATENCY_SAMPLES = 1000
+STATS_INTERVAL = 60
+TTL = struct.Struct('!I')
+
+# A reply in wire format, the only record of its DNSCache entry.
+CachedReply = namedtuple('CachedReply', 'ttl stored reply offsets')
+
+
+def question_end(data: bytes) -> int:
+    '''Offset just past the first question'''
+    return read_name(memoryview(data), HEADER.size, {})[1] + QUESTION.size
+
+
+def ttl_offsets(data: bytes) -> list:
+    '''Offsets of the TTL field of every record except the OPT pseudo-record'''
+    view = memoryview(data)
+    _, _, qdcount, ancount, nscount, arcount = HEADER.unpack_from(view, 0)
+    names = {}
+    offset = HEADER.size
+    for _ in range(qdcount):
+        offset = read_name(view, offset, names)[1] + QUESTION.size
+    offsets = []
+    for _ in range(ancount + nscount + arcount):
+        offset = read_name(view, offset, names)[1]
+        rtype, _, _, length = RR_FIXED.unpack_from(view, offset)
+        if rtype != TYPE_OPT:
+            offsets.append(offset + 4)
+        offset += RR_FIXED.size + length
+    return offsets
+
+
+def strip_opt(reply: bytes) -> bytes:
+    '''Reply without its OPT pseudo-record, which only describes the hop it came over (RFC 6891)'''
+    view = memoryview(reply)
+    _, _, qdcount, ancount, nscount, arcount = HEADER.unpack_from(view, 0)
+    names = {}
+    offset = HEADER.size
+    for _ in range(qdcount):
+        offset = read_name(view, offset, names)[1] + QUESTION.size
+    for _ in range(ancount + nscount + arcount):
+        start = offset
+        offset = read_name(view, offset, names)[1]
+        rtype, _, _, length = RR_FIXED.unpack_from(view, offset)
+        offset += RR_FIXED.size + length
+        if rtype == TYPE_OPT:
+            stripped = bytearray(reply[:start]) + reply[offset:]
+            UINT16.pack_into(stripped, 10, arcount - 1)
+            return bytes(stripped)
+    return reply
+
+
+def add_opt(reply: bytearray) -> bytearray:
+    '''Append the forwarder's own OPT record to a reply for an EDNS0 client'''
+    UINT16.pack_into(reply, 10, UINT16.unpack_from(reply, 10)[0] + 1)
+    reply += nameserver.opt_record(MAX_UDP_SIZE)
+    return reply
+
+
+def error_reply(request: bytes, end: int, rcode: int) -> bytes:
+    '''Header and question of the request with an error code and no records'''
+    return bytes(request[:2]) + bytes([0x80 | (request[2] & 0x01), 0x80 | rcode]) + b'\x00\x01' + bytes(6) + bytes(request[12:end])
+
+
+def fit(reply: bytearray, end: int, size: int, edns: bool = False) -> bytearray:
+    '''Cut a reply too large for the client's UDP buffer down to header, question and TC
+
+    An EDNS0 client keeps the OPT record in the truncated reply.
+    '''
+    if len(reply) <= size:
+        return reply
+    truncated = bytearray(reply[:end])
+    truncated[2] |= FLAG_TC
+    truncated[6:12] = bytes(6)
+    return add_opt(truncated) if edns else truncated
+
+
+class ReplyCache:
+    '''Upstream replies in wire format, kept in a DNSCache keyed by (name, type)
+
+    Each reply is stored as the only record of its entry, for its smallest
+    record TTL (or the negative TTL of an NXDOMAIN/NODATA answer), and is
+    served with every TTL counted down. Hits that make an entry due for
+    prefetch queue its key in `due`.
+    '''
+
+    def __init__(self, size: int = CACHE_SIZE, clock=time.monotonic, prefetcher: Prefetcher = None):
+        self.clock = clock
+        self.prefetcher = prefetcher
+        self.replies = DNSCache(size, clock, None if prefetcher is None else prefetcher.forget)
+        self.due = []
+
+    def __len__(self) -> int:
+        return len(self.replies)
+
+    def get(self, name: str, qtype: int) -> bytearray:
+        '''Copy of a live reply with its TTLs reduced by its age, or None'''
+        entry = self.replies.get(name, qtype)
+        if entry is None:
+            return None
+        cached = entry.records[0]
+        if self.prefetcher is not None and self.prefetcher.due(cache_key(name, qtype), cached.stored, entry.expires):
+            self.due.append(cache_key(name, qtype))
+        age = int(self.clock() - cached.stored)
+        reply = bytearray(cached.reply)
+        for offset in cached.offsets:
+            TTL.pack_into(reply, offset, max(TTL.unpack_from(reply, offset)[0] - age, 0))
+        return reply
+
+    def put(self, name: str, qtype: int, reply: bytes) -> None:
+        '''Cache a NOERROR or NXDOMAIN reply'''
+        message = decode_message(reply)
+        rcode = message.flags & 0xF
+        if is_negative(message):
+            ttl = negative_ttl(message.authority)
+        elif rcode == RCODE_NOERROR:
+            ttl = min(r.ttl for r in message.answers)
+        else:
+            return
+        cached = CachedReply(ttl, self.clock(), bytes(reply), ttl_offsets(reply))
+        self.replies.put(name, qtype, [cached], rcode, ttl)
+        if self.prefetcher is not None:
+            self.prefetcher.forget(cache_key(name, qtype))
+
+
+class Forwarder(asyncio.DatagramProtocol):
+    '''Answer from local zones, then from the cache, then from an upstream server
+
+    Identical questions arriving while one is already being forwarded wait
+    for that upstream reply instead of sending their own. Popular cached
+    answers are refreshed in the background before they expire.
+    '''
+
+    def __init__(self, zones: nameserver.ZoneStore, upstreams: list = PUBLIC_DNS_SERVER, upstream_port: int = PORT,
+                 timeout: float = TIMEOUT, cache: ReplyCache = None):
+        self.zones = zones
+        self.selector = UpstreamSelector(upstreams)
+        self.upstream_port = upstream_port
+        self.timeout = timeout
+        self.cache = ReplyCache(prefetcher=Prefetcher()) if cache is None else cache
+        self.upstream = None
+        self.transport = None
+        self.tcp_server = None
+        self.inflight = {}
+        self.tasks = set()
+        self.started = time.monotonic()
+        self.last_report = (self.started, 0)
+        self.queries = 0
+        self.authoritative = 0
+        self.upstream_queries = 0
+        self.upstream_failures = 0
+        self.coalesced = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    async def start(self, host: str = HOST, port: int = LISTEN_PORT) -> int:
+        '''Listen on UDP and TCP, returning the port'''
+        loop = asyncio.get_running_loop()
+        self.upstream = await DNSTransport.open()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=(host, port))
+        port = self.transport.get_extra_info('sockname')[1]
+        self.tcp_server = await asyncio.start_server(self.serve_tcp, host, port)
+        return port
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        task = asyncio.ensure_future(self.reply_udp(data, addr))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def reply_udp(self, data: bytes, addr: tuple) -> None:
+        '''Answer one datagram within the client's UDP buffer'''
+        reply = await self.handle(data)
+        if reply is not None:
+            edns_size = nameserver.parse_edns(data, question_end(data))
+            size = DEFAULT_UDP_SIZE if edns_size is None else min(max(edns_size, DEFAULT_UDP_SIZE), MAX_UDP_SIZE)
+            self.transport.sendto(fit(reply, question_end(reply), size, edns_size is not None), addr)
+
+    async def serve_tcp(self, reader, writer) -> None:
+        '''Answer length-prefixed queries on one TCP connection'''
+        try:
+            while True:
+                length = await asyncio.wait_for(reader.readexactly(2), nameserver.TCP_IDLE_TIMEOUT)
+                reply = await self.handle(await reader.readexactly(UINT16.unpack(length)[0]))
+                if reply is not None:
+                    writer.write(UINT16.pack(len(reply)) + bytes(reply))
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError):
+            writer.close()
+
+    async def handle(self, data: bytes) -> bytearray:
+        '''Response to one query, or None for a message that is not a query'''
+        try:
+            _, name, qtype = question_key(data)
+            _, wire_name, _, _, end = nameserver.parse_question(data)
+        except (ValueError, IndexError, struct.error):
+            return None
+        if data[2] & 0x80:
+            return None
+        self.queries += 1
+        found = self.zones.find(wire_name)
+        if found is not None:
+            self.authoritative += 1
+            # Missing names and types get their negative answer from the zone.
+            return self.zones.answer(data, limit=False)
+        reply = self.cache.get(name, qtype)
+        while self.cache.due:
+            self.prefetch(*self.cache.due.pop())
+        if reply is None:
+            try:
+                reply = bytearray(await self.forward(name, qtype))
+            except (OSError, asyncio.TimeoutError):
+                reply = bytearray(error_reply(data, end, RCODE_SERVFAIL))
+        reply[:2] = data[:2]
+        # Upstream replies are kept without their OPT; EDNS0 clients get ours.
+        return add_opt(reply) if nameserver.parse_edns(data, end) is not None else reply
+
+    async def forward(self, name: str, qtype: int) -> bytes:
+        '''Upstream reply to (name, qtype), shared by every query asking it meanwhile'''
+        key = cache_key(name, qtype)
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self.ask_upstream(name, qtype))
+            self.inflight[key] = future
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(future)
+
+    def prefetch(self, name: str, qtype: int) -> None:
+        '''Refresh a cached answer in the background'''
+        async def refresh():
+            try:
+                await self.forward(name, qtype)
+            except (OSError, asyncio.TimeoutError):
+                pass
+            finally:
+                self.cache.prefetcher.forget((name, qtype))
+        task = asyncio.ensure_future(refresh())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def ask_upstream(self, name: str, qtype: int) -> bytes:
+        '''Ask the best upstream servers in turn and cache the first usable reply'''
+        for server in self.selector.ranked()[:UPSTREAM_TRIES]:
+            self.upstream_queries += 1
+            start = time.monotonic()
+            try:
+                reply = await self.upstream.query(qtype, name.split('.'), server, self.upstream_port,
+                                                  self.timeout, retries=0)
+            except (OSError, asyncio.TimeoutError):
+                self.upstream_failures += 1
+                self.selector.record_failure(server)
+                continue
+            if reply[3] & 0xF in (RCODE_SERVFAIL, RCODE_REFUSED):
+                self.upstream_failures += 1
+                self.selector.record_failure(server)
+                continue
+            rtt = time.monotonic() - start
+            self.selector.record_success(server, rtt)
+            self.latencies.append(rtt)
+            reply = strip_opt(reply)
+            self.cache.put(name, qtype, reply)
+            return reply
+        raise TimeoutError("No upstream answered for {}".format(name))
+
+    def stats(self) -> dict:
+        '''Counters since start; qps covers the time since the previous call'''
+        now = time.monotonic()
+        since, queries = self.last_report
+        self.last_report = (now, self.queries)
+        lookups = self.cache.replies.hits + self.cache.replies.misses
+        latencies = sorted(self.latencies)
+        return {
+            'queries': self.queries,
+            'qps': (self.queries - queries) / max(now - since, 1e-9),
+            'authoritative': self.authoritative,
+            'cache_hits': self.cache.replies.hits,
+            'cache_misses': self.cache.replies.misses,
+            'hit_ratio': self.cache.replies.hits / lookups if lookups else 0.0,
+            'coalesced': self.coalesced,
+            'prefetched': self.cache.prefetcher.prefetched if self.cache.prefetcher else 0,
+            'throttled': self.cache.prefetcher.throttled if self.cache.prefetcher else 0,
+            'upstream_queries': self.upstream_queries,
+            'upstream_failures': self.upstream_failures,
+            'upstream_ms_avg': 1000 * sum(latencies) / len(latencies) if latencies else 0.0,
+            'upstream_ms_p50': 1000 * latencies[len(latencies) // 2] if latencies else 0.0,
+            'upstream_ms_p99': 1000 * latencies[int(len(latencies) * 0.99)] if latencies else 0.0
+        }
+
+    def close(self) -> None:
+        '''Stop listening and close the upstream socket'''
+        self.transport.close()
+        self.tcp_server.close()
+        self.upstream.close()
+
+
+async def report(forwarder: Forwarder, interval: float) -> None:
+    '''Print the counters every interval seconds'''
+    while True:
+        await asyncio.sleep(interval)
+        print(' '.join('{}={}'.format(k, round(v, 3) if isinstance(v, float) else v)
+                       for k, v in forwarder.stats().items()))
+
+
+async def serve(port: int, zone_files: list, upstreams: list, interval: float) -> None:
+    '''Run the forwarder until interrupted'''
+    forwarder = Forwarder(nameserver.load_zones(zone_files), upstreams)
+    port = await forwarder.start(HOST, port)
+    print("Forwarding on {}:{} to {}".format(HOST, port, ', '.join(upstreams)))
+    try:
+        await report(forwarder, interval)
+    finally:
+        forwarder.close()
+
+
+def main(*argv):
+    '''Main function'''
+    argv = list(argv[0])
+    upstreams = []
+    while '--upstream' in argv and argv.index('--upstream') + 1 < len(argv):
+        i = argv.index('--upstream')
+        upstreams.append(argv[i + 1])
+        del argv[i:i + 2]
+    if len(argv) < 2:
+        print('Proper use: python3 forwarder.py [--upstream <server>]... <port> [zone_file]...')
+        exit()
+    asyncio.run(serve(int(argv[1]), argv[2:], upstreams or PUBLIC_DNS_SERVER, STATS_INTERVAL))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
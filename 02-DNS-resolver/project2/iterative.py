@@ -0,0 +1,220 @@
+'''
+Iterative resolution from the root servers down
+'''
+#!/usr/bin/env python3
+
+import sys
+import time
+from collections import namedtuple
+from socket import socket, SOCK_DGRAM, AF_INET
+
+from resolver import (DNS_TYPES, EDNS_SIZE, MAX_MESSAGE, PORT, TYPE_A, TYPE_CNAME, TYPE_NS, TCP_POOL,
+                      decode_message, format_query, is_truncated)
+
+# The root servers (named.root); replace them with a hints file for private trees.
+ROOT_HINTS = [
+    ('a.root-servers.net', '198.41.0.4'),
+    ('b.root-servers.net', '170.247.170.2'),
+    ('c.root-servers.net', '192.33.4.12'),
+    ('d.root-servers.net', '199.7.91.13'),
+    ('e.root-servers.net', '192.203.230.10'),
+    ('f.root-servers.net', '192.5.5.241'),
+    ('g.root-servers.net', '192.112.36.4'),
+    ('h.root-servers.net', '198.97.190.53'),
+    ('i.root-servers.net', '192.36.148.17'),
+    ('j.root-servers.net', '192.58.128.30'),
+    ('k.root-servers.net', '193.0.14.129'),
+    ('l.root-servers.net', '199.7.83.42'),
+    ('m.root-servers.net', '202.12.27.33')
+]
+
+TIMEOUT = 2.0
+MAX_REFERRALS = 16
+MAX_CNAMES = 8
+# How deep resolving the address of a name server may recurse.
+MAX_DEPTH = 4
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_REFUSED = 5
+
+Delegation = namedtuple('Delegation', 'expires servers')
+
+
+def is_subdomain(name: str, zone: str) -> bool:
+    '''name is zone or lies below it; the root zone is ""'''
+    return not zone or name == zone or name.endswith('.' + zone)
+
+
+def read_root_hints(filename: str) -> list:
+    '''(name, address) pairs from the A records of a named.root-style file'''
+    hints = []
+    with open(filename) as infile:
+        for line in infile:
+            fields = line.split(';')[0].split()
+            if len(fields) >= 3 and fields[-2].upper() == 'A':
+                hints.append((fields[0].lower().rstrip('.'), fields[-1]))
+    return hints
+
+
+class DelegationCache:
+    '''Name servers of the zones met so far, and their addresses (glue)
+
+    Both expire on the TTLs of the records they came from. The root hints
+    never expire and back every lookup.
+    '''
+
+    def __init__(self, roots: list = ROOT_HINTS, clock=time.time):
+        self.clock = clock
+        self.roots = [name for name, _ in roots]
+        self.zones = {}
+        self.addresses = {}
+        for name, address in roots:
+            self.addresses.setdefault(name, (float('inf'), []))[1].append(address)
+
+    def add_addresses(self, name: str, addresses: list, ttl: int) -> None:
+        '''Remember the IPv4 addresses of a name server'''
+        if addresses and ttl > 0:
+            self.addresses[name] = (self.clock() + ttl, list(addresses))
+
+    def lookup_addresses(self, name: str) -> list:
+        '''Live addresses of a name server, or an empty list'''
+        expires, addresses = self.addresses.get(name, (0, []))
+        return addresses if expires > self.clock() else []
+
+    def add_zone(self, zone: str, ns_records: list, glue: list) -> None:
+        '''Cache a referral: the zone's NS records and the A records glued to them'''
+        servers = [r.rdata.lower() for r in ns_records]
+        ttl = min(r.ttl for r in ns_records)
+        if ttl > 0:
+            self.zones[zone] = Delegation(self.clock() + ttl, servers)
+        for server in servers:
+            records = [r for r in glue if r.rtype == TYPE_A and r.name.lower() == server]
+            if records:
+                self.add_addresses(server, [r.rdata for r in records], min(r.ttl for r in records))
+
+    def closest(self, name: str) -> tuple:
+        '''(zone, name servers) of the deepest live delegation above name'''
+        now = self.clock()
+        labels = name.split('.')
+        for i in range(len(labels)):
+            zone = '.'.join(labels[i:])
+            delegation = self.zones.get(zone)
+            if delegation is not None:
+                if delegation.expires > now:
+                    return zone, delegation.servers
+                del self.zones[zone]
+        return '', self.roots
+
+
+class IterativeResolver:
+    '''Follow referrals from the root hints, chasing CNAMEs on the way'''
+
+    def __init__(self, roots: list = ROOT_HINTS, port: int = PORT, timeout: float = TIMEOUT,
+                 delegations: DelegationCache = None):
+        self.port = port
+        self.timeout = timeout
+        self.delegations = DelegationCache(roots) if delegations is None else delegations
+        self.queries = 0
+
+    def ask(self, address: str, message: bytes):
+        '''Send one non-recursive query, retrying over TCP if the answer was truncated'''
+        with socket(AF_INET, SOCK_DGRAM) as sckt:
+            sckt.settimeout(self.timeout)
+            sckt.sendto(message, (address, self.port))
+            self.queries += 1
+            while True:
+                reply, source = sckt.recvfrom(MAX_MESSAGE)
+                if source[0] == address and reply[:2] == message[:2]:
+                    break
+        if is_truncated(reply):
+            reply = TCP_POOL.request(message, address, self.port)
+        return decode_message(reply)
+
+    def ask_zone(self, servers: list, name: str, qtype: int, depth: int):
+        '''Ask the zone's name servers in turn until one gives a usable answer'''
+        message = format_query(qtype, name.split('.'), edns_size=EDNS_SIZE)
+        # Recursion not desired: each server answers from its own data.
+        message[2] &= 0xFE
+        for server in servers:
+            addresses = self.delegations.lookup_addresses(server)
+            if not addresses and depth < MAX_DEPTH:
+                addresses = self.server_addresses(server, depth)
+            for address in addresses:
+                try:
+                    reply = self.ask(address, message)
+                except (OSError, ValueError, IndexError):
+                    continue
+                if reply.flags & 0xF not in (RCODE_SERVFAIL, RCODE_REFUSED):
+                    return reply
+        raise TimeoutError("No name server answered for {}".format(name))
+
+    def server_addresses(self, server: str, depth: int) -> list:
+        '''Resolve a name server that came without glue'''
+        try:
+            reply = self.resolve(server, TYPE_A, depth + 1)
+        except (OSError, ValueError):
+            return []
+        records = [r for r in reply.answers if r.rtype == TYPE_A]
+        if records:
+            self.delegations.add_addresses(server, [r.rdata for r in records], min(r.ttl for r in records))
+        return [r.rdata for r in records]
+
+    def lookup(self, name: str, qtype: int, depth: int = 0):
+        '''Ask from the closest known delegation down until a server answers'''
+        zone, servers = self.delegations.closest(name)
+        for _ in range(MAX_REFERRALS):
+            reply = self.ask_zone(servers, name, qtype, depth)
+            if reply.answers or reply.flags & 0xF != RCODE_NOERROR:
+                return reply
+            referral = [r for r in reply.authority if r.rtype == TYPE_NS]
+            child = referral[0].name.lower() if referral else None
+            # Only a zone between the current one and the name is a step down.
+            if child is None or child == zone or not is_subdomain(name, child) or not is_subdomain(child, zone):
+                return reply
+            # Glue is trusted only inside the zone that handed it out.
+            glue = [r for r in reply.additional if is_subdomain(r.name.lower(), zone)]
+            self.delegations.add_zone(child, [r for r in referral if r.name.lower() == child], glue)
+            zone, servers = child, [r.rdata.lower() for r in referral if r.name.lower() == child]
+        raise ValueError("Too many referrals for {}".format(name))
+
+    def resolve(self, name: str, qtype: int, depth: int = 0):
+        '''Answer for (name, qtype) with any CNAME chain leading to it'''
+        name = name.lower().rstrip('.')
+        chain = []
+        for _ in range(MAX_CNAMES + 1):
+            reply = self.lookup(name, qtype, depth)
+            answers = reply.answers
+            target = name
+            aliases = {r.name.lower(): r.rdata.lower() for r in answers if r.rtype == TYPE_CNAME}
+            while target in aliases:
+                target = aliases.pop(target)
+            done = qtype == TYPE_CNAME or any(r.rtype == qtype and r.name.lower() == target for r in answers)
+            if done or target == name:
+                return reply._replace(answers=chain + answers)
+            chain.extend(answers)
+            name = target
+        raise ValueError("CNAME chain too long")
+
+
+def main(*argv):
+    '''Main function'''
+    if len(argv[0]) < 3 or len(argv[0]) > 5:
+        print('Proper use: python3 iterative.py <type> <domain> [root_hints_file] [port]')
+        exit()
+    roots = read_root_hints(argv[0][3]) if len(argv[0]) >= 4 else ROOT_HINTS
+    port = int(argv[0][4]) if len(argv[0]) == 5 else PORT
+    resolver = IterativeResolver(roots, port)
+    start = time.time()
+    reply = resolver.resolve(argv[0][2], DNS_TYPES[argv[0][1].upper()])
+    end = time.time()
+    for record in reply.answers:
+        print('{}\t{}\t{}\t{}'.format(record.name, record.ttl,
+                                      next((k for k, v in DNS_TYPES.items() if v == record.rtype), record.rtype),
+                                      record.rdata))
+    if not reply.answers:
+        print('No records (rcode {})'.format(reply.flags & 0xF))
+    print("Resolved in {:.3f}s with {} queries".format(end-start, resolver.queries))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
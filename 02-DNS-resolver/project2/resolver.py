@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
 
+import os
+import struct
 import sys
 import time
-from random import randint, choice, seed
-from socket import socket, SOCK_DGRAM, AF_INET
+from collections import namedtuple
+from random import seed
+from secrets import randbelow
+from socket import socket, create_connection, SOCK_DGRAM, AF_INET
+
+from cache import DNSCache, RCODE_NXDOMAIN, Record
+from upstream import UpstreamSelector, query_hedged
 
 PORT = 53
 
@@ -30,6 +37,36 @@ PUBLIC_DNS_SERVER = [
     '208.67.220.220'  # OpenDNS
 ]
 
+TYPE_A = 1
+TYPE_NS = 2
+TYPE_CNAME = 5
+TYPE_SOA = 6
+TYPE_PTR = 12
+TYPE_MX = 15
+TYPE_TXT = 16
+TYPE_AAAA = 28
+TYPE_OPT = 41
+
+HEADER = struct.Struct('!6H')
+QUESTION = struct.Struct('!2H')
+RR_FIXED = struct.Struct('!2HIH')
+UINT16 = struct.Struct('!H')
+SOA_TIMERS = struct.Struct('!5I')
+IPV6_GROUPS = struct.Struct('!8H')
+# More pointers than this in one name can only be a compression loop.
+MAX_POINTERS = 64
+# UDP payload size advertised through EDNS0 (the DNS flag day 2020 default).
+EDNS_SIZE = 1232
+MAX_MESSAGE = 65535
+FLAG_TC = 0x02
+TCP_TIMEOUT = 5.0
+
+Question = namedtuple('Question', 'name qtype qclass')
+Message = namedtuple('Message', 'id flags questions answers authority additional')
+
+CACHE = DNSCache()
+SELECTOR = UpstreamSelector(PUBLIC_DNS_SERVER)
+
 
 def val_to_2_bytes(value: int) -> list:
     '''Split a value into 2 bytes'''
@@ -80,15 +117,16 @@ def parse_cli_query(filename, q_type, q_domain, q_server=None) -> tuple:
     q_type = DNS_TYPES[q_type]
     q_domain = q_domain.split(".")
     if not q_server:
-        q_server = choice(PUBLIC_DNS_SERVER)
+        q_server = SELECTOR.best()
     
     return q_type, q_domain, q_server
 
-def format_query(q_type: int, q_domain: list) -> bytearray:
-    '''Format DNS query'''
-    # transaction_id = val_to_2_bytes(randint(0, 65535))
-    # Hard coding transaction id.
-    transaction_id = [79,66]
+def format_query(q_type: int, q_domain: list, trans_id: int = None, edns_size: int = None) -> bytearray:
+    '''Format DNS query, with an EDNS0 OPT record when edns_size is given'''
+    if trans_id is None:
+        # From the OS CSPRNG: predictable IDs make off-path spoofing easier.
+        trans_id = randbelow(65536)
+    transaction_id = val_to_2_bytes(trans_id)
     query = bytearray([transaction_id[0], transaction_id[1], 1, 0])
 
     # Flags
@@ -114,17 +152,71 @@ def format_query(q_type: int, q_domain: list) -> bytearray:
     query.append(0)
     query.append(1)
 
+    if edns_size:
+        # One additional record: OPT with the root name and the payload size as its class.
+        query[11] = 1
+        query.extend([0] + val_to_2_bytes(TYPE_OPT) + val_to_2_bytes(edns_size) + [0] * 6)
+
     return query
 
-def send_request(q_message: bytearray, q_server: str) -> bytes:
-    '''Contact the server'''
+def send_request(q_message: bytearray, q_server: str, port: int = PORT) -> bytes:
+    '''Contact the server, retrying over TCP if the answer was truncated'''
     client_sckt = socket(AF_INET, SOCK_DGRAM)
-    client_sckt.sendto(q_message, (q_server, PORT))
-    (q_response, _) = client_sckt.recvfrom(2048)
+    client_sckt.sendto(q_message, (q_server, port))
+    (q_response, _) = client_sckt.recvfrom(MAX_MESSAGE)
     client_sckt.close()
-    
+    if is_truncated(q_response):
+        q_response = TCP_POOL.request(q_message, q_server, port)
+
     return q_response
 
+def is_truncated(resp_bytes: bytes) -> bool:
+    '''The TC bit says the answer did not fit in the datagram'''
+    return len(resp_bytes) > 2 and bool(resp_bytes[2] & FLAG_TC)
+
+def recv_exactly(sckt: socket, n_bytes: int) -> bytes:
+    '''Read exactly n bytes from a stream socket'''
+    data = bytearray()
+    while len(data) < n_bytes:
+        chunk = sckt.recv(n_bytes - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by the server")
+        data += chunk
+    return bytes(data)
+
+class TCPConnectionPool:
+    '''DNS-over-TCP connections kept open per server for reuse'''
+
+    def __init__(self, timeout: float = TCP_TIMEOUT):
+        self.timeout = timeout
+        self.idle = {}
+
+    def request(self, q_message: bytes, q_server: str, port: int = PORT) -> bytes:
+        '''Send a length-prefixed query and read the length-prefixed answer'''
+        idle = self.idle.setdefault((q_server, port), [])
+        while True:
+            reused = bool(idle)
+            sckt = idle.pop() if reused else create_connection((q_server, port), self.timeout)
+            try:
+                sckt.sendall(UINT16.pack(len(q_message)) + bytes(q_message))
+                q_response = recv_exactly(sckt, UINT16.unpack(recv_exactly(sckt, 2))[0])
+            except OSError:
+                sckt.close()
+                # The server may have closed an idle connection: retry on a fresh one.
+                if reused:
+                    continue
+                raise
+            idle.append(sckt)
+            return q_response
+
+    def close(self) -> None:
+        '''Close every idle connection'''
+        for idle in self.idle.values():
+            while idle:
+                idle.pop().close()
+
+TCP_POOL = TCPConnectionPool()
+
 def parse_response(resp_bytes: bytes):
     '''Parse server response'''
     start_of_name, i = resp_bytes[12], 12
@@ -260,27 +352,142 @@ def parse_address_aaaa(addr_len: int, addr_bytes: bytes) -> str:
 
     return "".join(address)
 
+def read_name(view: memoryview, offset: int, names: dict) -> tuple:
+    '''Read a possibly compressed name, returning it and the offset just past it
+
+    `names` maps offsets already decoded in this message to the name found
+    there, so the usual pointers back to the question cost one dict lookup.
+    '''
+    labels = []
+    # (offset, index into labels) for every position a pointer jumped to.
+    targets = []
+    end = None
+    while True:
+        length = view[offset]
+        if length >= 0xC0:
+            if end is None:
+                end = offset + 2
+            if len(targets) >= MAX_POINTERS:
+                raise ValueError("Compression loop")
+            offset = (length & 0x3F) << 8 | view[offset + 1]
+            if offset in names:
+                if names[offset]:
+                    labels.append(names[offset])
+                break
+            targets.append((offset, len(labels)))
+        elif length:
+            labels.append(str(view[offset + 1:offset + 1 + length], 'latin-1'))
+            offset += length + 1
+        else:
+            offset += 1
+            break
+    for target, i in targets:
+        names[target] = '.'.join(labels[i:])
+    return '.'.join(labels), offset if end is None else end
+
+
+def read_rdata(view: memoryview, rtype: int, offset: int, length: int, names: dict):
+    '''Decode the data of one resource record'''
+    if rtype == TYPE_A and length == 4:
+        return '%d.%d.%d.%d' % tuple(view[offset:offset + 4])
+    if rtype == TYPE_AAAA and length == 16:
+        return '%x:%x:%x:%x:%x:%x:%x:%x' % IPV6_GROUPS.unpack_from(view, offset)
+    if rtype in (TYPE_NS, TYPE_CNAME, TYPE_PTR):
+        return read_name(view, offset, names)[0]
+    if rtype == TYPE_MX:
+        return (UINT16.unpack_from(view, offset)[0], read_name(view, offset + 2, names)[0])
+    if rtype == TYPE_SOA:
+        mname, pos = read_name(view, offset, names)
+        rname, pos = read_name(view, pos, names)
+        return (mname, rname) + SOA_TIMERS.unpack_from(view, pos)
+    if rtype == TYPE_TXT:
+        strings, pos, end = [], offset, offset + length
+        while pos < end:
+            strings.append(str(view[pos + 1:pos + 1 + view[pos]], 'utf-8', 'replace'))
+            pos += view[pos] + 1
+        return tuple(strings)
+    return bytes(view[offset:offset + length])
+
+
+def decode_message(data: bytes) -> Message:
+    '''Decode a whole DNS message, following compression pointers anywhere'''
+    view = memoryview(data)
+    trans_id, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(view, 0)
+    names = {}
+    offset = HEADER.size
+    questions = []
+    for _ in range(qdcount):
+        name, offset = read_name(view, offset, names)
+        qtype, qclass = QUESTION.unpack_from(view, offset)
+        offset += QUESTION.size
+        questions.append(Question(name, qtype, qclass))
+    sections = []
+    for count in (ancount, nscount, arcount):
+        records = []
+        for _ in range(count):
+            name, offset = read_name(view, offset, names)
+            rtype, rclass, ttl, length = RR_FIXED.unpack_from(view, offset)
+            offset += RR_FIXED.size
+            if offset + length > len(view):
+                raise ValueError("Truncated record")
+            records.append(Record(name, rtype, rclass, ttl, read_rdata(view, rtype, offset, length, names)))
+            offset += length
+        sections.append(records)
+    return Message(trans_id, flags, questions, *sections)
+
+
 def resolve(query: str) -> None:
     '''Resolve the query'''
     q_type, q_domain, q_server = parse_cli_query(*query[0])
-    query_bytes = format_query(q_type, q_domain)
-    response_bytes = send_request(query_bytes, q_server)
-    answers = parse_response(response_bytes)
-    print('DNS server used: {}'.format(q_server))
+    name = '.'.join(q_domain)
+    entry = CACHE.get(name, q_type)
+    if entry is None:
+        query_bytes = format_query(q_type, q_domain, edns_size=EDNS_SIZE)
+        if len(query[0]) == 4:
+            response_bytes = send_request(query_bytes, q_server)
+        else:
+            # No server given: ask the fastest public one, hedging to the runner-up.
+            q_server, response_bytes = query_hedged(SELECTOR, query_bytes, PORT)
+            if is_truncated(response_bytes):
+                response_bytes = TCP_POOL.request(query_bytes, q_server)
+        message = decode_message(response_bytes)
+        CACHE.store(name, q_type, message)
+        print('DNS server used: {}'.format(q_server))
+        answers = message.answers
+        rcode = message.flags & 0xF
+    else:
+        print('Answered from cache')
+        answers = entry.records
+        rcode = entry.rcode
+    if rcode == RCODE_NXDOMAIN:
+        print('No such domain: {}\n'.format(name))
     for a in answers:
-        print('Domain: {}'.format(a[0]))
-        print('TTL: {}'.format(a[1]))
-        print('Address: {}\n'.format(a[2]))
+        if a.rtype not in (TYPE_A, TYPE_AAAA):
+            continue
+        print('Domain: {}'.format(a.name))
+        print('TTL: {}'.format(a.ttl))
+        print('Address: {}\n'.format(a.rdata))
 
 def main(*query):
     '''Main function'''
-    if len(query[0]) < 3 or len(query[0]) > 4:
-        print('Proper use: python3 resolver.py <type> <domain> <server>')
+    argv = list(query[0])
+    cache_file = None
+    if '--cache' in argv and argv.index('--cache') + 1 < len(argv):
+        # --cache <file> keeps the cache on disk between runs.
+        i = argv.index('--cache')
+        cache_file = argv[i + 1]
+        del argv[i:i + 2]
+    if len(argv) < 3 or len(argv) > 4:
+        print('Proper use: python3 resolver.py [--cache <file>] <type> <domain> <server>')
         exit()
+    if cache_file and os.path.exists(cache_file):
+        CACHE.load(cache_file)
     start = time.time()
-    resolve(query)
+    resolve((argv,))
     end = time.time()
     print("Resolved in {:.3f}s".format(end-start))
+    if cache_file:
+        CACHE.save(cache_file)
 
 if __name__ == '__main__':
     main(sys.argv)
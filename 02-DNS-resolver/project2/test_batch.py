@@ -0,0 +1,73 @@
+'''
+Testing batch resolution against the local name server
+'''
+#!/usr/bin/python3
+
+
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from socket import socket, AF_INET, SOCK_DGRAM
+import pytest
+from batch import resolve_many
+
+NAMESERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '03-DNS-server', 'project3')
+NAMESERVER_PORT = 43053
+
+
+@pytest.fixture(scope='module')
+def nameserver():
+    '''Run 03-DNS-server on zoo.zone for the whole module'''
+    proc = subprocess.Popen([sys.executable, '-u', 'nameserver.py', 'zoo.zone'], cwd=NAMESERVER_DIR,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    proc.stdout.readline()
+    time.sleep(0.1)
+    yield ('127.0.0.1', NAMESERVER_PORT)
+    proc.terminate()
+    proc.wait()
+
+
+def collect(queries, server, **kwargs) -> list:
+    '''Run resolve_many to completion'''
+    async def gather():
+        return [r async for r in resolve_many(queries, *server, **kwargs)]
+    return asyncio.run(gather())
+
+
+class TestBatch:
+    '''Testing batch resolution'''
+
+    def test_resolve_many(self, nameserver):
+        '''Every name is resolved, with a small in-flight window'''
+        animals = ['ant', 'emu', 'duck', 'viper', 'hawk', 'bear', 'cat', 'zebra']
+        queries = [(t, '{}.cs430.luther.edu'.format(a)) for a in animals for t in ('A', 'AAAA')]
+        results = collect(queries, nameserver, window=3)
+        assert len(results) == len(queries)
+        assert all(r.error is None for r in results)
+        ant = [r for r in results if r.domain == 'ant.cs430.luther.edu' and r.qtype == 'A'][0]
+        assert sorted(a.rdata for a in ant.message.answers) == ['185.84.224.89', '199.83.67.158']
+
+    def test_nxdomain(self, nameserver):
+        '''A missing name is answered with NXDOMAIN rather than left to time out'''
+        results = collect([('A', 'nothere.cs430.luther.edu')], nameserver, timeout=0.5, retries=0)
+        assert results[0].error is None
+        assert results[0].message.flags & 0xF == 3
+
+    def test_timeout(self):
+        '''Unanswered queries fail after their retries without blocking the others'''
+        # The name server answers every query, so ask a socket that never does.
+        with socket(AF_INET, SOCK_DGRAM) as silent:
+            silent.bind(('127.0.0.1', 0))
+            start = time.monotonic()
+            results = collect([('A', 'ant.cs430.luther.edu'), ('A', 'emu.cs430.luther.edu')],
+                              silent.getsockname(), timeout=0.1, retries=1)
+            elapsed = time.monotonic() - start
+        assert all(isinstance(r.error, asyncio.TimeoutError) for r in results)
+        assert all(r.elapsed >= 0.2 for r in results)
+        assert elapsed < 0.4
+
+
+if __name__ == '__main__':
+    pytest.main(['test_batch.py'])
@@ -0,0 +1,105 @@
+'''
+Testing the DNS cache
+'''
+#!/usr/bin/python3
+
+
+import pytest
+from cache import DNSCache
+from cache import Prefetcher
+from forwarder import Forwarder
+from forwarder import ReplyCache
+from resolver import decode_message
+from resolver import Record
+from conftest import Clock
+import nameserver
+
+
+class TestCache:
+    '''Testing DNS cache'''
+
+    @pytest.fixture(scope='function', autouse=True)
+    def setup_class(self):
+        '''Setting up'''
+        self.clock = Clock()
+        self.cache = DNSCache(size=2, clock=self.clock)
+        self.records = [Record('luther.edu', 1, 1, 300, '174.129.25.170'),
+                        Record('luther.edu', 1, 1, 60, '174.129.25.171')]
+
+    def test_expiry(self):
+        '''Entries live for their smallest TTL and count down'''
+        self.cache.put('Luther.edu.', 1, self.records)
+        self.clock.now += 20
+        entry = self.cache.get('luther.edu', 1)
+        assert [r.ttl for r in entry.records] == [40, 40]
+        self.clock.now += 40
+        assert self.cache.get('luther.edu', 1) is None
+        assert self.cache.stats() == {'entries': 0, 'hits': 1, 'misses': 1, 'evictions': 0, 'expirations': 1}
+
+    def test_lru_eviction(self):
+        '''The least recently used entry goes first'''
+        self.cache.put('a.edu', 1, self.records)
+        self.cache.put('b.edu', 1, self.records)
+        self.cache.get('a.edu', 1)
+        self.cache.put('c.edu', 1, self.records)
+        assert self.cache.get('b.edu', 1) is None
+        assert self.cache.get('a.edu', 1) is not None
+        assert self.cache.evictions == 1
+
+    def test_negative(self):
+        '''NXDOMAIN is cached for the SOA minimum'''
+        message = decode_message(b'\x12\x34\x81\x83\x00\x01\x00\x00\x00\x01\x00\x00' +
+                                 b'\x04nope\x03edu\x00\x00\x01\x00\x01' +
+                                 b'\xc0\x11\x00\x06\x00\x01\x00\x00\x03\x84\x00\x1c' +
+                                 b'\x01a\xc0\x11\x01b\xc0\x11\x00\x00\x00\x01\x00\x00\x00\x02' +
+                                 b'\x00\x00\x00\x03\x00\x00\x00\x04\x00\x00\x00\x05')
+        self.cache.store('nope.edu', 1, message)
+        entry = self.cache.get('nope.edu', 1)
+        assert entry.rcode == 3
+        assert entry.records == []
+        self.clock.now += 5
+        assert self.cache.get('nope.edu', 1) is None
+
+    def test_negative_without_soa(self):
+        '''A negative answer with no SOA in the authority section is not cached'''
+        message = decode_message(b'\x12\x34\x81\x83\x00\x01\x00\x00\x00\x00\x00\x00' +
+                                 b'\x04nope\x03edu\x00\x00\x01\x00\x01')
+        self.cache.store('nope.edu', 1, message)
+        assert self.cache.get('nope.edu', 1) is None
+        assert len(self.cache) == 0
+
+    def test_save_load(self, tmp_path):
+        '''A new cache starts warm from the saved file'''
+        self.cache.put('luther.edu', 1, self.records)
+        self.cache.save(str(tmp_path / 'cache.json'))
+        warm = DNSCache(clock=self.clock)
+        assert warm.load(str(tmp_path / 'cache.json')) == 1
+        assert [r.rdata for r in warm.get('luther.edu', 1).records] == ['174.129.25.170', '174.129.25.171']
+
+    def test_prefetch_due(self):
+        '''Only entries hit often enough and close to expiry are due'''
+        prefetcher = Prefetcher(fraction=0.1, min_hits=2, max_qps=10, clock=self.clock)
+        key = ('luther.edu', 1)
+        assert not prefetcher.due(key, 1000, 1100)
+        assert not prefetcher.due(key, 1000, 1100)
+        self.clock.now += 95
+        assert prefetcher.due(key, 1000, 1100)
+        assert not prefetcher.due(key, 1000, 1100)
+        prefetcher.forget(key)
+        assert not prefetcher.due(key, 1000, 1100)
+
+    def test_prefetch_rate_limit(self):
+        '''Refreshes are capped at max_qps'''
+        prefetcher = Prefetcher(fraction=0.5, min_hits=1, max_qps=2, clock=self.clock)
+        due = [prefetcher.due(('host{}'.format(i), 1), 900, 1010) for i in range(5)]
+        assert due == [True, True, False, False, False]
+        assert prefetcher.throttled == 3
+        self.clock.now += 0.5
+        assert prefetcher.due(('host4', 1), 900, 1010)
+        forwarder = Forwarder(nameserver.ZoneStore(), cache=ReplyCache(clock=self.clock, prefetcher=prefetcher))
+        stats = forwarder.stats()
+        assert (stats['prefetched'], stats['throttled']) == (3, 3)
+
+
+if __name__ == '__main__':
+    pytest.main(['test_cache.py'])
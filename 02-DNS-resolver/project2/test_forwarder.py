@@ -0,0 +1,170 @@
+'''
+Testing the caching forwarder
+'''
+#!/usr/bin/python3
+
+
+import asyncio
+import os
+import pytest
+from resolver import decode_message
+from resolver import format_query
+from forwarder import Forwarder
+from forwarder import ReplyCache
+from forwarder import question_end
+from cache import Prefetcher
+from conftest import Clock
+from conftest import NAMESERVER_DIR
+import nameserver
+
+
+class Upstream(asyncio.DatagramProtocol):
+    '''Answers every question with one A record and an OPT record after a delay'''
+
+    def __init__(self, delay: float = 0.05, ttl: int = 100):
+        self.delay = delay
+        self.ttl = ttl
+        self.queries = 0
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        self.queries += 1
+        asyncio.get_running_loop().call_later(self.delay, self.reply, data, addr)
+
+    def reply(self, data: bytes, addr: tuple) -> None:
+        answer = b'\xc0\x0c\x00\x01\x00\x01' + self.ttl.to_bytes(4, 'big') + b'\x00\x04\x0a\x00\x00\x01'
+        opt = b'\x00\x00\x29\x04\xd0' + bytes(6)
+        self.transport.sendto(data[:2] + b'\x81\x80\x00\x01\x00\x01\x00\x00\x00\x01' +
+                              data[12:question_end(data)] + answer + opt, addr)
+
+
+async def ask(port: int, q_type: int, q_domain: list, trans_id: int = 0x1234, edns_size: int = None) -> bytes:
+    '''Send one query to the forwarder and wait for its reply'''
+    loop = asyncio.get_running_loop()
+    reply = loop.create_future()
+
+    class Client(asyncio.DatagramProtocol):
+        def datagram_received(self, data, addr):
+            if not reply.done():
+                reply.set_result(data)
+
+    transport, _ = await loop.create_datagram_endpoint(Client, remote_addr=('127.0.0.1', port))
+    try:
+        transport.sendto(bytes(format_query(q_type, q_domain, trans_id, edns_size)))
+        return await asyncio.wait_for(reply, 2.0)
+    finally:
+        transport.close()
+
+
+async def with_forwarder(test, clock=None):
+    '''Run test(forwarder, port, upstream) against a forwarder with one local upstream'''
+    loop = asyncio.get_running_loop()
+    upstream_transport, upstream = await loop.create_datagram_endpoint(Upstream, local_addr=('127.0.0.1', 0))
+    zones = nameserver.load_zones([os.path.join(NAMESERVER_DIR, 'zoo.zone')])
+    cache = ReplyCache(clock=clock, prefetcher=Prefetcher(clock=clock)) if clock else None
+    forwarder = Forwarder(zones, ['127.0.0.1'], upstream_transport.get_extra_info('sockname')[1], 1.0, cache)
+    port = await forwarder.start('127.0.0.1', 0)
+    try:
+        return await test(forwarder, port, upstream)
+    finally:
+        forwarder.close()
+        upstream_transport.close()
+
+
+class TestForwarder:
+    '''Testing the forwarder'''
+
+    def test_authoritative(self):
+        '''Names in a loaded zone are answered locally'''
+        async def test(forwarder, port, upstream):
+            message = decode_message(await ask(port, 1, ['ant', 'cs430', 'luther', 'edu']))
+            assert sorted(r.rdata for r in message.answers) == ['185.84.224.89', '199.83.67.158']
+            missing = decode_message(await ask(port, 1, ['gnu', 'cs430', 'luther', 'edu']))
+            assert missing.flags & 0xF == 3
+            assert upstream.queries == 0
+            assert forwarder.authoritative == 2
+        asyncio.run(with_forwarder(test))
+
+    def test_cache(self):
+        '''A repeated question is answered from the cache with its TTL counted down'''
+        clock = Clock()
+
+        async def test(forwarder, port, upstream):
+            first = decode_message(await ask(port, 1, ['luther', 'edu'], 1))
+            clock.now += 40
+            second = decode_message(await ask(port, 1, ['Luther', 'edu'], 2))
+            assert second.id == 2
+            assert first.answers[0].ttl == 100
+            assert second.answers[0].ttl == 60
+            assert upstream.queries == 1
+            stats = forwarder.stats()
+            assert stats['hit_ratio'] == 0.5
+            assert stats['upstream_queries'] == 1
+            assert stats['upstream_ms_avg'] > 0
+            clock.now += 60
+            await ask(port, 1, ['luther', 'edu'], 3)
+            assert upstream.queries == 2
+        asyncio.run(with_forwarder(test, clock))
+
+    def test_prefetch(self):
+        '''A popular answer is refreshed before it expires'''
+        clock = Clock()
+
+        async def test(forwarder, port, upstream):
+            for i in range(3):
+                await ask(port, 1, ['luther', 'edu'], i)
+            assert upstream.queries == 1
+            clock.now += 95
+            assert decode_message(await ask(port, 1, ['luther', 'edu'], 3)).answers[0].ttl == 5
+            await asyncio.sleep(0.1)
+            assert upstream.queries == 2
+            assert forwarder.stats()['prefetched'] == 1
+            clock.now += 10
+            assert decode_message(await ask(port, 1, ['luther', 'edu'], 4)).answers[0].ttl == 90
+            assert upstream.queries == 2
+        asyncio.run(with_forwarder(test, clock))
+
+    def test_reply_cache_eviction(self):
+        '''An evicted reply is forgotten by the prefetcher as well'''
+        clock = Clock()
+        prefetcher = Prefetcher(clock=clock)
+        cache = ReplyCache(size=1, clock=clock, prefetcher=prefetcher)
+        for name in ('luther.edu', 'knuth.edu'):
+            query = bytes(format_query(1, name.split('.'), 1))
+            cache.put(name, 1, query[:2] + b'\x81\x80\x00\x01\x00\x01\x00\x00\x00\x00' + query[12:] +
+                      b'\xc0\x0c\x00\x01\x00\x01\x00\x00\x00\x64\x00\x04\x0a\x00\x00\x01')
+            assert cache.get(name, 1) is not None
+        assert len(cache) == 1
+        assert ('luther.edu', 1) not in prefetcher.hits
+        assert cache.get('luther.edu', 1) is None
+        clock.now += 30
+        assert decode_message(cache.get('knuth.edu', 1)).answers[0].ttl == 70
+
+    def test_coalescing(self):
+        '''A burst of identical questions makes one upstream query'''
+        async def test(forwarder, port, upstream):
+            replies = await asyncio.gather(*(ask(port, 1, ['www', 'luther', 'edu'], i) for i in range(20)))
+            assert sorted(decode_message(r).id for r in replies) == list(range(20))
+            assert upstream.queries == 1
+            assert forwarder.coalesced == 19
+            assert forwarder.stats()['queries'] == 20
+        asyncio.run(with_forwarder(test))
+
+    def test_edns(self):
+        '''The upstream's OPT is never relayed: EDNS0 clients get the forwarder's own, others none'''
+        async def test(forwarder, port, upstream):
+            plain = await ask(port, 1, ['luther', 'edu'], 1)
+            assert plain[10:12] == b'\x00\x00'
+            assert decode_message(plain).answers[0].rdata == '10.0.0.1'
+            for trans_id in (2, 3):
+                extended = await ask(port, 1, ['luther', 'edu'], trans_id, edns_size=1232)
+                assert extended[10:12] == b'\x00\x01'
+                assert extended.endswith(nameserver.opt_record(nameserver.MAX_UDP_SIZE))
+            assert upstream.queries == 1
+        asyncio.run(with_forwarder(test))
+
+
+if __name__ == '__main__':
+    pytest.main(['test_forwarder.py'])
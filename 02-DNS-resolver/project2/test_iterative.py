@@ -0,0 +1,162 @@
+'''
+Testing iterative resolution against a tree of local name servers
+'''
+#!/usr/bin/python3
+
+
+import struct
+import pytest
+from resolver import decode_message
+from resolver import TYPE_A, TYPE_CNAME, TYPE_MX, TYPE_NS, TYPE_SOA
+from iterative import DelegationCache
+from iterative import IterativeResolver
+from iterative import is_subdomain
+from conftest import LoopbackServer
+from conftest import ZooZone
+from nameserver import encode_name
+
+PORT = 43253
+ROOT = '127.0.0.21'
+EDU = '127.0.0.22'
+LUTHER = '127.0.0.23'
+CS430 = '127.0.0.24'
+OTHER = '127.0.0.25'
+
+
+def encode_record(name: str, rtype: int, ttl: int, rdata) -> bytes:
+    '''Wire-format resource record'''
+    if rtype == TYPE_A:
+        rdata = bytes(int(octet) for octet in rdata.split('.'))
+    elif rtype in (TYPE_NS, TYPE_CNAME):
+        rdata = encode_name(rdata)
+    elif rtype == TYPE_MX:
+        rdata = struct.pack('!H', rdata[0]) + encode_name(rdata[1])
+    elif rtype == TYPE_SOA:
+        rdata = encode_name(rdata[0]) + encode_name(rdata[1]) + struct.pack('!5I', *rdata[2:])
+    return encode_name(name) + struct.pack('!2HIH', rtype, 1, ttl, len(rdata)) + rdata
+
+
+class Zone:
+    '''Authoritative data of one zone: records plus delegations to child zones'''
+
+    def __init__(self, origin: str, records: list, delegations: dict = None):
+        self.origin = origin
+        self.records = records
+        self.delegations = delegations or {}
+
+    def answer(self, request: bytes) -> bytes:
+        '''Answer, refer or deny the way an authoritative server would'''
+        question = decode_message(request).questions[0]
+        name = question.name.lower()
+        header = request[:2] + b'\x84\x00'
+        for child, servers in self.delegations.items():
+            if is_subdomain(name, child):
+                authority = [encode_record(child, TYPE_NS, 3600, ns) for ns, _ in servers]
+                glue = [encode_record(ns, TYPE_A, 3600, address) for ns, address in servers if address]
+                return (request[:2] + b'\x80\x00' + struct.pack('!4H', 1, 0, len(authority), len(glue)) +
+                        request[12:12 + len(encode_name(name)) + 4] + b''.join(authority + glue))
+        answers = [r for r in self.records if r[0] == name and r[1] in (question.qtype, TYPE_CNAME)]
+        authority = []
+        if not answers:
+            if not any(r[0] == name for r in self.records):
+                header = request[:2] + b'\x84\x03'
+            authority = [(self.origin, TYPE_SOA, 60, ('ns.' + self.origin, 'admin.' + self.origin, 1, 3600, 600, 86400, 30))]
+        return (header + struct.pack('!4H', 1, len(answers), len(authority), 0) +
+                request[12:12 + len(encode_name(name)) + 4] +
+                b''.join(encode_record(*r) for r in answers + authority))
+
+
+@pytest.fixture(scope='module')
+def tree():
+    '''root -> edu -> luther.edu -> cs430.luther.edu, plus a glueless other.edu'''
+    servers = {
+        ROOT: LoopbackServer(ROOT, PORT, Zone('', [], {'edu': [('a.edu-servers.net', EDU)]})),
+        EDU: LoopbackServer(EDU, PORT, Zone('edu', [], {
+            'luther.edu': [('ns.luther.edu', LUTHER)],
+            'other.edu': [('ns.luther.edu', None)]
+        })),
+        LUTHER: LoopbackServer(LUTHER, PORT, Zone('luther.edu', [
+            ('luther.edu', TYPE_MX, 300, (10, 'mail.luther.edu')),
+            ('mail.luther.edu', TYPE_A, 300, '10.0.0.25'),
+            ('www.luther.edu', TYPE_CNAME, 300, 'ant.cs430.luther.edu'),
+            ('ns.luther.edu', TYPE_A, 300, OTHER)
+        ], {'cs430.luther.edu': [('ns.cs430.luther.edu', CS430)]})),
+        CS430: LoopbackServer(CS430, PORT, ZooZone()),
+        OTHER: LoopbackServer(OTHER, PORT, Zone('other.edu', [('www.other.edu', TYPE_A, 300, '10.0.0.80')]))
+    }
+    yield servers
+    for server in servers.values():
+        server.close()
+
+
+def make_resolver() -> IterativeResolver:
+    '''Resolver with a single local root and a fresh delegation cache'''
+    return IterativeResolver([('root.test', ROOT)], PORT, timeout=1.0)
+
+
+class TestIterative:
+    '''Testing iterative resolution'''
+
+    def test_is_subdomain(self):
+        '''Names lie below themselves, their parents and the root'''
+        assert is_subdomain('ant.cs430.luther.edu', 'luther.edu')
+        assert is_subdomain('luther.edu', 'luther.edu')
+        assert is_subdomain('luther.edu', '')
+        assert not is_subdomain('notluther.edu', 'luther.edu')
+
+    def test_delegation_cache_expiry(self):
+        '''Delegations expire on the NS TTL and fall back to the roots'''
+        now = [1000.0]
+        cache = DelegationCache([('root.test', ROOT)], clock=lambda: now[0])
+        ns = decode_message(b'\x00\x00\x80\x00\x00\x00\x00\x00\x00\x01\x00\x01' +
+                            encode_record('edu', TYPE_NS, 60, 'a.edu-servers.net') +
+                            encode_record('a.edu-servers.net', TYPE_A, 30, EDU))
+        cache.add_zone('edu', ns.authority, ns.additional)
+        assert cache.closest('www.luther.edu') == ('edu', ['a.edu-servers.net'])
+        assert cache.lookup_addresses('a.edu-servers.net') == [EDU]
+        now[0] += 45
+        assert cache.lookup_addresses('a.edu-servers.net') == []
+        now[0] += 30
+        assert cache.closest('www.luther.edu') == ('', ['root.test'])
+
+    def test_referrals(self, tree):
+        '''Follow root and TLD referrals down to the zone holding the name'''
+        reply = make_resolver().resolve('ant.cs430.luther.edu', TYPE_A)
+        assert sorted(r.rdata for r in reply.answers) == ['185.84.224.89', '199.83.67.158']
+
+    def test_delegation_cache(self, tree):
+        '''A second name under a cached zone skips the upper levels'''
+        resolver = make_resolver()
+        resolver.resolve('ant.cs430.luther.edu', TYPE_A)
+        root_queries = tree[ROOT].queries
+        queries = resolver.queries
+        reply = resolver.resolve('emu.cs430.luther.edu', TYPE_A)
+        assert '70.15.79.109' in [r.rdata for r in reply.answers]
+        assert tree[ROOT].queries == root_queries
+        assert resolver.queries == queries + 1
+
+    def test_cname(self, tree):
+        '''Chase a CNAME into another zone'''
+        reply = make_resolver().resolve('www.luther.edu', TYPE_A)
+        assert [r.rtype for r in reply.answers][0] == TYPE_CNAME
+        assert sorted(r.rdata for r in reply.answers if r.rtype == TYPE_A) == ['185.84.224.89', '199.83.67.158']
+
+    def test_mx(self, tree):
+        '''Any record type can be asked for'''
+        reply = make_resolver().resolve('luther.edu', TYPE_MX)
+        assert [r.rdata for r in reply.answers] == [(10, 'mail.luther.edu')]
+
+    def test_glueless_delegation(self, tree):
+        '''Resolve the address of a name server that came without glue'''
+        reply = make_resolver().resolve('www.other.edu', TYPE_A)
+        assert [r.rdata for r in reply.answers] == ['10.0.0.80']
+
+    def test_nxdomain(self, tree):
+        '''Return the negative answer with its SOA'''
+        reply = make_resolver().resolve('nope.luther.edu', TYPE_A)
+        assert reply.flags & 0xF == 3
+        assert reply.authority[0].rtype == TYPE_SOA
+
+
+if __name__ == '__main__':
+    pytest.main(['test_iterative.py'])
@@ -4,8 +4,11 @@ Testing the DNS resolver
 #!/usr/bin/python3
 
 
+import threading
 from random import seed
+from socket import socket, AF_INET, SOCK_DGRAM, SOCK_STREAM
 import pytest
+import resolver
 from resolver import val_to_2_bytes
 from resolver import val_to_n_bytes
 from resolver import bytes_to_val
@@ -18,10 +21,49 @@ from resolver import parse_answers
 from resolver import parse_address_a
 from resolver import parse_address_aaaa
 from resolver import PUBLIC_DNS_SERVER
+from resolver import decode_message
+from resolver import read_name
+from resolver import Record
+from resolver import send_request
+from resolver import TCPConnectionPool
+from resolver import EDNS_SIZE
 
 seed(430)
 
 
+class TruncatingServer:
+    '''Answers over UDP with the TC bit set and over TCP in full'''
+
+    def __init__(self):
+        self.udp = socket(AF_INET, SOCK_DGRAM)
+        self.udp.bind(('127.0.0.1', 0))
+        self.port = self.udp.getsockname()[1]
+        self.tcp = socket(AF_INET, SOCK_STREAM)
+        self.tcp.bind(('127.0.0.1', self.port))
+        self.tcp.listen(1)
+        threading.Thread(target=self.serve_udp, daemon=True).start()
+        threading.Thread(target=self.serve_tcp, daemon=True).start()
+
+    def serve_udp(self) -> None:
+        while True:
+            data, addr = self.udp.recvfrom(512)
+            self.udp.sendto(data[:2] + bytes([data[2] | 0x82]) + data[3:], addr)
+
+    def serve_tcp(self) -> None:
+        conn, _ = self.tcp.accept()
+        with conn:
+            while True:
+                length = conn.recv(2)
+                if not length:
+                    return
+                data = conn.recv(bytes_to_val(list(length)))
+                conn.sendall(length + data[:2] + bytes([data[2] | 0x80]) + data[3:])
+
+    def close(self) -> None:
+        self.udp.close()
+        self.tcp.close()
+
+
 class TestResolver:
     '''Testing DNS resolver'''
 
@@ -67,7 +109,12 @@ class TestResolver:
 
     def test_format_query(self):
         '''Format a query'''
-        assert format_query(1, ['luther', 'edu']) == b'OB\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x06luther\x03edu\x00\x00\x01\x00\x01'
+        assert format_query(1, ['luther', 'edu'], 0x4f42) == b'OB\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x06luther\x03edu\x00\x00\x01\x00\x01'
+
+    def test_format_query_random_id(self):
+        '''Transaction IDs are random unless given'''
+        ids = {bytes(format_query(1, ['luther', 'edu'])[:2]) for _ in range(20)}
+        assert len(ids) > 1
 
     def test_parse_response(self):
         '''Parse the response'''
@@ -159,6 +206,59 @@ class TestResolver:
         '''Parse IPv6 address'''
         assert parse_address_aaaa(16, b' \x01I\x98\x00\x0c\x10#\x00\x00\x00\x00\x00\x00\x00\x04\xc0') == '2001:4998:c:1023:0:0:0:4'
 
+    def test_read_name(self):
+        '''Read labels and compression pointers'''
+        msg = b'\x00' * 12 + b'\x06luther\x03edu\x00\x03www\xc0\x0c'
+        names = {}
+        assert read_name(memoryview(msg), 12, names) == ('luther.edu', 24)
+        assert read_name(memoryview(msg), 24, names) == ('www.luther.edu', 30)
+        with pytest.raises(ValueError):
+            read_name(memoryview(b'\xc0\x00'), 0, {})
+
+    def test_decode_message(self):
+        '''Decode every section of a response'''
+        message = decode_message(b'tH\x81\x80\x00\x01\x00\x01\x00\x03\x00\x01\x06luther\x03edu\x00\x00\x01\x00\x01' +
+                                 b'\xc0\x0c\x00\x01\x00\x01\x00\x00\x01,\x00\x04\xae\x81\x19\xaa\xc0\x0c\x00\x02\x00' +
+                                 b'\x01\x00\x01Q\x80\x00\x10\x05dns-2\x07iastate\xc0\x13\xc0\x0c\x00\x02\x00\x01\x00' +
+                                 b'\x01Q\x80\x00\n\x03dns\x03uni\xc0\x13\xc0\x0c\x00\x02\x00\x01\x00\x01Q\x80\x00\t' +
+                                 b'\x06martin\xc0\x0c\xc0j\x00\x01\x00\x01\x00\x01Q\x80\x00\x04\xc0\xcb\xc4\x14')
+        assert message.id == 29768
+        assert message.questions[0] == ('luther.edu', 1, 1)
+        assert message.answers == [Record('luther.edu', 1, 1, 300, '174.129.25.170')]
+        assert [r.rdata for r in message.authority] == ['dns-2.iastate.edu', 'dns.uni.edu', 'martin.luther.edu']
+        assert message.additional == [Record('martin.luther.edu', 1, 1, 86400, '192.203.196.20')]
+
+    def test_decode_message_matches_parse_response(self):
+        '''Decode uncompressed AAAA answers the way parse_response does'''
+        response = (b'k\xfb\x81\x80\x00\x01\x00\x02\x00\x00\x00\x00\x05yahoo\x03com\x00\x00\x1c\x00\x01' +
+                    b'\x05yahoo\x03com\x00\x00\x1c\x00\x01\x00\x00\x04T\x00\x10 \x01I\x98\x00X\x186' +
+                    b'\x00\x00\x00\x00\x00\x00\x00\x11\xc0\x0c\x00\x1c\x00\x01\x00\x00\x04T\x00\x10 ' +
+                    b'\x01I\x98\x00\x0c\x10#\x00\x00\x00\x00\x00\x00\x00\x04')
+        assert [(r.name, r.ttl, r.rdata) for r in decode_message(response).answers] == [
+            ('yahoo.com', 1108, '2001:4998:58:1836:0:0:0:11'),
+            ('yahoo.com', 1108, '2001:4998:c:1023:0:0:0:4')
+        ]
+
+    def test_format_query_edns(self):
+        '''Advertise a larger UDP payload in an OPT record'''
+        query = format_query(1, ['luther', 'edu'], 0x4f42, EDNS_SIZE)
+        assert query[10:12] == b'\x00\x01'
+        assert query[-11:] == b'\x00\x00\x29' + EDNS_SIZE.to_bytes(2, 'big') + bytes(6)
+
+    def test_send_request_tcp_fallback(self):
+        '''Retry over TCP when the UDP answer is truncated'''
+        server = TruncatingServer()
+        pool = TCPConnectionPool(1.0)
+        default_pool, resolver.TCP_POOL = resolver.TCP_POOL, pool
+        try:
+            response = send_request(format_query(1, ['luther', 'edu'], 0x4f42), '127.0.0.1', server.port)
+            assert response[:4] == b'\x4f\x42\x81\x00'
+            assert len(pool.idle[('127.0.0.1', server.port)]) == 1
+        finally:
+            resolver.TCP_POOL = default_pool
+            pool.close()
+            server.close()
+
 
 if __name__ == '__main__':
     pytest.main(['test_resolver.py'])
@@ -0,0 +1,118 @@
+'''
+Testing the shared resolver transport
+'''
+#!/usr/bin/python3
+
+
+import asyncio
+import pytest
+from transport import DNSTransport
+from transport import question_key
+
+
+class EchoServer(asyncio.DatagramProtocol):
+    '''Answers each query with the query itself, after optional decoys'''
+
+    def __init__(self, delay: float = 0, decoys: bool = False, truncate: bool = False):
+        self.delay = delay
+        self.decoys = decoys
+        self.truncate = truncate
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        asyncio.get_running_loop().call_later(self.delay, self.reply, data, addr)
+
+    def reply(self, data: bytes, addr: tuple) -> None:
+        if self.decoys:
+            wrong_id = bytes([data[0] ^ 0xFF]) + data[1:]
+            wrong_name = data[:13] + bytes([data[13] ^ 0x01]) + data[14:]
+            self.transport.sendto(wrong_id, addr)
+            self.transport.sendto(wrong_name, addr)
+        if self.truncate:
+            data = data[:2] + bytes([data[2] | 0x02]) + data[3:]
+        self.transport.sendto(data, addr)
+
+
+async def echo_tcp(reader, writer) -> None:
+    '''Answer length-prefixed queries with the query itself plus a marker byte'''
+    try:
+        while True:
+            length = await reader.readexactly(2)
+            data = await reader.readexactly(int.from_bytes(length, 'big')) + b'T'
+            writer.write(len(data).to_bytes(2, 'big') + data)
+    except asyncio.IncompleteReadError:
+        writer.close()
+
+
+def run(coro):
+    '''Run a coroutine with a fresh event loop'''
+    return asyncio.run(coro)
+
+
+async def with_server(test, **kwargs):
+    '''Run test(transport, port) against an echo server'''
+    loop = asyncio.get_running_loop()
+    server, _ = await loop.create_datagram_endpoint(lambda: EchoServer(**kwargs), local_addr=('127.0.0.1', 0))
+    port = server.get_extra_info('sockname')[1]
+    tcp_server = await asyncio.start_server(echo_tcp, '127.0.0.1', port)
+    transport = await DNSTransport.open()
+    try:
+        return await test(transport, port)
+    finally:
+        transport.close()
+        server.close()
+        tcp_server.close()
+
+
+class TestTransport:
+    '''Testing the shared transport'''
+
+    def test_question_key(self):
+        '''Match on ID, lowercase name and type'''
+        assert question_key(b'OB\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x06Luther\x03edu\x00\x00\x01\x00\x01') == \
+            (0x4f42, 'luther.edu', 1)
+
+    def test_concurrent_queries(self):
+        '''Many queries share one socket and each gets its own reply'''
+        async def test(transport, port):
+            names = [['host{}'.format(i), 'luther', 'edu'] for i in range(200)]
+            replies = await asyncio.gather(*(transport.query(1, n, '127.0.0.1', port) for n in names))
+            assert [question_key(r)[1] for r in replies] == ['.'.join(n) for n in names]
+            assert transport.sent == 200
+            assert transport.received == 200
+            assert transport.pending == {}
+        run(with_server(test))
+
+    def test_mismatched_replies(self):
+        '''Replies with the wrong ID or name are dropped'''
+        async def test(transport, port):
+            reply = await transport.query(28, ['luther', 'edu'], '127.0.0.1', port)
+            assert question_key(reply)[1:] == ('luther.edu', 28)
+            await asyncio.sleep(0.05)
+            assert transport.dropped == 2
+        run(with_server(test, decoys=True))
+
+    def test_truncated_reply(self):
+        '''A truncated answer is fetched again over one reused TCP connection'''
+        async def test(transport, port):
+            for name in (['luther', 'edu'], ['www', 'luther', 'edu']):
+                reply = await transport.query(1, name, '127.0.0.1', port)
+                assert reply.endswith(b'T')
+                assert question_key(reply)[1] == '.'.join(name)
+            assert len(transport.tcp.idle[('127.0.0.1', port)]) == 1
+        run(with_server(test, truncate=True))
+
+    def test_late_reply(self):
+        '''A reply arriving after the query gave up is dropped'''
+        async def test(transport, port):
+            with pytest.raises(asyncio.TimeoutError):
+                await transport.query(1, ['luther', 'edu'], '127.0.0.1', port, timeout=0.05, retries=0)
+            await asyncio.sleep(0.15)
+            assert transport.dropped == 1
+        run(with_server(test, delay=0.1))
+
+
+if __name__ == '__main__':
+    pytest.main(['test_transport.py'])
@@ -0,0 +1,110 @@
+'''
+Testing upstream selection against delayed local name servers
+'''
+#!/usr/bin/python3
+
+
+import time
+import pytest
+from resolver import decode_message
+from resolver import format_query
+from upstream import UpstreamSelector
+from upstream import query_hedged
+from conftest import Clock
+from conftest import LoopbackServer
+from conftest import ZooZone
+
+PORT = 43153
+
+
+@pytest.fixture
+def servers(request):
+    '''One delayed name server per loopback address'''
+    zone = ZooZone()
+    started = {'127.0.0.{}'.format(11 + i): LoopbackServer('127.0.0.{}'.format(11 + i), PORT, zone, delay)
+               for i, delay in enumerate(request.param)}
+    yield started
+    for server in started.values():
+        server.close()
+
+
+def ask(selector: UpstreamSelector, trans_id: int = 0x1234, timeout: float = 2.0) -> tuple:
+    '''Resolve ant.cs430.luther.edu through the selector'''
+    message = format_query(1, ['ant', 'cs430', 'luther', 'edu'], trans_id)
+    server, reply = query_hedged(selector, message, PORT, timeout)
+    return server, decode_message(reply)
+
+
+class TestUpstream:
+    '''Testing upstream selection'''
+
+    def test_scores(self):
+        '''Smoothed RTT ranks servers and failures are forgiven over time'''
+        clock = Clock()
+        selector = UpstreamSelector(['a', 'b'], clock)
+        for _ in range(20):
+            selector.record_success('a', 0.05)
+            selector.record_success('b', 0.01)
+        assert selector.ranked() == ['b', 'a']
+        selector.record_failure('b')
+        selector.record_failure('b')
+        selector.record_failure('b')
+        assert selector.best() == 'a'
+        clock.now += 100
+        assert selector.best() == 'b'
+
+    def test_ties_random(self):
+        '''Servers with equal scores, as all are at start, are picked at random'''
+        selector = UpstreamSelector(['a', 'b', 'c'], Clock())
+        assert {selector.best() for _ in range(200)} == {'a', 'b', 'c'}
+        assert {selector.ranked()[0] for _ in range(200)} == {'a', 'b', 'c'}
+
+    @pytest.mark.parametrize('servers', [(0.15, 0.01, 0.06)], indirect=True)
+    def test_prefers_fastest(self, servers):
+        '''Traffic settles on the fastest server'''
+        selector = UpstreamSelector(list(servers))
+        for i in range(10):
+            server, message = ask(selector, i)
+            assert sorted(a.rdata for a in message.answers) == ['185.84.224.89', '199.83.67.158']
+        assert selector.best() == '127.0.0.12'
+        assert server == '127.0.0.12'
+
+    @pytest.mark.parametrize('servers', [(None, 0.01)], indirect=True)
+    def test_hedges_past_dead_server(self, servers):
+        '''A silent server is tried once, and costs one hedge delay, not the whole timeout'''
+        selector = UpstreamSelector(list(servers))
+        for i in range(2):
+            start = time.monotonic()
+            server, message = ask(selector, i)
+            assert server == '127.0.0.12'
+            assert time.monotonic() - start < 1.0
+            assert len(message.answers) == 2
+        assert servers['127.0.0.11'].queries == 1
+        assert selector.best() == '127.0.0.12'
+
+    @pytest.mark.parametrize('servers', [(0.2, None)], indirect=True)
+    def test_hedge_loser_not_rewarded(self, servers):
+        '''Losing a hedge sooner than its smoothed RTT leaves a slow server's estimate alone'''
+        selector = UpstreamSelector(list(servers))
+        fast, slow = selector.servers['127.0.0.11'], selector.servers['127.0.0.12']
+        fast.srtt, fast.rttvar, fast.samples = 0.01, 0.001, 1
+        slow.srtt, slow.rttvar, slow.samples = 0.5, 0.05, 1
+        server, _ = ask(selector)
+        assert server == '127.0.0.11'
+        assert servers['127.0.0.12'].queries == 1
+        assert (slow.srtt, slow.rttvar) == (0.5, 0.05)
+        selector.record_unanswered('127.0.0.12', 0.9)
+        assert slow.srtt > 0.5
+
+    @pytest.mark.parametrize('servers', [(None, None)], indirect=True)
+    def test_timeout(self, servers):
+        '''Every server silent'''
+        selector = UpstreamSelector(list(servers))
+        with pytest.raises(TimeoutError):
+            ask(selector, timeout=0.6)
+        assert all(selector.failures(s) == 1 for s in servers)
+        assert all(s.queries == 1 for s in servers.values())
+
+
+if __name__ == '__main__':
+    pytest.main(['test_upstream.py'])
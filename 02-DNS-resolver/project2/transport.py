@@ -0,0 +1,141 @@
+'''
+Shared UDP transport demultiplexing replies by transaction ID
+'''
+#!/usr/bin/env python3
+
+import asyncio
+from secrets import randbelow
+from struct import error as struct_error
+
+from resolver import EDNS_SIZE, PORT, QUESTION, UINT16, format_query, is_truncated, read_name
+
+TIMEOUT = 2.0
+RETRIES = 2
+
+
+def question_key(data: bytes) -> tuple:
+    '''(id, lowercase name, type) of a message's first question'''
+    view = memoryview(data)
+    name, offset = read_name(view, 12, {})
+    return (UINT16.unpack_from(view, 0)[0], name.lower(), QUESTION.unpack_from(view, offset)[0])
+
+
+class TCPPool:
+    '''asyncio DNS-over-TCP connections kept open per server for reuse'''
+
+    def __init__(self):
+        self.idle = {}
+
+    async def exchange(self, conn: tuple, message: bytes, timeout: float) -> bytes:
+        '''Send a length-prefixed query and read the length-prefixed answer'''
+        reader, writer = conn
+        writer.write(UINT16.pack(len(message)) + bytes(message))
+        length = await asyncio.wait_for(reader.readexactly(2), timeout)
+        return await asyncio.wait_for(reader.readexactly(UINT16.unpack(length)[0]), timeout)
+
+    async def request(self, message: bytes, server: str, port: int = PORT, timeout: float = TIMEOUT) -> bytes:
+        '''Ask over a pooled connection, opening a new one if needed'''
+        idle = self.idle.setdefault((server, port), [])
+        while True:
+            reused = bool(idle)
+            if reused:
+                conn = idle.pop()
+            else:
+                conn = await asyncio.wait_for(asyncio.open_connection(server, port), timeout)
+            try:
+                reply = await self.exchange(conn, message, timeout)
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                conn[1].close()
+                # The server may have closed an idle connection: retry on a fresh one.
+                if reused:
+                    continue
+                raise
+            idle.append(conn)
+            return reply
+
+    def close(self) -> None:
+        '''Close every idle connection'''
+        for idle in self.idle.values():
+            while idle:
+                idle.pop()[1].close()
+
+
+class DNSTransport(asyncio.DatagramProtocol):
+    '''One long-lived UDP socket carrying every outstanding query
+
+    Each query gets a random transaction ID; replies are matched on
+    (id, name, type) and on the address the query was sent to, and
+    anything that matches no pending query is dropped. Truncated
+    answers are fetched again over a pooled TCP connection.
+    '''
+
+    def __init__(self):
+        self.transport = None
+        self.tcp = TCPPool()
+        self.pending = {}
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+
+    @classmethod
+    async def open(cls, local_addr: tuple = ('0.0.0.0', 0)):
+        '''Bind the shared socket'''
+        loop = asyncio.get_running_loop()
+        _, protocol = await loop.create_datagram_endpoint(cls, local_addr=local_addr)
+        return protocol
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        try:
+            key = question_key(data)
+        except (ValueError, IndexError, struct_error):
+            self.dropped += 1
+            return
+        waiting = self.pending.get(key)
+        if waiting is None or waiting[1] != addr[:2] or waiting[0].done():
+            # Late, spoofed or unrelated reply.
+            self.dropped += 1
+            return
+        self.received += 1
+        waiting[0].set_result(data)
+
+    def error_received(self, exc: Exception) -> None:
+        # ICMP errors are not tied to a query; the affected ones time out.
+        pass
+
+    def new_key(self, name: str, q_type: int) -> tuple:
+        '''Key with an unpredictable transaction ID not already in use for this question'''
+        while True:
+            key = (randbelow(65536), name.lower(), q_type)
+            if key not in self.pending:
+                return key
+
+    async def query(self, q_type: int, q_domain: list, server: str, port: int = PORT,
+                    timeout: float = TIMEOUT, retries: int = RETRIES) -> bytes:
+        '''Send one query, resending it after each timeout, and return the raw reply'''
+        key = self.new_key('.'.join(q_domain), q_type)
+        message = format_query(q_type, q_domain, key[0], EDNS_SIZE)
+        reply = asyncio.get_running_loop().create_future()
+        self.pending[key] = (reply, (server, port))
+        try:
+            for attempt in range(retries + 1):
+                self.transport.sendto(message, (server, port))
+                self.sent += 1
+                try:
+                    await asyncio.wait_for(asyncio.shield(reply), timeout)
+                    break
+                except asyncio.TimeoutError:
+                    if attempt == retries:
+                        raise
+        finally:
+            del self.pending[key]
+        if is_truncated(reply.result()):
+            return await self.tcp.request(message, server, port, timeout)
+        return reply.result()
+
+    def close(self) -> None:
+        '''Close the socket and the pooled TCP connections'''
+        self.transport.close()
+        self.tcp.close()
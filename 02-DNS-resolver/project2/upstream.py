@@ -0,0 +1,168 @@
+'''
+Latency-based upstream selection with hedged queries
+'''
+#!/usr/bin/env python3
+
+import select
+import time
+from random import random
+from socket import socket, SOCK_DGRAM, AF_INET
+
+# Weights of a new sample in the smoothed RTT and its deviation (RFC 6298).
+SMOOTHING = 0.125
+DEVIATION_SMOOTHING = 0.25
+INITIAL_RTT = 0.1
+MIN_HEDGE = 0.005
+MAX_HEDGE = 1.0
+# Each recorded failure doubles a server's score; one is forgiven per FAILURE_DECAY seconds.
+FAILURE_DECAY = 30.0
+MAX_FAILURES = 8
+TIMEOUT = 2.0
+RECV_SIZE = 65535
+RCODE_SERVFAIL = 2
+RCODE_REFUSED = 5
+
+
+class Upstream:
+    '''Latency and failure history of one server'''
+    __slots__ = ('srtt', 'rttvar', 'samples', 'failures', 'last_failure')
+
+    def __init__(self):
+        self.srtt = INITIAL_RTT
+        self.rttvar = INITIAL_RTT / 2
+        self.samples = 0
+        self.failures = 0
+        self.last_failure = 0.0
+
+
+class UpstreamSelector:
+    '''Rank servers by smoothed RTT, penalizing recent failures'''
+
+    def __init__(self, servers: list, clock=time.monotonic):
+        self.clock = clock
+        self.servers = {server: Upstream() for server in servers}
+
+    def failures(self, server: str) -> int:
+        '''Failures not yet forgiven'''
+        state = self.servers[server]
+        if not state.failures:
+            return 0
+        forgiven = int((self.clock() - state.last_failure) / FAILURE_DECAY)
+        return max(state.failures - forgiven, 0)
+
+    def score(self, server: str) -> float:
+        '''Expected cost of asking a server; lower is better'''
+        return self.servers[server].srtt * 2 ** self.failures(server)
+
+    def tiebreak(self, server: str) -> tuple:
+        '''Sort key: servers never measured first, then the score, then a random draw
+
+        Every server is tried once before the ranking settles, and equal
+        servers (all of them at start) share the load.
+        '''
+        state = self.servers[server]
+        return (bool(state.samples or state.failures), self.score(server), random())
+
+    def ranked(self) -> list:
+        '''Servers from best to worst'''
+        return sorted(self.servers, key=self.tiebreak)
+
+    def best(self) -> str:
+        '''Server to ask first'''
+        return min(self.servers, key=self.tiebreak)
+
+    def hedge_delay(self, server: str) -> float:
+        '''How long to wait for a server before asking another one too'''
+        state = self.servers[server]
+        return min(max(state.srtt + 4 * state.rttvar, MIN_HEDGE), MAX_HEDGE)
+
+    def record_rtt(self, server: str, rtt: float) -> None:
+        '''Fold a round-trip time sample into the smoothed estimate'''
+        state = self.servers[server]
+        state.rttvar += DEVIATION_SMOOTHING * (abs(state.srtt - rtt) - state.rttvar)
+        state.srtt += SMOOTHING * (rtt - state.srtt)
+        state.samples += 1
+
+    def record_unanswered(self, server: str, elapsed: float) -> None:
+        '''No answer after elapsed seconds: a lower bound, which only ever raises the estimate'''
+        if elapsed > self.servers[server].srtt:
+            self.record_rtt(server, elapsed)
+
+    def record_success(self, server: str, rtt: float) -> None:
+        '''A valid answer arrived after rtt seconds'''
+        self.record_rtt(server, rtt)
+        self.servers[server].failures = 0
+
+    def record_failure(self, server: str) -> None:
+        '''A server timed out, was unreachable or answered SERVFAIL/REFUSED'''
+        state = self.servers[server]
+        state.failures = min(self.failures(server) + 1, MAX_FAILURES)
+        state.last_failure = self.clock()
+
+
+def usable(reply: bytes, trans_id: bytes) -> bool:
+    '''Reply matches the query and is not a server-side failure'''
+    return len(reply) >= 12 and reply[:2] == trans_id and reply[3] & 0xF not in (RCODE_SERVFAIL, RCODE_REFUSED)
+
+
+def query_hedged(selector: UpstreamSelector, message: bytes, port: int, timeout: float = TIMEOUT) -> tuple:
+    '''Ask the best server, hedge to the next one after an adaptive delay
+
+    Returns (server, reply) for the first valid answer. At most two servers are
+    asked at once; a server that fails outright is replaced by the next one.
+    '''
+    ranked = selector.ranked()
+    start = time.monotonic()
+    deadline = start + timeout
+    hedge_at = start + selector.hedge_delay(ranked[0])
+    in_flight = {}
+
+    def launch():
+        server = ranked.pop(0)
+        sckt = socket(AF_INET, SOCK_DGRAM)
+        sckt.setblocking(False)
+        in_flight[sckt] = (server, time.monotonic())
+        try:
+            sckt.sendto(message, (server, port))
+        except OSError:
+            drop(sckt)
+
+    def drop(sckt):
+        server, _ = in_flight.pop(sckt)
+        selector.record_failure(server)
+        sckt.close()
+
+    try:
+        while True:
+            now = time.monotonic()
+            if now < deadline and ranked and (not in_flight or (len(in_flight) < 2 and now >= hedge_at)):
+                launch()
+                continue
+            if now >= deadline or not in_flight:
+                for sckt in list(in_flight):
+                    drop(sckt)
+                raise TimeoutError("No upstream answered in {:.1f}s".format(timeout))
+            wait = min(hedge_at, deadline) if ranked and len(in_flight) < 2 else deadline
+            ready, _, _ = select.select(list(in_flight), [], [], max(wait - now, 0))
+            for sckt in ready:
+                server, sent = in_flight[sckt]
+                try:
+                    reply = sckt.recv(RECV_SIZE)
+                except OSError:
+                    drop(sckt)
+                    continue
+                if reply[:2] != message[:2]:
+                    continue
+                if not usable(reply, message[:2]):
+                    drop(sckt)
+                    continue
+                answered = time.monotonic()
+                selector.record_success(server, answered - sent)
+                for other, (slower, other_sent) in in_flight.items():
+                    if other is not sckt:
+                        # Still waiting, so it is at least this slow.
+                        selector.record_unanswered(slower, answered - other_sent)
+                return server, reply
+    finally:
+        for sckt in in_flight:
+            sckt.close()
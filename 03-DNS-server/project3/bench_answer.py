@@ -0,0 +1,44 @@
+'''
+CPU time per query of format_response against ZoneStore.answer on compiled zones
+'''
+#!/usr/bin/env python3
+
+import sys
+import timeit
+
+from nameserver import read_zone_file, load_zones, parse_request, format_response
+
+ORIGIN = 'cs430.luther.edu'
+QUERIES = {
+    'A ant (2 records)': b'6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01',
+    'AAAA ant (1 record)': b'i\xce\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x1c\x00\x01',
+    'A emu (2 records)': b'\x12\xaf\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03emu\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01',
+}
+
+
+def per_query(func, number: int) -> float:
+    '''Microseconds per call, best of three runs'''
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+
+
+def main(*argv):
+    '''Main function'''
+    number = int(argv[0][1]) if len(argv[0]) > 1 else 20000
+    zone = read_zone_file('zoo.zone')[1]
+    store = load_zones(['zoo.zone'])
+    print('{:<22} {:>15} {:>14} {:>8}'.format('query', 'format_response', 'answer', 'speedup'))
+    for label, request in QUERIES.items():
+        # Both paths start from the raw request, as the server loop does.
+        def old():
+            trans_id, name, qry_type, qry = parse_request(ORIGIN, request)
+            return format_response(zone, trans_id, name, qry_type, qry)
+        expected = old()
+        # Only the flags differ: answer sets AA.
+        assert store.answer(request) == expected[:2] + b'\x85\x00' + expected[4:]
+        old_us = per_query(old, number)
+        new_us = per_query(lambda: store.answer(request), number)
+        print('{:<22} {:>13.2f}us {:>12.2f}us {:>7.1f}x'.format(label, old_us, new_us, old_us / new_us))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,91 @@
+'''
+CPU time per query of the UDP receive path: recvfrom and bytes against
+recvfrom_into a pooled buffer
+'''
+#!/usr/bin/env python3
+
+import sys
+import time
+from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_RCVBUF
+
+from nameserver import BufferPool, RECV_SIZE, load_zones, parse_request, format_response, read_zone_file
+
+QUERY = b'6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01'
+# Datagrams queued before each timed drain; they must fit the receive buffer.
+BATCH = 2000
+
+
+def fill(server: socket, client: socket) -> None:
+    '''Queue BATCH queries on the server socket'''
+    for _ in range(BATCH):
+        client.sendto(QUERY, server.getsockname())
+
+
+def drain_parse_request(server: socket, sink: socket, origin: str, zone: dict) -> None:
+    '''The original loop: a new bytes per datagram, names rebuilt a character at a time'''
+    for _ in range(BATCH):
+        request_msg, client_addr = server.recvfrom(512)
+        trans_id, domain, qry_type, qry = parse_request(origin, request_msg)
+        sink.sendto(format_response(zone, trans_id, domain, qry_type, qry), client_addr)
+
+
+def drain_bytes(server: socket, sink: socket, store) -> None:
+    '''recvfrom into a new bytes per datagram, answered from the zone store'''
+    for _ in range(BATCH):
+        request_msg, client_addr = server.recvfrom(RECV_SIZE)
+        sink.sendto(store.answer(request_msg), client_addr)
+
+
+def drain_pooled(server: socket, sink: socket, store) -> None:
+    '''recvfrom_into one pooled buffer, parsed in place'''
+    pool = BufferPool(count=1)
+    buffer = pool.get()
+    for _ in range(BATCH):
+        size, client_addr = server.recvfrom_into(buffer)
+        sink.sendto(store.answer(buffer[:size]), client_addr)
+    pool.put(buffer)
+
+
+def per_query(drain, server: socket, client: socket, rounds: int) -> float:
+    '''Microseconds per query to drain a full batch, best of rounds'''
+    best = float('inf')
+    for _ in range(rounds):
+        fill(server, client)
+        start = time.perf_counter()
+        drain()
+        best = min(best, time.perf_counter() - start)
+        # Drop the replies so the client socket does not fill up.
+        client.setblocking(False)
+        try:
+            while True:
+                client.recv(512)
+        except BlockingIOError:
+            client.setblocking(True)
+    return best / BATCH * 1e6
+
+
+def main(*argv):
+    '''Main function'''
+    rounds = int(argv[0][1]) if len(argv[0]) > 1 else 5
+    origin, zone = read_zone_file('zoo.zone')
+    store = load_zones(['zoo.zone'])
+    with socket(AF_INET, SOCK_DGRAM) as server, socket(AF_INET, SOCK_DGRAM) as client, \
+            socket(AF_INET, SOCK_DGRAM) as sink:
+        server.setsockopt(SOL_SOCKET, SO_RCVBUF, 1 << 22)
+        client.setsockopt(SOL_SOCKET, SO_RCVBUF, 1 << 22)
+        server.bind(('127.0.0.1', 0))
+        client.bind(('127.0.0.1', 0))
+        results = [
+            ('recvfrom + parse_request', per_query(lambda: drain_parse_request(server, sink, origin, zone),
+                                                   server, client, rounds)),
+            ('recvfrom + ZoneStore', per_query(lambda: drain_bytes(server, sink, store), server, client, rounds)),
+            ('recvfrom_into + ZoneStore', per_query(lambda: drain_pooled(server, sink, store), server, client, rounds)),
+        ]
+    base = results[0][1]
+    print('{:<28} {:>10} {:>8}'.format('receive path', 'per query', 'speedup'))
+    for label, micros in results:
+        print('{:<28} {:>8.2f}us {:>7.2f}x'.format(label, micros, base / micros))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,92 @@
+'''
+Queries per second of nameserver.py as the number of workers grows
+'''
+#!/usr/bin/env python3
+
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from socket import socket, timeout, AF_INET, SOCK_DGRAM
+
+from nameserver import PORT
+
+SERVER = ('127.0.0.1', PORT)
+QUERY = b'\x00\x00\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01'
+DURATION = 3.0
+# Queries each load process keeps outstanding.
+WINDOW = 16
+
+
+def load(duration: float, answered) -> None:
+    '''Keep WINDOW queries in flight for duration seconds, counting the answers'''
+    count = 0
+    with socket(AF_INET, SOCK_DGRAM) as sckt:
+        sckt.connect(SERVER)
+        sckt.settimeout(0.2)
+        for _ in range(WINDOW):
+            sckt.send(QUERY)
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            try:
+                sckt.recv(512)
+                count += 1
+            except timeout:
+                # Lost datagrams would shrink the window: top it up.
+                for _ in range(WINDOW):
+                    sckt.send(QUERY)
+                continue
+            sckt.send(QUERY)
+    with answered.get_lock():
+        answered.value += count
+
+
+def wait_ready() -> None:
+    '''Block until the server answers'''
+    with socket(AF_INET, SOCK_DGRAM) as sckt:
+        sckt.settimeout(0.1)
+        for _ in range(50):
+            sckt.sendto(QUERY, SERVER)
+            try:
+                sckt.recv(512)
+                return
+            except (timeout, ConnectionRefusedError):
+                continue
+    raise TimeoutError("nameserver did not start")
+
+
+def measure(workers: int, clients: int, duration: float) -> float:
+    '''QPS served by nameserver.py with the given number of workers'''
+    server = subprocess.Popen([sys.executable, 'nameserver.py', '--workers', str(workers), 'zoo.zone'],
+                              stdout=subprocess.DEVNULL)
+    try:
+        wait_ready()
+        answered = multiprocessing.Value('l', 0)
+        loaders = [multiprocessing.Process(target=load, args=(duration, answered)) for _ in range(clients)]
+        for loader in loaders:
+            loader.start()
+        for loader in loaders:
+            loader.join()
+        return answered.value / duration
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(*argv):
+    '''Main function'''
+    cores = os.cpu_count() or 1
+    counts = [int(n) for n in argv[0][1:]] or sorted({1, 2, max(cores // 2, 1), cores})
+    clients = max(cores, 2)
+    print('{} cores, {} load processes, {:.0f}s per run'.format(cores, clients, DURATION))
+    print('{:>8} {:>10} {:>8}'.format('workers', 'qps', 'speedup'))
+    base = None
+    for workers in counts:
+        qps = measure(workers, clients, DURATION)
+        base = base or qps
+        print('{:>8} {:>10.0f} {:>7.2f}x'.format(workers, qps, qps / base))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
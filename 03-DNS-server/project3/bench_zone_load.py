@@ -0,0 +1,57 @@
+'''
+Load time of a large zone: text parsing against a mapped binary image
+'''
+#!/usr/bin/env python3
+
+import os
+import sys
+import tempfile
+import time
+
+from nameserver import encode_name, load_zones
+
+ORIGIN = 'bench.example'
+
+
+def write_zone(filename: str, records: int) -> None:
+    '''A zone with one A record per host, hosts spread over sub-domains'''
+    with open(filename, 'w') as zone_file:
+        zone_file.write('$ORIGIN {}.\n$TTL 1h\n'.format(ORIGIN))
+        for i in range(records):
+            zone_file.write('host{}.d{}\t30m\tIN\tA\t10.{}.{}.{}\n'.format(
+                i, i % 100, i >> 16 & 255, i >> 8 & 255, i & 255))
+
+
+def timed(func):
+    '''(result, seconds) of one call'''
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def main(*argv):
+    '''Main function'''
+    records = int(argv[0][1]) if len(argv[0]) > 1 else 1000000
+    with tempfile.TemporaryDirectory() as folder:
+        text = os.path.join(folder, 'bench.zone')
+        image = os.path.join(folder, 'bench.zimg')
+        write_zone(text, records)
+        store, text_time = timed(lambda: load_zones([text]))
+        _, write_time = timed(lambda: store.write_image(image))
+        mapped, map_time = timed(lambda: load_zones([image]))
+        names = [encode_name('host{}.d{}.{}'.format(i, i % 100, ORIGIN)) for i in range(0, records, max(records // 1000, 1))]
+        zone = mapped.find(names[0])[1]
+        _, cold_time = timed(lambda: [zone.get(name) for name in names])
+        _, lookup_time = timed(lambda: [zone.get(name) for name in names])
+        assert all(zone.get(name) == store.find(name)[1].get(name) for name in names)
+        print('{} records, text {:.1f} MB, image {:.1f} MB'.format(
+            records, os.path.getsize(text) / 1e6, os.path.getsize(image) / 1e6))
+        print('parse and compile text: {:8.3f}s'.format(text_time))
+        print('write image:            {:8.3f}s'.format(write_time))
+        print('map image:              {:8.3f}s'.format(map_time))
+        print('first lookups (faults): {:8.2f}us'.format(cold_time / len(names) * 1e6))
+        print('lookup from image:      {:8.2f}us'.format(lookup_time / len(names) * 1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -3,14 +3,62 @@ DNS Name Server
 '''
 #!/usr/bin/env python3
 
+import functools
+import mmap
+import os
 import re
+import shlex
+import signal
+import struct
 import sys
+import threading
+import time
+import traceback
+import zlib
+from collections import namedtuple
 from random import randint, choice
-from socket import socket, SOCK_DGRAM, AF_INET
+from socket import socket, timeout, inet_pton, SOCK_DGRAM, SOCK_STREAM, AF_INET, AF_INET6, SOL_SOCKET, SO_REUSEADDR, SO_REUSEPORT
 
 
 HOST = "localhost"
 PORT = 43053
+# Plain DNS answers over UDP are limited to 512 bytes; EDNS0 clients may
+# advertise more, and we send at most MAX_UDP_SIZE.
+DEFAULT_UDP_SIZE = 512
+MAX_UDP_SIZE = 4096
+RECV_SIZE = 4096
+TYPE_OPT = 41
+TYPE_SOA = 6
+TYPE_CNAME = 5
+TYPE_IXFR = 251
+TYPE_AXFR = 252
+RCODE_FORMERR = 1
+RCODE_NXDOMAIN = 3
+RCODE_NOTIMP = 4
+RCODE_REFUSED = 5
+# Opcode bits of the third header byte; only standard queries (0) are answered.
+OPCODE_MASK = 0x78
+WILDCARD = b'\x01*'
+# Zone transfers are sent as a stream of messages of at most this size.
+AXFR_MESSAGE_SIZE = 16384
+FLAG_TC = 0x02
+TCP_IDLE_TIMEOUT = 10
+# A worker that dies sooner than this after starting is restarted only after this delay.
+RESTART_DELAY = 1.0
+SUPERVISOR_SIGNALS = {signal.SIGTERM, signal.SIGHUP}
+RELOAD_INTERVAL = 2.0
+# Receive buffers kept ready for the UDP loop and TCP connections.
+POOL_SIZE = 64
+# Response rate limiting (--rate-limit): UDP responses per second to one
+# client prefix and for one (name, type); every RRL_SLIP-th dropped response
+# is sent truncated instead, so real clients can retry over TCP.
+RRL_PREFIX_FACTOR = 4
+RRL_SLIP = 2
+RRL_TABLE_SIZE = 65536
+RRL_REPORT_INTERVAL = 60.0
+# Unreadable requests are counted, and reported at most once per interval.
+DROP_REPORT_INTERVAL = 10.0
+ANSWER, DROP, SLIP = range(3)
 
 DNS_TYPES = {
     1: 'A',
@@ -19,7 +67,8 @@ DNS_TYPES = {
     12: 'PTR',
     15: 'MX',
     16: 'TXT',
-    28: 'AAAA'
+    28: 'AAAA',
+    6: 'SOA'
 }
 
 TTL_SEC = {
@@ -31,6 +80,35 @@ TTL_SEC = {
     '1y': 60*60*24*365
     }
 
+HEADER = struct.Struct('!6H')
+# Type, class, TTL and data length of a record whose name points back to the question.
+ANSWER_FIXED = struct.Struct('!HHHIH')
+QUESTION = struct.Struct('!2H')
+# Root name, type and UDP payload size opening an OPT record.
+OPT_FIXED = struct.Struct('!BHH')
+QUESTION_POINTER = 0xC00C
+ADDRESS_FAMILIES = {'A': AF_INET, 'AAAA': AF_INET6}
+# Types whose data is a single domain name
+NAME_TYPES = {'NS': 2, 'CNAME': TYPE_CNAME, 'PTR': 12}
+ZoneSource = namedtuple('ZoneSource', 'stamp origin serial zone')
+
+TTL_UNITS = {'s': 1, 'm': 60, 'h': 60*60, 'd': 60*60*24, 'w': 60*60*24*7, 'y': 60*60*24*365}
+TTL_PATTERN = re.compile(r'(?:\d+[smhdwy])+', re.IGNORECASE)
+TTL_PART = re.compile(r'(\d+)([smhdwy])', re.IGNORECASE)
+CLASSES = ('IN', 'CH', 'HS', 'CS')
+# Master file tokens: a quoted string kept whole, a bare word, a parenthesis,
+# or a lone quote that was never closed.
+ZONE_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[^\s"()]+|[()"]')
+
+# Binary zone image: header, one directory entry per zone, then per zone its
+# origin, its record blocks and an open-addressing table of block offsets.
+IMAGE_MAGIC = b'DNSZIMG1'
+IMAGE_HEADER = struct.Struct('!8sI')
+IMAGE_ZONE = struct.Struct('!IIII')
+IMAGE_RRSET = struct.Struct('!HHI')
+UINT16 = struct.Struct('!H')
+UINT32 = struct.Struct('!I')
+
 
 def val_to_bytes(value: int, n_bytes: int) -> list:
     '''Split a value into n bytes'''
@@ -103,6 +181,95 @@ def read_zone_file(filename: str) -> tuple:
 
     return (origin, zone)
 
+@functools.lru_cache(maxsize=1024)
+def parse_ttl(text: str) -> int:
+    '''Seconds in a TTL written as "3600", "30m", "1h30m" or "1W" '''
+    if text.isdigit():
+        return int(text)
+    if not TTL_PATTERN.fullmatch(text):
+        raise ValueError("Bad TTL: {}".format(text))
+    return sum(int(value) * TTL_UNITS[unit.lower()] for value, unit in TTL_PART.findall(text))
+
+
+def strip_comment(line: str) -> str:
+    '''Drop a ";" comment, leaving semicolons inside quotes alone'''
+    if ';' not in line:
+        return line
+    if '"' not in line:
+        return line[:line.index(';')]
+    quoted = False
+    for i, char in enumerate(line):
+        if char == '"':
+            quoted = not quoted
+        elif char == ';' and not quoted:
+            return line[:i]
+    return line
+
+
+def parse_zone(text: str, origin: str = None) -> tuple:
+    '''Parse a master file in free whitespace layout into (origin, zone)
+
+    The zone maps owner names, as written, to (ttl seconds, class, type, data)
+    tuples. Owners may be omitted to repeat the previous one, TTL and class may
+    come in either order or be left out, and parentheses continue a record
+    over several lines.
+    '''
+    zone = {}
+    default_ttl = last_ttl = None
+    owner = None
+    pending = ''
+    for number, line in enumerate(text.splitlines(), 1):
+        line = strip_comment(line)
+        if pending or '(' in line:
+            pending += ' ' + line if pending else line
+            tokens = ZONE_TOKEN.findall(pending)
+            if tokens.count('(') > tokens.count(')'):
+                continue
+            line, pending = pending, ''
+        # Quoted strings are single fields, with their spacing kept as written.
+        fields = [token for token in ZONE_TOKEN.findall(line) if token not in ('(', ')')]
+        if '"' in fields:
+            raise ValueError("line {}: unterminated string".format(number))
+        if not fields:
+            continue
+        keyword = fields[0].upper()
+        if keyword == '$ORIGIN':
+            origin = fields[1].rstrip('.')
+            continue
+        if keyword == '$TTL':
+            default_ttl = parse_ttl(fields[1])
+            continue
+        if keyword.startswith('$'):
+            raise ValueError("line {}: unsupported directive {}".format(number, fields[0]))
+        if not line[0].isspace():
+            owner = fields.pop(0)
+        elif owner is None:
+            raise ValueError("line {}: record without an owner".format(number))
+        ttl, class_ = None, 'IN'
+        while fields and (fields[0][0].isdigit() or fields[0].upper() in CLASSES):
+            if fields[0][0].isdigit():
+                ttl = parse_ttl(fields.pop(0))
+            else:
+                class_ = fields.pop(0).upper()
+        if not fields:
+            raise ValueError("line {}: record without a type".format(number))
+        if ttl is None:
+            ttl = default_ttl if default_ttl is not None else last_ttl
+            if ttl is None:
+                raise ValueError("line {}: record without a TTL".format(number))
+        last_ttl = ttl
+        zone.setdefault(owner, []).append((ttl, class_, fields[0].upper(), ' '.join(fields[1:])))
+    if origin is None:
+        raise ValueError("No $ORIGIN")
+    return (origin, zone)
+
+
+def read_zone(filename: str) -> tuple:
+    '''Read a zone file in any whitespace layout'''
+    with open(filename) as zone_file:
+        return parse_zone(zone_file.read())
+
+
 def parse_request(origin: str, msg_req: bytes) -> tuple:
     '''Parse the request'''
     trans_id = bytes_to_val([msg_req[0], msg_req[1]])
@@ -124,7 +291,8 @@ def parse_request(origin: str, msg_req: bytes) -> tuple:
 
     qry_type = bytes_to_val([msg_req[i+1], msg_req[i+2]])
     class_  = bytes_to_val([msg_req[i+3], msg_req[i+4]])
-    query = msg_req[12:]
+    # Only the question: an EDNS0 OPT record may follow in the additional section.
+    query = msg_req[12:i+5]
 
     
     if qry_type not in DNS_TYPES:
@@ -216,30 +384,944 @@ def format_response(zone: dict, trans_id: int, qry_name: str, qry_type: int, qry
     return response
 
 
-def run(filename: str) -> None:
-    '''Main server loop'''
-    server_sckt = socket(AF_INET, SOCK_DGRAM)
-    server_sckt.bind((HOST, PORT))
-    origin, zone = read_zone_file(filename)
-    print("Listening on %s:%d" % (HOST, PORT))
+def encode_soa(rdata: str, origin: str) -> bytes:
+    '''Uncompressed SOA record data: primary server, mailbox and five numbers'''
+    fields = rdata.split()
+    return (encode_name(owner_name(fields[0], origin)) + encode_name(owner_name(fields[1], origin)) +
+            struct.pack('!5I', int(fields[2]), *(parse_ttl(field) for field in fields[3:7])))
 
-    while True:
-        (request_msg, client_addr) = server_sckt.recvfrom(512)
+
+def encode_txt(rdata: str) -> bytes:
+    '''TXT record data: each quoted or bare string prefixed with its length'''
+    strings = [text.encode() for text in shlex.split(rdata)]
+    if any(len(text) > 255 for text in strings):
+        raise ValueError("TXT string longer than 255 bytes")
+    return b''.join([bytes((len(text),)) + text for text in strings])
+
+
+def encode_rdata(req_type: str, rdata: str, origin: str) -> tuple:
+    '''(type, uncompressed record data) of a zone file record'''
+    if req_type == 'SOA':
+        return (TYPE_SOA, encode_soa(rdata, origin))
+    if req_type in ADDRESS_FAMILIES:
+        return (1 if req_type == 'A' else 28, inet_pton(ADDRESS_FAMILIES[req_type], rdata))
+    if req_type in NAME_TYPES:
+        return (NAME_TYPES[req_type], encode_name(owner_name(rdata, origin)))
+    if req_type == 'MX':
+        preference, exchange = rdata.split()
+        return (15, UINT16.pack(int(preference)) + encode_name(owner_name(exchange, origin)))
+    if req_type == 'TXT':
+        return (16, encode_txt(rdata))
+    raise ValueError("Unsupported record type {}".format(req_type))
+
+
+def compile_zone(zone: dict, origin: str = '') -> dict:
+    '''Encode every RRset once: {name: {type: (record count, answer section bytes)}}
+
+    Each record's name is a pointer to the question, so the bytes are valid
+    in any response whose question starts right after the header. A record
+    of a type that cannot be encoded fails the whole zone.
+    '''
+    answers = {}
+    for name, records in zone.items():
+        rrsets = answers.setdefault(name, {})
+        for ttl, _, req_type, address in records:
+            rtype, rdata = encode_rdata(req_type, address, origin)
+            count, encoded = rrsets.get(rtype, (0, b''))
+            ttl = ttl if isinstance(ttl, int) else parse_ttl(ttl)
+            rrsets[rtype] = (count + 1, encoded + ANSWER_FIXED.pack(QUESTION_POINTER, rtype, 1, ttl, len(rdata)) + rdata)
+    return answers
+
+
+def origin_offset(name: bytes, origin: bytes) -> int:
+    '''Offset of origin within a wire-format name, or None if the name lies outside it'''
+    i = 0
+    while name[i:] != origin:
+        if not name[i]:
+            return None
+        i += name[i] + 1
+    return i
+
+
+def add_empty_non_terminals(compiled: dict, origin: bytes, owners) -> None:
+    '''Add every name between owners and the origin as a node without records
+
+    Such names exist (RFC 4592): they answer with no data instead of
+    NXDOMAIN, and they stop a wildcard higher up from covering names below.
+    '''
+    for owner in owners:
+        i = origin_offset(owner, origin)
+        if i is None:
+            continue
+        at = 0
+        while at < i:
+            at += owner[at] + 1
+            compiled.setdefault(owner[at:], {})
+
+
+def owner_records(owner: bytes, origin: bytes, records: bytes):
+    '''Split pre-encoded records, naming each after owner instead of the question
+
+    The owner lies inside origin, so its name ends with a pointer to the
+    question, which in a zone transfer is the origin itself.
+    '''
+    name = owner[:origin_offset(owner, origin)] + b'\xc0\x0c'
+    at = 0
+    while at < len(records):
+        end = at + ANSWER_FIXED.size + ANSWER_FIXED.unpack_from(records, at)[4]
+        yield name + bytes(records[at + 2:end])
+        at = end
+
+
+def transfer_messages(trans_id: int, qry: bytes, origin: bytes, zone):
+    '''AXFR response: the zone between two copies of its SOA, one message at a time
+
+    Records are read from the zone as the messages are sent, so a transfer
+    never holds more than one message in memory. Owners outside the zone
+    are not part of it and are left out (RFC 5936).
+    '''
+    soa = next(owner_records(origin, origin, zone.get(origin)[TYPE_SOA][1]))
+
+    def records():
+        yield soa
+        for owner, rrsets in zone.items():
+            if origin_offset(owner, origin) is None:
+                continue
+            for rtype, (_, encoded) in rrsets.items():
+                if rtype != TYPE_SOA:
+                    yield from owner_records(owner, origin, encoded)
+        yield soa
+
+    room = AXFR_MESSAGE_SIZE - HEADER.size - len(qry)
+    batch, size = [], 0
+    for record in records():
+        if batch and size + len(record) > room:
+            yield HEADER.pack(trans_id, 0x8400, 1, len(batch), 0, 0) + qry + b''.join(batch)
+            batch, size = [], 0
+        batch.append(record)
+        size += len(record)
+    yield HEADER.pack(trans_id, 0x8400, 1, len(batch), 0, 0) + qry + b''.join(batch)
+
+
+@functools.lru_cache(maxsize=1024)
+def negative_soa(soa: bytes) -> bytes:
+    '''The zone's SOA record for the authority section of a negative answer, without its name
+
+    Its TTL is capped by the SOA minimum, which bounds negative caching (RFC 2308).
+    '''
+    _, rtype, class_, ttl, length = ANSWER_FIXED.unpack_from(soa)
+    minimum = UINT32.unpack_from(soa, ANSWER_FIXED.size + length - 4)[0]
+    return ANSWER_FIXED.pack(0, rtype, class_, min(ttl, minimum), length)[2:] + \
+        soa[ANSWER_FIXED.size:ANSWER_FIXED.size + length]
+
+
+def wildcard(zone, name: bytes, origin_at: int) -> dict:
+    '''RRsets of the wildcard covering a name missing from the zone, or None (RFC 4592)
+
+    Only the wildcard child of the closest existing ancestor applies.
+    '''
+    i = name[0] + 1
+    while i <= origin_at:
+        if zone.get(name[i:]) is not None:
+            return zone.get(WILDCARD + name[i:])
+        i += name[i] + 1
+    return None
+
+
+def error_response(msg_req: bytes, end: int, rcode: int) -> bytearray:
+    '''Header of the request with an error code, its question up to end, and no records'''
+    # The opcode and RD are copied from the request.
+    flags = 0x8000 | (msg_req[2] & (OPCODE_MASK | 0x01)) << 8 | rcode
+    return bytearray(HEADER.pack(HEADER.unpack_from(msg_req)[0], flags, 1 if end > HEADER.size else 0, 0, 0, 0) +
+                     msg_req[HEADER.size:end])
+
+
+def malformed_response(msg_req: bytes) -> bytearray:
+    '''FORMERR reply to a query whose question cannot be read, or None without a usable header'''
+    if len(msg_req) < HEADER.size or msg_req[2] & 0x80:
+        return None
+    return error_response(msg_req, HEADER.size, RCODE_FORMERR)
+
+
+def parse_edns(msg_req: bytes, offset: int) -> int:
+    '''UDP payload size advertised by an OPT record at offset, or None without EDNS0'''
+    if not (msg_req[10] or msg_req[11]) or len(msg_req) < offset + 11:
+        return None
+    root, rtype, payload_size = OPT_FIXED.unpack_from(msg_req, offset)
+    if root != 0 or rtype != TYPE_OPT:
+        return None
+    return payload_size
+
+
+def opt_record(payload_size: int) -> bytes:
+    '''OPT pseudo-record advertising our UDP payload size'''
+    return bytes([0] + val_to_bytes(TYPE_OPT, 2) + val_to_bytes(payload_size, 2) + [0] * 6)
+
+
+def finish_response(response: bytearray, qry_len: int, edns_size: int, limit: bool = True) -> bytearray:
+    '''Echo EDNS0 back to EDNS0 clients and truncate answers that do not fit
+
+    A truncated answer keeps the header and the question, has the TC bit set
+    and no records, telling the client to retry over TCP.
+    '''
+    if edns_size is not None:
+        response[11] = 1
+        response += opt_record(MAX_UDP_SIZE)
+    size = DEFAULT_UDP_SIZE if edns_size is None else min(max(edns_size, DEFAULT_UDP_SIZE), MAX_UDP_SIZE)
+    if limit and len(response) > size:
+        truncated = bytearray(response[:12 + qry_len])
+        truncated[2] |= FLAG_TC
+        truncated[6:10] = bytes(4)
+        if edns_size is not None:
+            truncated += opt_record(MAX_UDP_SIZE)
+        return truncated
+    return response
+
+
+def encode_name(name: str) -> bytes:
+    '''Lowercase wire-format name'''
+    labels = name.lower().rstrip('.').encode().split(b'.')
+    return b''.join([bytes((len(label),)) + label for label in labels if label]) + b'\x00'
+
+
+def owner_name(name: str, origin: str) -> str:
+    '''Absolute name of a zone file owner: "@", relative (one or more labels) or ending with a dot'''
+    if name == '@':
+        return origin
+    if name.endswith('.'):
+        return name
+    return name + '.' + origin
+
+
+def absolute_zone(zone: dict, origin: str) -> dict:
+    '''Records by wire-format owner name, merging owners written differently (such as "@" and the origin)'''
+    merged = {}
+    for name, records in zone.items():
+        merged.setdefault(encode_name(owner_name(name, origin)), []).extend(records)
+    return merged
+
+
+def parse_question(msg_req: bytes) -> tuple:
+    '''(transaction ID, lowercase wire-format name, type, class, end offset) of the question
+
+    msg_req may be a memoryview of a receive buffer: the name is the only
+    thing copied out of it.
+    '''
+    i = 12
+    length = msg_req[i]
+    while length:
+        if length >= 0xC0:
+            raise ValueError("Compressed question name")
+        i += length + 1
+        length = msg_req[i]
+    trans_id = HEADER.unpack_from(msg_req)[0]
+    qry_type, class_ = QUESTION.unpack_from(msg_req, i + 1)
+    return (trans_id, bytes(msg_req[12:i + 1]).lower(), qry_type, class_, i + 5)
+
+
+class ZoneStore:
+    '''Compiled zones for any number of origins
+
+    Zones are keyed by their lowercase wire-format origin and records by
+    their full wire-format owner name. The zone for a query is the longest
+    suffix of its name that is an origin, found with one dict probe per
+    label whatever the number of zones or records.
+    '''
+
+    def __init__(self):
+        self.zones = {}
+        # filename -> ZoneSource of every file loaded with load()
+        self.sources = {}
+
+    def __len__(self) -> int:
+        return len(self.zones)
+
+    def add(self, origin: str, zone: dict) -> None:
+        '''Compile and add a zone read by read_zone_file'''
+        key = encode_name(origin)
+        compiled = compile_zone(absolute_zone(zone, origin), origin)
+        add_empty_non_terminals(compiled, key, list(compiled))
+        self.zones[key] = (origin, compiled)
+
+    def load(self, filename: str) -> None:
+        '''Add the zones of a zone file or image, remembering it for reloads'''
+        stamp = file_stamp(filename)
+        if is_image(filename):
+            self.add_image(filename)
+            self.sources[filename] = ZoneSource(stamp, None, None, None)
+            return
+        origin, zone = read_zone(filename)
+        self.add(origin, zone)
+        self.sources[filename] = ZoneSource(stamp, origin, zone_serial(zone), absolute_zone(zone, origin))
+
+    def changed(self, filename: str) -> bool:
+        '''The file was modified since it was last loaded'''
+        stamp = file_stamp(filename)
+        return stamp is not None and stamp != self.sources[filename].stamp
+
+    def reload(self, filename: str) -> str:
+        '''Load a file again off the serving path and swap its zone in, returning a log line
+
+        A zone whose SOA serial did not change is left alone. Otherwise only
+        the owners whose records changed are compiled again; the answers of
+        every other owner are reused as they are.
+        '''
+        start = time.perf_counter()
+        stamp = file_stamp(filename)
+        if is_image(filename):
+            self.add_image(filename)
+            self.sources[filename] = ZoneSource(stamp, None, None, None)
+            return "Reloaded image {} in {:.1f} ms".format(filename, (time.perf_counter() - start) * 1000)
+        old = self.sources[filename]
+        origin, zone = read_zone(filename)
+        serial = zone_serial(zone)
+        if origin == old.origin and serial is not None and serial == old.serial:
+            self.sources[filename] = old._replace(stamp=stamp)
+            return "Zone {} unchanged (serial {}), not reloaded".format(origin, serial)
+        key = encode_name(origin)
+        zone = absolute_zone(zone, origin)
+        if origin == old.origin and key in self.zones:
+            changed = [name for name in zone.keys() | old.zone.keys() if zone.get(name) != old.zone.get(name)]
+            compiled = dict(self.zones[key][1])
+            for name in changed:
+                if name in zone:
+                    compiled[name] = compile_zone({name: zone[name]}, origin)[name]
+                else:
+                    compiled.pop(name, None)
+            if any(name not in zone for name in changed):
+                # Names that only existed above a removed owner may be gone too: rebuild them all.
+                compiled = {owner: rrsets for owner, rrsets in compiled.items() if rrsets}
+                add_empty_non_terminals(compiled, key, list(compiled))
+            else:
+                add_empty_non_terminals(compiled, key, changed)
+        else:
+            changed = list(zone)
+            compiled = compile_zone(zone, origin)
+            add_empty_non_terminals(compiled, key, list(compiled))
+        rebuilt = sum(name in zone for name in changed)
+        # Held until after the swap so freeing it is not timed as part of it.
+        previous = self.zones.get(key)
+        built = time.perf_counter()
+        # One assignment: every query sees either the whole old zone or the whole new one.
+        self.zones[key] = (origin, compiled)
+        if old.origin is not None and old.origin != origin:
+            self.zones.pop(encode_name(old.origin), None)
+        swapped = time.perf_counter()
+        del previous
+        self.sources[filename] = ZoneSource(stamp, origin, serial, zone)
+        return "Reloaded {} (serial {} -> {}): {} owners rebuilt, {} removed, {} kept in {:.1f} ms, swapped in {:.1f} us".format(
+            origin, old.serial, serial, rebuilt, len(changed) - rebuilt, len(zone) - rebuilt,
+            (built - start) * 1000, (swapped - built) * 1e6)
+
+    def find(self, name: bytes) -> tuple:
+        '''(origin, compiled zone) of the closest zone enclosing a wire-format name, or None'''
+        return self.enclosing(name)[1]
+
+    def enclosing(self, name: bytes) -> tuple:
+        '''(offset of the origin in name, (origin, compiled zone)) of the closest enclosing zone'''
+        i = 0
+        while True:
+            zone = self.zones.get(name[i:])
+            if zone is not None or not name[i]:
+                return i, zone
+            i += name[i] + 1
+
+    def answer(self, msg_req: bytes, limit: bool = True, question: tuple = None) -> bytearray:
+        '''Build the complete response to one request, whose question may already be parsed
+
+        Names missing from a zone get NXDOMAIN and names without the type
+        asked for get their CNAME if they have one, or else no records, with
+        the zone's SOA for negative caching. Names outside every zone are
+        REFUSED.
+        '''
+        if msg_req[2] & 0x80:
+            raise ValueError("Not a query")
+        trans_id, name, qry_type, class_, end = question or parse_question(msg_req)
+        edns_size = parse_edns(msg_req, end)
+        if msg_req[2] & OPCODE_MASK or qry_type in (TYPE_AXFR, TYPE_IXFR):
+            return finish_response(error_response(msg_req, end, RCODE_NOTIMP), end - 12, edns_size, limit)
+        origin_at, zone = self.enclosing(name)
+        if zone is None or class_ != 1:
+            return finish_response(error_response(msg_req, end, RCODE_REFUSED), end - 12, edns_size, limit)
+        records = zone[1]
+        rrsets = records.get(name)
+        if rrsets is None:
+            rrsets = wildcard(records, name, origin_at)
+        count, answers = rrsets.get(qry_type, (0, b'')) if rrsets is not None else (0, b'')
+        if not count and rrsets is not None:
+            count, answers = rrsets.get(TYPE_CNAME, (0, b''))
+        # Authoritative answer, with recursion desired copied from the query.
+        flags = 0x8400 | (msg_req[2] & 0x01) << 8
+        if count:
+            msg_resp = bytearray(HEADER.pack(trans_id, flags, 1, count, 0, 0) + msg_req[12:end] + answers)
+        else:
+            rcode = 0 if rrsets is not None else RCODE_NXDOMAIN
+            soa = (records.get(name[origin_at:]) or {}).get(TYPE_SOA)
+            authority = b'' if soa is None else \
+                UINT16.pack(QUESTION_POINTER + origin_at) + negative_soa(bytes(soa[1]))
+            msg_resp = bytearray(HEADER.pack(trans_id, flags | rcode, 1, 0, 0 if soa is None else 1, 0) +
+                                 msg_req[12:end] + authority)
+        return finish_response(msg_resp, end - 12, edns_size, limit)
+
+    def transfer(self, msg_req: bytes):
+        '''Messages of a zone transfer (AXFR) request, generated as they are sent
+
+        A request for a zone not held here, or one without an SOA, gets a
+        single REFUSED message.
+        '''
+        trans_id, name, _, class_, end = parse_question(msg_req)
+        zone = self.zones.get(name)
+        if class_ != 1 or zone is None or TYPE_SOA not in zone[1].get(name, {}):
+            return [error_response(msg_req, end, RCODE_REFUSED)]
+        return transfer_messages(trans_id, bytes(msg_req[12:end]), name, zone[1])
+
+    def add_image(self, filename: str) -> None:
+        '''Map a zone image written by write_image and add its zones'''
+        with open(filename, 'rb') as image_file:
+            image = mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, zones = IMAGE_HEADER.unpack_from(image)
+        if magic != IMAGE_MAGIC:
+            raise ValueError("Not a zone image: {}".format(filename))
+        for i in range(zones):
+            origin_at, table_at, slots, records = IMAGE_ZONE.unpack_from(image, IMAGE_HEADER.size + i * IMAGE_ZONE.size)
+            origin = image[origin_at + 1:origin_at + 1 + image[origin_at]].decode()
+            self.zones[encode_name(origin)] = (origin, ImageZone(image, table_at, slots, records))
+
+    def write_image(self, filename: str) -> None:
+        '''Write every zone to a binary image that add_image can map'''
+        image = bytearray(IMAGE_HEADER.pack(IMAGE_MAGIC, len(self.zones)))
+        directory_at = len(image)
+        image += bytes(IMAGE_ZONE.size * len(self.zones))
+        for i, (origin, zone) in enumerate(self.zones.values()):
+            origin_at = len(image)
+            image += bytes([len(origin)]) + origin.encode()
+            # At most half full, so probe chains stay short.
+            slots = 2 * len(zone) + 1
+            table = [0] * slots
+            for name, rrsets in zone.items():
+                slot = zlib.crc32(name) % slots
+                while table[slot]:
+                    slot = (slot + 1) % slots
+                table[slot] = len(image)
+                image += bytes([len(name)]) + name + bytes([len(rrsets)])
+                for rtype, (count, records) in rrsets.items():
+                    image += IMAGE_RRSET.pack(rtype, count, len(records)) + records
+            IMAGE_ZONE.pack_into(image, directory_at + i * IMAGE_ZONE.size, origin_at, len(image), slots, len(zone))
+            image += struct.pack('!{}I'.format(slots), *table)
+        temp = filename + '.tmp'
+        with open(temp, 'wb') as image_file:
+            image_file.write(image)
+        os.replace(temp, filename)
+
+
+class ImageZone:
+    '''Compiled zone inside a mapped image, read in place
+
+    Behaves like the dict built by ZoneStore.add: owner name to
+    {type: (record count, answer section bytes)}.
+    '''
+
+    def __init__(self, image: mmap.mmap, table_at: int, slots: int, records: int):
+        self.image = image
+        self.table_at = table_at
+        self.slots = slots
+        self.records = records
+
+    def __len__(self) -> int:
+        return self.records
+
+    def __contains__(self, name: bytes) -> bool:
+        return self.get(name) is not None
+
+    def get(self, name: bytes, default=None):
+        '''RRsets of a wire-format owner name'''
+        image = self.image
+        slot = zlib.crc32(name) % self.slots
+        while True:
+            at = UINT32.unpack_from(image, self.table_at + 4 * slot)[0]
+            if not at:
+                return default
+            if image[at + 1:at + 1 + image[at]] == name:
+                return self.rrsets(at + 1 + image[at])
+            slot = (slot + 1) % self.slots
+
+    def rrsets(self, at: int) -> dict:
+        '''Decode the RRsets of a record block'''
+        image = self.image
+        rrsets = {}
+        at += 1
+        for _ in range(image[at - 1]):
+            rtype, count, length = IMAGE_RRSET.unpack_from(image, at)
+            at += IMAGE_RRSET.size
+            rrsets[rtype] = (count, image[at:at + length])
+            at += length
+        return rrsets
+
+    def items(self):
+        '''(name, RRsets) of every record block'''
+        for slot in range(self.slots):
+            at = UINT32.unpack_from(self.image, self.table_at + 4 * slot)[0]
+            if at:
+                yield self.image[at + 1:at + 1 + self.image[at]], self.rrsets(at + 1 + self.image[at])
+
+
+class ZoneWatcher:
+    '''Reload zone files when they change or when asked, in a background thread'''
+
+    def __init__(self, store: ZoneStore, interval: float = RELOAD_INTERVAL):
+        self.store = store
+        self.interval = interval
+        self.requested = threading.Event()
+
+    def start(self) -> None:
+        '''Poll in a daemon thread'''
+        threading.Thread(target=self.watch, daemon=True).start()
+
+    def request(self, *_) -> None:
+        '''Reload every file on the next pass; usable as a SIGHUP handler'''
+        self.requested.set()
+
+    def watch(self) -> None:
+        '''Reload changed files every interval, or all of them when requested'''
+        while True:
+            forced = self.requested.wait(self.interval)
+            self.requested.clear()
+            for filename in list(self.store.sources):
+                try:
+                    if forced or self.store.changed(filename):
+                        print(self.store.reload(filename))
+                except (OSError, ValueError, IndexError, KeyError) as err:
+                    print("Reload of {} failed, keeping the loaded zone: {}".format(filename, err))
+
+
+def file_stamp(filename: str) -> tuple:
+    '''Modification time and size of a file, or None if it is missing'''
+    try:
+        info = os.stat(filename)
+    except OSError:
+        return None
+    return (info.st_mtime_ns, info.st_size)
+
+
+def zone_serial(zone: dict) -> int:
+    '''Serial number of the zone's SOA record, or None without one'''
+    for records in zone.values():
+        for record in records:
+            if record[2] == 'SOA':
+                return int(record[3].split()[2])
+    return None
+
+
+def is_image(filename: str) -> bool:
+    '''The file starts with the zone image magic'''
+    with open(filename, 'rb') as zone_file:
+        return zone_file.read(len(IMAGE_MAGIC)) == IMAGE_MAGIC
+
+
+def load_zones(filenames: list) -> ZoneStore:
+    '''Map zone images and read and compile zone files'''
+    store = ZoneStore()
+    for filename in filenames:
+        store.load(filename)
+    return store
+
+
+class BufferPool:
+    '''Preallocated receive buffers, handed out as memoryviews and given back after use'''
+
+    def __init__(self, count: int = POOL_SIZE, size: int = RECV_SIZE):
+        self.size = size
+        self.free = [memoryview(bytearray(size)) for _ in range(count)]
+
+    def get(self) -> memoryview:
+        '''A free buffer, or a new one when all are in use'''
+        try:
+            return self.free.pop()
+        except IndexError:
+            return memoryview(bytearray(self.size))
+
+    def put(self, buffer: memoryview) -> None:
+        '''Return a buffer to the pool'''
+        self.free.append(buffer)
+
+
+BUFFERS = BufferPool()
+
+
+class DropLog:
+    '''Requests dropped as unreadable, reported at most once per interval
+
+    A flood of garbage datagrams would otherwise print a line each, costing
+    more than dropping them.
+    '''
+
+    def __init__(self, interval: float = DROP_REPORT_INTERVAL, clock=time.monotonic):
+        self.interval = interval
+        self.clock = clock
+        self.dropped = 0
+        self.reported = 0
+        self.last_report = None
+
+    def drop(self, error: Exception) -> None:
+        '''Count a dropped request, and print the drops since the last report if one is due'''
+        self.dropped += 1
+        now = self.clock()
+        if self.last_report is None or now - self.last_report >= self.interval:
+            print('Ignoring {} unreadable request(s), the last: {}'.format(self.dropped - self.reported, error))
+            self.reported = self.dropped
+            self.last_report = now
+
+
+DROPS = DropLog()
+
+
+def recv_exactly_into(conn: socket, buffer: memoryview) -> int:
+    '''Fill buffer, or return how much was read before the peer closed'''
+    read = 0
+    while read < len(buffer):
+        chunk = conn.recv_into(buffer[read:])
+        if not chunk:
+            break
+        read += chunk
+    return read
+
+
+def recv_exactly(conn: socket, n_bytes: int) -> bytes:
+    '''Read exactly n bytes, or return what was read before the peer closed'''
+    data = bytearray()
+    while len(data) < n_bytes:
+        chunk = conn.recv(n_bytes - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return bytes(data)
+
+
+def is_transfer(msg_req: bytes) -> bool:
+    '''The request asks for a zone transfer'''
+    return parse_question(msg_req)[2] == TYPE_AXFR
+
+
+def send_transfer(conn: socket, send_lock: threading.Lock, messages) -> None:
+    '''Stream zone transfer messages, each sent whole between other replies'''
+    try:
+        for message in messages:
+            with send_lock:
+                conn.sendall(UINT16.pack(len(message)) + message)
+    except OSError:
+        return
+
+
+def serve_tcp_client(conn: socket, store: ZoneStore, pool: BufferPool = BUFFERS, drops: DropLog = DROPS) -> None:
+    '''Answer length-prefixed queries on one TCP connection until it goes idle
+
+    Clients may pipeline queries. Zone transfers stream from their own
+    thread, so later queries are answered while a transfer is under way and
+    replies may come back out of order.
+    '''
+    buffer = pool.get()
+    send_lock = threading.Lock()
+    transfers = []
+    with conn:
+        conn.settimeout(TCP_IDLE_TIMEOUT)
         try:
-            trans_id, domain, qry_type, qry = parse_request(origin, request_msg)
-            msg_resp = format_response(zone, trans_id, domain, qry_type, qry)
+            while True:
+                try:
+                    if recv_exactly_into(conn, buffer[:2]) < 2:
+                        return
+                except timeout:
+                    # Only a connection with nothing to send is idle.
+                    transfers = [thread for thread in transfers if thread.is_alive()]
+                    if transfers:
+                        continue
+                    return
+                length = UINT16.unpack_from(buffer)[0]
+                if length <= len(buffer):
+                    request_msg = buffer[:length]
+                    if recv_exactly_into(conn, request_msg) < length:
+                        return
+                else:
+                    request_msg = recv_exactly(conn, length)
+                try:
+                    if is_transfer(request_msg):
+                        thread = threading.Thread(target=send_transfer, daemon=True,
+                                                  args=(conn, send_lock, store.transfer(request_msg)))
+                        thread.start()
+                        transfers.append(thread)
+                        continue
+                    msg_resp = store.answer(request_msg, limit=False)
+                except (ValueError, IndexError, struct.error) as ve:
+                    msg_resp = malformed_response(request_msg)
+                    if msg_resp is None:
+                        drops.drop(ve)
+                        continue
+                with send_lock:
+                    conn.sendall(UINT16.pack(len(msg_resp)) + msg_resp)
+        except OSError:
+            return
+        finally:
+            # A client that stops sending after asking for a transfer still gets all of it.
+            for thread in transfers:
+                thread.join()
+            pool.put(buffer)
+
+
+def serve_tcp(store: ZoneStore, reuse_port: bool = False) -> None:
+    '''Accept TCP clients, for answers too large for UDP'''
+    with socket(AF_INET, SOCK_STREAM) as listener:
+        listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        if reuse_port:
+            listener.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        listener.bind((HOST, PORT))
+        listener.listen(64)
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=serve_tcp_client, args=(conn, store), daemon=True).start()
+
+
+def udp_socket(reuse_port: bool = False) -> socket:
+    '''UDP socket bound to the server address, shareable between processes'''
+    sckt = socket(AF_INET, SOCK_DGRAM)
+    if reuse_port:
+        # The kernel spreads datagrams over every socket bound with SO_REUSEPORT.
+        sckt.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    sckt.bind((HOST, PORT))
+    return sckt
+
+
+class RateLimiter:
+    '''Token buckets holding up to rate tokens, refilled once a second
+
+    The table maps a key to (tokens, second of the last update). Updated
+    keys move to the end, so when the table is full the entry dropped is
+    the one idle the longest, whose bucket has long been full again.
+    '''
+
+    def __init__(self, rate: int, size: int = RRL_TABLE_SIZE, clock=time.monotonic):
+        self.rate = rate
+        self.size = size
+        self.clock = clock
+        self.table = {}
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def allow(self, key) -> bool:
+        '''Take a token for key if it has one'''
+        now = int(self.clock())
+        entry = self.table.pop(key, None)
+        if entry is None:
+            tokens = self.rate
+        else:
+            tokens = min(self.rate, entry[0] + (now - entry[1]) * self.rate)
+        self.table[key] = (tokens - 1 if tokens else 0, now)
+        if len(self.table) > self.size:
+            del self.table[next(iter(self.table))]
+        return tokens > 0
+
+
+def client_prefix(client_addr: tuple) -> str:
+    '''The /24 network of an IPv4 client, or the /56 of an IPv6 one'''
+    address = client_addr[0]
+    if ':' in address:
+        return inet_pton(AF_INET6, address)[:7].hex()
+    return address.rpartition('.')[0]
+
+
+class ResponseLimiter:
+    '''Response rate limiting by client prefix and by (client prefix, name, type)
+
+    As in BIND's RRL, identical responses are counted per client network, so
+    spoofed traffic reflecting one answer off a victim runs out of that
+    victim's tokens without limiting anyone else. A prefix asking for many
+    different names runs out of its own, larger bucket.
+    '''
+
+    def __init__(self, rate: int, prefix_rate: int = None, slip: int = RRL_SLIP,
+                 size: int = RRL_TABLE_SIZE, clock=time.monotonic):
+        self.clients = RateLimiter(prefix_rate or rate * RRL_PREFIX_FACTOR, size, clock)
+        self.responses = RateLimiter(rate, size, clock)
+        self.slip = slip
+        self.answered = 0
+        self.dropped = 0
+        self.slipped = 0
+
+    def check(self, client_addr: tuple, name: bytes, qry_type: int) -> int:
+        '''ANSWER, DROP or SLIP (send a truncated reply) for one response'''
+        prefix = client_prefix(client_addr)
+        # A limited prefix is not charged for the response, so a flood keeps no more entries alive.
+        if self.clients.allow(prefix) and self.responses.allow((prefix, name, qry_type)):
+            self.answered += 1
+            return ANSWER
+        self.dropped += 1
+        if self.slip and self.dropped % self.slip == 0:
+            self.slipped += 1
+            return SLIP
+        return DROP
+
+    def stats(self) -> dict:
+        '''Counters since the server started'''
+        return {'answered': self.answered, 'dropped': self.dropped, 'slipped': self.slipped,
+                'clients': len(self.clients), 'responses': len(self.responses)}
+
+
+def report_limits(limiter: ResponseLimiter, interval: float = RRL_REPORT_INTERVAL) -> None:
+    '''Print the rate limiting counters every interval while responses are being dropped'''
+    reported = 0
+    while True:
+        time.sleep(interval)
+        if limiter.dropped != reported:
+            reported = limiter.dropped
+            print("Rate limiting: {answered} answered, {dropped} dropped, {slipped} slipped "
+                  "({clients} prefixes, {responses} responses tracked)".format(**limiter.stats()))
+
+
+def slip_response(msg_req: bytes, end: int) -> bytes:
+    '''Truncated reply with no records, asking the client to retry over TCP'''
+    return HEADER.pack(HEADER.unpack_from(msg_req)[0], 0x8100 | FLAG_TC << 8, 1, 0, 0, 0) + msg_req[12:end]
+
+
+def serve_udp(store: ZoneStore, server_sckt: socket, pool: BufferPool = BUFFERS,
+              limiter: ResponseLimiter = None, drops: DropLog = DROPS) -> None:
+    '''Answer queries arriving on one UDP socket, rate limited by limiter if given'''
+    # Every datagram is read into the same buffer and parsed in place.
+    buffer = pool.get()
+    try:
+        while True:
+            size, client_addr = server_sckt.recvfrom_into(buffer)
+            request_msg = buffer[:size]
+            try:
+                question = parse_question(request_msg)
+                if limiter is not None:
+                    action = limiter.check(client_addr, question[1], question[2])
+                    if action == DROP:
+                        continue
+                    if action == SLIP:
+                        server_sckt.sendto(slip_response(request_msg, question[4]), client_addr)
+                        continue
+                msg_resp = store.answer(request_msg, question=question)
+            except (ValueError, IndexError, struct.error) as ve:
+                msg_resp = malformed_response(request_msg)
+                if msg_resp is None:
+                    drops.drop(ve)
+                    continue
             server_sckt.sendto(msg_resp, client_addr)
-        except ValueError as ve:
-            print('Ignoring the request: {}'.format(ve))
-    server_sckt.close()
+    finally:
+        pool.put(buffer)
+
+
+def spawn(store: ZoneStore, limiter: ResponseLimiter = None) -> int:
+    '''Fork a worker serving UDP and TCP on the shared port'''
+    # Nothing buffered before the fork may be written twice.
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            watcher = ZoneWatcher(store)
+            signal.signal(signal.SIGHUP, watcher.request)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, SUPERVISOR_SIGNALS)
+            watcher.start()
+            threading.Thread(target=serve_tcp, args=(store, True), daemon=True).start()
+            if limiter is not None:
+                threading.Thread(target=report_limits, args=(limiter,), daemon=True).start()
+            serve_udp(store, udp_socket(True), limiter=limiter)
+        except KeyboardInterrupt:
+            status = 0
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+    print("Worker {} started".format(pid))
+    return pid
+
+
+def start_worker(store: ZoneStore, children: dict, limiter: ResponseLimiter = None) -> None:
+    '''Spawn a worker and record it before any signal can interrupt the supervisor'''
+    # A SIGTERM handled between the fork and the bookkeeping would orphan the worker.
+    signal.pthread_sigmask(signal.SIG_BLOCK, SUPERVISOR_SIGNALS)
+    try:
+        children[spawn(store, limiter)] = time.monotonic()
+    finally:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, SUPERVISOR_SIGNALS)
+
+
+def supervise(store: ZoneStore, workers: int, limiter: ResponseLimiter = None) -> None:
+    '''Run workers, restarting any that exits, until interrupted or terminated'''
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    children = {}
+    # Every worker reloads its own copy of the zones.
+    signal.signal(signal.SIGHUP, lambda *_: [os.kill(pid, signal.SIGHUP) for pid in children])
+    try:
+        for _ in range(workers):
+            start_worker(store, children, limiter)
+        print("Listening on %s:%d (%d workers)" % (HOST, PORT, workers))
+        while True:
+            pid, status = os.wait()
+            started = children.pop(pid, None)
+            if started is None:
+                continue
+            print("Worker {} exited with status {}, restarting".format(pid, status))
+            if time.monotonic() - started < RESTART_DELAY:
+                time.sleep(RESTART_DELAY)
+            start_worker(store, children, limiter)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+
+
+def run(filenames: list, workers: int = 1, rate_limit: int = None) -> None:
+    '''Main server loop'''
+    store = load_zones(filenames)
+    # Each worker gets its own copy, limiting the clients the kernel sends it.
+    limiter = ResponseLimiter(rate_limit) if rate_limit else None
+    if workers > 1:
+        # Compiled before forking so every worker shares the zones' pages.
+        supervise(store, workers, limiter)
+        return
+    server_sckt = udp_socket()
+    watcher = ZoneWatcher(store)
+    signal.signal(signal.SIGHUP, watcher.request)
+    watcher.start()
+    threading.Thread(target=serve_tcp, args=(store,), daemon=True).start()
+    if limiter is not None:
+        threading.Thread(target=report_limits, args=(limiter,), daemon=True).start()
+    print("Listening on %s:%d" % (HOST, PORT))
+    try:
+        serve_udp(store, server_sckt, limiter=limiter)
+    finally:
+        server_sckt.close()
 
 
 def main(*argv):
     '''Main function'''
-    if len(argv[0]) != 2:
-        print('Proper use: python3 nameserver.py <zone_file>')
+    argv = list(argv[0])
+    workers = 1
+    if '--workers' in argv and argv.index('--workers') + 1 < len(argv):
+        i = argv.index('--workers')
+        workers = int(argv[i + 1])
+        del argv[i:i + 2]
+    rate_limit = None
+    if '--rate-limit' in argv and argv.index('--rate-limit') + 1 < len(argv):
+        i = argv.index('--rate-limit')
+        rate_limit = int(argv[i + 1])
+        del argv[i:i + 2]
+    if len(argv) > 3 and argv[1] == '--compile':
+        # --compile <image> <zone_file>... writes the zones as one mappable image.
+        load_zones(argv[3:]).write_image(argv[2])
+        return
+    if len(argv) < 2:
+        print('Proper use: python3 nameserver.py [--workers N] [--rate-limit N] <zone_file|zone_image>...')
+        print('           python3 nameserver.py --compile <zone_image> <zone_file>...')
         exit()
-    run(argv[0][1])
+    run(argv[1:], workers, rate_limit)
     # run("zoo.zone")
 
 
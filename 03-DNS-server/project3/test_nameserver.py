@@ -4,7 +4,15 @@ Testing the DNS Server
 #!/usr/bin/python3
 
 
+import os
+import signal
+import struct
+import subprocess
+import sys
+import threading
+import time
 from random import seed
+from socket import socket, socketpair, AF_INET, SOCK_DGRAM, MSG_WAITALL, SHUT_WR
 import pytest
 from nameserver import val_to_bytes
 from nameserver import bytes_to_val
@@ -13,6 +21,32 @@ from nameserver import get_right_bits
 from nameserver import read_zone_file
 from nameserver import parse_request
 from nameserver import format_response
+from nameserver import parse_edns
+from nameserver import finish_response
+from nameserver import FLAG_TC
+from nameserver import udp_socket
+from nameserver import PORT
+from nameserver import compile_zone
+from nameserver import encode_name
+from nameserver import parse_question
+from nameserver import load_zones
+from nameserver import parse_ttl
+from nameserver import parse_zone
+from nameserver import read_zone
+from nameserver import is_image
+from nameserver import ZoneStore
+from nameserver import ZoneWatcher
+from nameserver import BufferPool
+from nameserver import DropLog
+from nameserver import serve_udp
+from nameserver import serve_tcp_client
+from nameserver import ANSWER_FIXED
+from nameserver import RateLimiter
+from nameserver import ResponseLimiter
+from nameserver import ANSWER, DROP, SLIP
+from nameserver import malformed_response
+from nameserver import TYPE_SOA
+import nameserver
 
 seed(430)
 
@@ -87,6 +121,501 @@ class TestServer:
             parse_request('luther.edu', b'6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01')
         exception_msg = excinfo.value.args[0]
         assert exception_msg == 'Unknown zone'
+    def test_answer_matches_format_response(self):
+        '''Pre-encoded answers give the bytes of format_response, with AA set'''
+        store = load_zones(['zoo.zone'])
+        for name in self.zone:
+            for qry_type in (1, 28, 15):
+                qry = bytes([len(name)]) + name.encode() + b'\x05cs430\x06luther\x03edu\x00\x00' + bytes([qry_type, 0, 1])
+                expected = format_response(self.zone, 4783, name, qry_type, qry)
+                request = b'\x12\xaf\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00' + qry
+                assert store.answer(request) == expected[:2] + b'\x85\x00' + expected[4:]
+
+    def test_parse_request_edns(self):
+        '''Keep only the question when an OPT record follows it'''
+        request = b'6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x01\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01' + \
+                  b'\x00\x00\x29\x04\xd0\x00\x00\x00\x00\x00\x00'
+        trans_id, name, qry_type, query = parse_request('cs430.luther.edu', request)
+        assert query == b'\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01'
+        assert parse_edns(request, 12 + len(query)) == 1232
+        assert parse_edns(request[:-11], 12 + len(query)) is None
+
+    def test_answer_edns(self):
+        '''Echo an OPT record to EDNS0 clients'''
+        request = b'6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x01\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01' + \
+                  b'\x00\x00\x29\x04\xd0\x00\x00\x00\x00\x00\x00'
+        response = load_zones(['zoo.zone']).answer(request)
+        assert response[6:12] == b'\x00\x02\x00\x00\x00\x01'
+        assert response[-11:] == b'\x00\x00\x29\x10\x00\x00\x00\x00\x00\x00\x00'
+
+    def test_finish_response_truncated(self):
+        '''Drop the records and set TC when the answer does not fit'''
+        query = b'\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01'
+        response = format_response(self.zone, 4783, 'ant', 1, query)
+        assert finish_response(bytearray(response), len(query), None) == response
+        # Padding stands in for records that push the answer past 512 bytes.
+        truncated = finish_response(bytearray(response + bytes(512)), len(query), None)
+        assert truncated[2] & FLAG_TC
+        assert truncated[6:10] == bytes(4)
+        assert truncated[12:] == query
+
+    def test_udp_socket_reuse_port(self):
+        '''Several sockets can share the port with SO_REUSEPORT'''
+        first, second = udp_socket(True), udp_socket(True)
+        assert first.getsockname()[1] == second.getsockname()[1] == PORT
+        first.close()
+        second.close()
+
+    def test_workers_restarted(self):
+        '''The supervisor replaces a worker that dies'''
+        proc = subprocess.Popen([sys.executable, '-u', 'nameserver.py', '--workers', '2', 'zoo.zone'],
+                                stdout=subprocess.PIPE, universal_newlines=True)
+        try:
+            workers = [int(proc.stdout.readline().split()[1]) for _ in range(2)]
+            assert proc.stdout.readline().startswith('Listening')
+            os.kill(workers[0], signal.SIGKILL)
+            assert proc.stdout.readline().startswith('Worker {} exited'.format(workers[0]))
+            replacement = int(proc.stdout.readline().split()[1])
+            assert replacement not in workers
+            with socket(AF_INET, SOCK_DGRAM) as sckt:
+                sckt.settimeout(2)
+                sckt.sendto(b'6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01',
+                            ('127.0.0.1', PORT))
+                assert sckt.recv(512)[:2] == b'6\xc3'
+        finally:
+            proc.terminate()
+            proc.wait()
+        for pid in (workers[1], replacement):
+            with pytest.raises(ProcessLookupError):
+                os.kill(pid, 0)
+
+    def test_parse_question(self):
+        '''Lowercase the wire-format name and find the end of the question'''
+        request = b'6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03Ant\x05CS430\x06luther\x03edu\x00\x00\x1c\x00\x01'
+        assert parse_question(request) == (14019, b'\x03ant\x05cs430\x06luther\x03edu\x00', 28, 1, len(request))
+        assert encode_name('Ant.CS430.luther.edu.') == b'\x03ant\x05cs430\x06luther\x03edu\x00'
+
+    def test_zone_store(self, tmp_path):
+        '''Serve several origins, nested zones and multi-label owners'''
+        luther = tmp_path / 'luther.zone'
+        luther.write_text('$ORIGIN luther.edu.\n$TTL 1h\n' +
+                          '{:<15}{:<5}{:<5}{:<10}{}\n'.format('@', '1h', 'IN', 'A', '10.0.0.1') +
+                          '{:<15}{:<5}{:<5}{:<10}{}\n'.format('www.dept', '1m', 'IN', 'A', '10.0.0.2') +
+                          '{:<15}{:<5}{:<5}{:<10}{}'.format('ant.cs430', '1m', 'IN', 'A', '10.0.0.3'))
+        store = load_zones(['zoo.zone', str(luther)])
+        assert len(store) == 2
+        assert store.find(encode_name('luther.edu'))[0] == 'luther.edu'
+        assert store.find(encode_name('www.dept.luther.edu'))[0] == 'luther.edu'
+        # The closest enclosing zone wins over its parent.
+        assert store.find(encode_name('ant.cs430.luther.edu'))[0] == 'cs430.luther.edu'
+        assert store.find(encode_name('luther.org')) is None
+
+        def ask(labels: list) -> bytes:
+            name = b''.join(bytes([len(l)]) + l.encode() for l in labels) + b'\x00'
+            return store.answer(b'\x12\xaf\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00' + name + b'\x00\x01\x00\x01')
+        assert ask(['WWW', 'dept', 'luther', 'edu'])[-4:] == bytes([10, 0, 0, 2])
+        assert ask(['luther', 'edu'])[-4:] == bytes([10, 0, 0, 1])
+        assert ask(['ant', 'cs430', 'luther', 'edu'])[6:8] == b'\x00\x02'
+        assert ask(['www', 'luther', 'org'])[3] & 0xF == 5
+        assert ask(['gnu', 'luther', 'edu'])[3] & 0xF == 3
+
+    def test_parse_ttl(self):
+        '''Plain seconds, units and combined units'''
+        assert parse_ttl('3600') == 3600
+        assert parse_ttl('30m') == 1800
+        assert parse_ttl('1h30M') == 5400
+        assert parse_ttl('1W') == 604800
+        with pytest.raises(ValueError):
+            parse_ttl('1x')
+
+    def test_parse_zone(self):
+        '''Free layout: omitted owners, TTL and class in any order, parentheses, comments'''
+        origin, zone = read_zone('cs430.zone')
+        assert origin == 'cs430.luther.edu'
+        assert zone['@'][0] == (86400, 'IN', 'SOA',
+                                'ns.cs430.luther.edu. admin.cs430.luther.edu. 2018091601 3H 15 1w 3h')
+        assert [r[2] for r in zone['@']] == ['SOA', 'NS', 'MX', 'MX']
+        assert zone['roman'] == [(1, 'IN', 'A', '1.2.3.4'), (3600, 'IN', 'A', '1.2.3.5'),
+                                 (86400, 'IN', 'AAAA', 'abcd:abcd:abcd:abcd:1234:1234:1234:1234')]
+        assert zone['www'][1] == (86400, 'IN', 'TXT', '"This is a web server"')
+        assert parse_zone('$ORIGIN a.b.\nx 30m A 1.2.3.4\n  IN 1h30m A 1.2.3.5 ; two\n')[1] == \
+            {'x': [(1800, 'IN', 'A', '1.2.3.4'), (5400, 'IN', 'A', '1.2.3.5')]}
+        with pytest.raises(ValueError):
+            parse_zone('$ORIGIN a.b.\nx 30m TXT "open\n')
+        assert compile_zone(read_zone('zoo.zone')[1]) == compile_zone(self.zone)
+
+    def test_zone_image(self, tmp_path):
+        '''A mapped image answers exactly like the zones it was written from'''
+        store = load_zones(['zoo.zone'])
+        store.write_image(str(tmp_path / 'zoo.zimg'))
+        assert is_image(str(tmp_path / 'zoo.zimg'))
+        assert not is_image('zoo.zone')
+        mapped = load_zones([str(tmp_path / 'zoo.zimg')])
+        origin, zone = store.find(encode_name('cs430.luther.edu'))
+        mapped_origin, mapped_zone = mapped.find(encode_name('ant.cs430.luther.edu'))
+        assert mapped_origin == origin
+        assert len(mapped_zone) == len(zone)
+        assert dict(mapped_zone.items()) == zone
+        assert mapped_zone.get(encode_name('gnu.cs430.luther.edu')) is None
+        request = b'6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x1c\x00\x01'
+        assert mapped.answer(request) == store.answer(request)
+
+    def test_reload(self, tmp_path):
+        '''A new serial rebuilds only the changed owners; the same serial is ignored'''
+        soa = '@ 3600 IN SOA ns.example.com. admin.example.com. {} 3600 600 86400 60\n'
+        zone_file = tmp_path / 'example.zone'
+        zone_file.write_text('$ORIGIN example.com.\n' + soa.format(1) +
+                             'www 300 IN A 10.0.0.1\nmail 300 IN A 10.0.0.2\nold 300 IN A 10.0.0.3\n')
+        store = ZoneStore()
+        store.load(str(zone_file))
+        _, before = store.find(encode_name('example.com'))
+        zone_file.write_text('$ORIGIN example.com.\n' + soa.format(1) + 'www 300 IN A 10.0.0.9\n')
+        assert 'not reloaded' in store.reload(str(zone_file))
+        assert store.find(encode_name('example.com'))[1] is before
+        zone_file.write_text('$ORIGIN example.com.\n' + soa.format(2) +
+                             'www 300 IN A 10.0.0.9\nmail 300 IN A 10.0.0.2\n')
+        assert '2 owners rebuilt, 1 removed, 1 kept' in store.reload(str(zone_file))
+        _, after = store.find(encode_name('example.com'))
+        assert after[encode_name('mail.example.com')] is before[encode_name('mail.example.com')]
+        assert after[encode_name('www.example.com')][1][1].endswith(bytes([10, 0, 0, 9]))
+        assert encode_name('old.example.com') not in after
+        assert encode_name('old.example.com') in before
+
+    def test_watcher(self, tmp_path):
+        '''The watcher reloads a file that changed on disk'''
+        zone_file = tmp_path / 'example.zone'
+        zone_file.write_text('$ORIGIN example.com.\nwww 300 IN A 10.0.0.1\n')
+        store = ZoneStore()
+        store.load(str(zone_file))
+        assert not store.changed(str(zone_file))
+        zone_file.write_text('$ORIGIN example.com.\nwww 300 IN A 10.0.0.1\nftp 300 IN A 10.0.0.2\n')
+        assert store.changed(str(zone_file))
+        ZoneWatcher(store, interval=0.05).start()
+        for _ in range(40):
+            if encode_name('ftp.example.com') in store.find(encode_name('example.com'))[1]:
+                break
+            time.sleep(0.05)
+        assert encode_name('ftp.example.com') in store.find(encode_name('example.com'))[1]
+        assert not store.changed(str(zone_file))
+
+    def test_buffer_pool(self):
+        '''Buffers are reused once given back, and made anew when the pool runs dry'''
+        pool = BufferPool(count=1, size=16)
+        first = pool.get()
+        second = pool.get()
+        assert len(first) == len(second) == 16
+        pool.put(first)
+        assert pool.get() is first
+
+    def test_answer_from_buffer(self):
+        '''A query read into a larger buffer is answered in place'''
+        store = load_zones(['zoo.zone'])
+        request = b'6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ANT\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01'
+        buffer = memoryview(bytearray(512))
+        buffer[:len(request)] = request
+        assert parse_question(buffer[:len(request)])[1] == encode_name('ant.cs430.luther.edu')
+        assert store.answer(buffer[:len(request)]) == store.answer(request)
+
+    def test_serve_udp(self):
+        '''The receive loop answers from its pooled buffer and survives bad requests'''
+        store = load_zones(['zoo.zone'])
+        server = socket(AF_INET, SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        pool = BufferPool(count=1)
+        threading.Thread(target=serve_udp, args=(store, server, pool), daemon=True).start()
+        request = b'6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01'
+        with socket(AF_INET, SOCK_DGRAM) as client:
+            client.settimeout(2)
+            client.sendto(b'\x00\x01', server.getsockname())
+            client.sendto(request, server.getsockname())
+            assert client.recv(512) == store.answer(request)
+            client.sendto(request[:2] + b'\x01' + request[3:], server.getsockname())
+            assert client.recv(512)[:2] == b'6\xc3'
+        assert pool.free == []
+
+    def test_serve_udp_drops_counted(self, capsys):
+        '''Unreadable datagrams are counted, and reported once per interval instead of once each'''
+        store = load_zones(['zoo.zone'])
+        server = socket(AF_INET, SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        clock = [100.0]
+        drops = DropLog(interval=10.0, clock=lambda: clock[0])
+        threading.Thread(target=serve_udp, args=(store, server, BufferPool(count=1), None, drops), daemon=True).start()
+        request = b'6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01'
+        with socket(AF_INET, SOCK_DGRAM) as client:
+            client.settimeout(2)
+            for _ in range(50):
+                client.sendto(b'\x00\x01', server.getsockname())
+            client.sendto(request, server.getsockname())
+            assert client.recv(512) == store.answer(request)
+            clock[0] += 10.0
+            client.sendto(b'\x00\x01', server.getsockname())
+            client.sendto(request, server.getsockname())
+            assert client.recv(512) == store.answer(request)
+        assert drops.dropped == 51
+        lines = capsys.readouterr().out.splitlines()
+        assert len(lines) == 2
+        assert lines[0].startswith('Ignoring 1 unreadable request(s)')
+        assert lines[1].startswith('Ignoring 50 unreadable request(s)')
+
+    def transfer_store(self, tmp_path) -> ZoneStore:
+        '''A zone with an SOA, an apex record, two hosts and an out-of-zone owner'''
+        zone_file = tmp_path / 'example.zone'
+        zone_file.write_text('$ORIGIN example.com.\n'
+                             '@ 3600 IN SOA ns admin 7 3600 600 1w 60\n'
+                             '  300 IN A 10.0.0.1\n'
+                             'www 300 IN A 10.0.0.2\n'
+                             'www 300 IN AAAA ::2\n'
+                             'mail.hosts 300 IN A 10.0.0.3\n'
+                             'elsewhere.org. 300 IN A 10.0.0.4\n')
+        return load_zones([str(zone_file)])
+
+    def test_transfer(self, tmp_path, monkeypatch):
+        '''AXFR streams every record between two SOAs over several messages'''
+        monkeypatch.setattr(nameserver, 'AXFR_MESSAGE_SIZE', 100)
+        store = self.transfer_store(tmp_path)
+        question = encode_name('example.com') + b'\x00\xfc\x00\x01'
+        messages = list(store.transfer(b'\x12\x34\x00\x00\x00\x01\x00\x00\x00\x00\x00\x00' + question))
+        assert len(messages) > 1
+        assert all(len(m) <= 100 and m[:4] == b'\x12\x34\x84\x00' and m[12:12 + len(question)] == question
+                   for m in messages)
+        assert sum(int.from_bytes(m[6:8], 'big') for m in messages) == 6
+        records = b''.join(m[12 + len(question):] for m in messages)
+        rdata = encode_name('ns.example.com') + encode_name('admin.example.com') + bytes.fromhex(
+            '00000007' '00000e10' '00000258' '00093a80' '0000003c')
+        soa = ANSWER_FIXED.pack(0xC00C, 6, 1, 3600, len(rdata)) + rdata
+        assert records.startswith(soa) and records.endswith(soa)
+        assert b'\x03www\xc0\x0c\x00\x1c\x00\x01' in records
+        assert b'\x04mail\x05hosts\xc0\x0c\x00\x01\x00\x01' in records
+        assert b'elsewhere' not in records
+
+    def test_transfer_refused(self, tmp_path):
+        '''Only zones with an SOA are transferred, and only from their origin; others are REFUSED'''
+        store = self.transfer_store(tmp_path)
+        for zones, name in ((store, 'www.example.com'), (load_zones(['zoo.zone']), 'cs430.luther.edu')):
+            question = encode_name(name) + b'\x00\xfc\x00\x01'
+            messages = list(zones.transfer(b'\x12\x34\x00\x00\x00\x01\x00\x00\x00\x00\x00\x00' + question))
+            assert messages == [b'\x12\x34\x80\x05\x00\x01\x00\x00\x00\x00\x00\x00' + question]
+
+    def test_tcp_pipelining(self, tmp_path):
+        '''Pipelined queries and a transfer on one connection all get their replies'''
+        store = self.transfer_store(tmp_path)
+        client, server = socketpair()
+        thread = threading.Thread(target=serve_tcp_client, args=(server, store), daemon=True)
+        thread.start()
+        axfr = b'\x00\x01\x00\x00\x00\x01\x00\x00\x00\x00\x00\x00' + encode_name('example.com') + b'\x00\xfc\x00\x01'
+        query = b'\x00\x02\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00' + encode_name('www.example.com') + b'\x00\x01\x00\x01'
+        with client:
+            client.settimeout(2)
+            client.sendall(b''.join(len(m).to_bytes(2, 'big') + m for m in (axfr, query, query)))
+            client.shutdown(SHUT_WR)
+            replies = []
+            while True:
+                length = client.recv(2, MSG_WAITALL)
+                if not length:
+                    break
+                replies.append(client.recv(int.from_bytes(length, 'big'), MSG_WAITALL))
+        thread.join(2)
+        assert not thread.is_alive()
+        assert [r for r in replies if r[:2] == b'\x00\x02'] == [store.answer(query, limit=False)] * 2
+        assert b''.join(r for r in replies if r[:2] == b'\x00\x01') == b''.join(store.transfer(axfr))
+
+    def test_tcp_idle_timeout(self, monkeypatch):
+        '''An idle connection is closed'''
+        monkeypatch.setattr(nameserver, 'TCP_IDLE_TIMEOUT', 0.1)
+        client, server = socketpair()
+        thread = threading.Thread(target=serve_tcp_client, args=(server, load_zones(['zoo.zone'])), daemon=True)
+        thread.start()
+        with client:
+            client.settimeout(2)
+            assert client.recv(2) == b''
+        thread.join(2)
+        assert not thread.is_alive()
+
+    def test_rate_limiter(self):
+        '''Buckets hold rate tokens, refill every second and the idlest key is evicted'''
+        now = [100.0]
+        limiter = RateLimiter(3, size=2, clock=lambda: now[0])
+        assert [limiter.allow('a') for _ in range(4)] == [True, True, True, False]
+        now[0] += 0.5
+        assert not limiter.allow('a')
+        now[0] += 0.5
+        assert [limiter.allow('a') for _ in range(4)] == [True, True, True, False]
+        limiter.allow('b')
+        limiter.allow('c')
+        assert len(limiter) == 2
+        assert 'a' not in limiter.table
+
+    def test_response_limiter(self):
+        '''A repeated response and a noisy prefix are limited, with every second drop slipped'''
+        limiter = ResponseLimiter(2, prefix_rate=4, clock=lambda: 100.0)
+        ant, emu = encode_name('ant.cs430.luther.edu'), encode_name('emu.cs430.luther.edu')
+        actions = [limiter.check(('10.0.0.1', 5353), ant, 1) for _ in range(3)]
+        assert actions == [ANSWER, ANSWER, DROP]
+        assert limiter.check(('10.0.0.2', 5353), emu, 1) == ANSWER
+        assert limiter.check(('10.0.0.3', 5353), ant, 28) == SLIP
+        assert limiter.check(('10.0.1.1', 5353), ant, 1) == ANSWER
+        assert limiter.stats() == {'answered': 4, 'dropped': 2, 'slipped': 1, 'clients': 2, 'responses': 3}
+
+    def test_response_limiter_prefixes(self):
+        '''A prefix flooding one name does not limit the same answer to other prefixes'''
+        limiter = ResponseLimiter(2, clock=lambda: 100.0)
+        name = encode_name('ant.cs430.luther.edu')
+        for i in range(1000):
+            limiter.check(('10.0.0.{}'.format(i % 256), 5353), name, 1)
+        assert all(limiter.check(('10.0.{}.1'.format(i), 5353), name, 1) == ANSWER for i in range(1, 100))
+        assert all(limiter.check(('2001:db8:{:x}::1'.format(i), 5353), name, 1) == ANSWER for i in range(100))
+        assert limiter.stats()['answered'] == 2 + 99 + 100
+
+    def test_serve_udp_rate_limited(self):
+        '''Past the limit, responses are dropped or slipped as truncated replies'''
+        store = load_zones(['zoo.zone'])
+        server = socket(AF_INET, SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        limiter = ResponseLimiter(2, clock=lambda: 100.0)
+        threading.Thread(target=serve_udp, args=(store, server, BufferPool(count=1), limiter), daemon=True).start()
+        request = b'6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01'
+        replies = []
+        with socket(AF_INET, SOCK_DGRAM) as client:
+            client.settimeout(0.5)
+            for _ in range(6):
+                client.sendto(request, server.getsockname())
+            with pytest.raises(OSError):
+                while True:
+                    replies.append(client.recv(512))
+        assert replies[:2] == [store.answer(request)] * 2
+        assert replies[2:] == [b'6\xc3\x83\x00\x00\x01\x00\x00\x00\x00\x00\x00' + request[12:]] * 2
+        assert limiter.stats()['dropped'] == 4
+
+    def negative_store(self, tmp_path) -> ZoneStore:
+        '''A zone with an SOA, a wildcard and an empty non-terminal (b)'''
+        zone_file = tmp_path / 'example.zone'
+        zone_file.write_text('$ORIGIN example.com.\n'
+                             '@ 3600 IN SOA ns admin 7 3600 600 1w 60\n'
+                             'www 300 IN A 10.0.0.2\n'
+                             '* 300 IN A 10.0.0.9\n'
+                             'a.b 300 IN A 10.0.0.3\n')
+        return load_zones([str(zone_file)])
+
+    def ask(self, store: ZoneStore, name: str, qry_type: int = 1, flags: bytes = b'\x01\x00') -> bytes:
+        '''Response of the store to a query'''
+        return bytes(store.answer(b'\x12\xaf' + flags + b'\x00\x01\x00\x00\x00\x00\x00\x00' + encode_name(name) +
+                                  qry_type.to_bytes(2, 'big') + b'\x00\x01'))
+
+    def test_negative_answers(self, tmp_path):
+        '''NXDOMAIN and no data carry the SOA, with its TTL capped by the minimum'''
+        store = self.negative_store(tmp_path)
+        question_end = 12 + len(encode_name('gone.b.example.com')) + 4
+        nxdomain = self.ask(store, 'gone.b.example.com')
+        assert nxdomain[2:12] == b'\x85\x03\x00\x01\x00\x00\x00\x01\x00\x00'
+        # The SOA owner points at "example.com" inside the question.
+        assert nxdomain[question_end:question_end + 12] == b'\xc0\x13\x00\x06\x00\x01\x00\x00\x00\x3c\x00\x37'
+        assert self.ask(store, 'www.example.com', 28)[2:12] == b'\x85\x00\x00\x01\x00\x00\x00\x01\x00\x00'
+        assert self.ask(store, 'b.example.com')[2:12] == b'\x85\x00\x00\x01\x00\x00\x00\x01\x00\x00'
+        assert self.ask(store, 'example.com', 6)[6:8] == b'\x00\x01'
+        # AA is always set, RD only when the query asked for recursion.
+        assert self.ask(store, 'www.example.com', flags=b'\x00\x00')[2:8] == b'\x84\x00\x00\x01\x00\x01'
+
+    def test_negative_answers_cs430(self):
+        '''cs430.zone, whose SOA owner is "@", puts its SOA in NXDOMAIN and no data answers'''
+        store = load_zones(['cs430.zone'])
+        nxdomain = self.ask(store, 'gone.cs430.luther.edu')
+        assert nxdomain[2:12] == b'\x85\x03\x00\x01\x00\x00\x00\x01\x00\x00'
+        question_end = 12 + len(encode_name('gone.cs430.luther.edu')) + 4
+        # The SOA owner points at "cs430.luther.edu" inside the question, its TTL capped at 3h.
+        assert nxdomain[question_end:question_end + 10] == b'\xc0\x11\x00\x06\x00\x01\x00\x00\x2a\x30'
+        nodata = self.ask(store, 'ns.cs430.luther.edu', 28)
+        assert nodata[2:12] == b'\x85\x00\x00\x01\x00\x00\x00\x01\x00\x00'
+        assert encode_name('admin.cs430.luther.edu') in nodata
+
+    def test_error_answers(self, tmp_path):
+        '''Every query gets a reply: REFUSED, NOTIMP or FORMERR'''
+        store = self.negative_store(tmp_path)
+        assert self.ask(store, 'www.example.org')[2:6] == b'\x81\x05\x00\x01'
+        assert self.ask(store, 'www.example.com', flags=b'\x11\x00')[2:6] == b'\x91\x04\x00\x01'
+        assert self.ask(store, 'example.com', 252)[2:4] == b'\x81\x04'
+        with pytest.raises(ValueError):
+            self.ask(store, 'www.example.com', flags=b'\x81\x00')
+        compressed = b'\x12\xaf\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\xc0\x0c\x00\x01\x00\x01'
+        assert malformed_response(compressed) == b'\x12\xaf\x81\x01' + bytes(8)
+        assert malformed_response(b'\x12\xaf\x81') is None
+
+    def test_wildcard(self, tmp_path):
+        '''A wildcard answers for missing names, but not below existing ones or for missing types'''
+        store = self.negative_store(tmp_path)
+        reply = self.ask(store, 'Anything.example.com')
+        assert reply[3] & 0xF == 0 and reply[6:8] == b'\x00\x01'
+        assert reply.endswith(b'\xc0\x0c\x00\x01\x00\x01\x00\x00\x01\x2c\x00\x04' + bytes([10, 0, 0, 9]))
+        assert self.ask(store, 'deeper.anything.example.com').endswith(bytes([10, 0, 0, 9]))
+        assert self.ask(store, 'x.b.example.com')[3] & 0xF == 3
+        assert self.ask(store, 'www.example.com').endswith(bytes([10, 0, 0, 2]))
+        assert self.ask(store, 'anything.example.com', 28)[6:10] == b'\x00\x00\x00\x01'
+
+    def test_negative_image(self, tmp_path):
+        '''A mapped image gives the same negative and wildcard answers'''
+        store = self.negative_store(tmp_path)
+        store.write_image(str(tmp_path / 'example.zimg'))
+        mapped = load_zones([str(tmp_path / 'example.zimg')])
+        for name in ('gone.b.example.com', 'b.example.com', 'anything.example.com', 'www.example.org'):
+            assert self.ask(mapped, name) == self.ask(store, name)
+
+    def test_reload_empty_non_terminals(self, tmp_path):
+        '''Names that only existed above a removed owner disappear with it'''
+        zone_file = tmp_path / 'example.zone'
+        zone_file.write_text('$ORIGIN example.com.\nwww 300 IN A 10.0.0.2\na.b 300 IN A 10.0.0.3\n')
+        store = ZoneStore()
+        store.load(str(zone_file))
+        assert self.ask(store, 'b.example.com')[3] & 0xF == 0
+        zone_file.write_text('$ORIGIN example.com.\nwww 300 IN A 10.0.0.2\nc.d 300 IN A 10.0.0.4\n')
+        store.reload(str(zone_file))
+        assert self.ask(store, 'b.example.com')[3] & 0xF == 3
+        assert self.ask(store, 'd.example.com')[3] & 0xF == 0
+
+    def test_apex_owners_merged(self, tmp_path):
+        '''Records of "@" and of the origin written out are one owner, on load and on reload'''
+        zone_file = tmp_path / 'cs430.zone'
+        zone_file.write_text(open('cs430.zone').read())
+        store = ZoneStore()
+        store.load(str(zone_file))
+        apex = store.find(encode_name('cs430.luther.edu'))[1][encode_name('cs430.luther.edu')]
+        assert {TYPE_SOA, 1, 28} <= set(apex)
+        zone_file.write_text(open('cs430.zone').read().replace('2018091601', '2018091602')
+                             .replace('192.168.0.2', '192.168.0.9'))
+        assert '1 owners rebuilt' in store.reload(str(zone_file))
+        apex = store.find(encode_name('cs430.luther.edu'))[1][encode_name('cs430.luther.edu')]
+        assert {TYPE_SOA, 1, 28} <= set(apex)
+        assert apex[1][1].endswith(bytes([192, 168, 0, 9]))
+        assert self.ask(store, 'cs430.luther.edu', TYPE_SOA)[6:8] == b'\x00\x01'
+
+    def test_txt_spacing(self, tmp_path):
+        '''Quoted strings keep their spaces, parentheses and semicolons'''
+        zone_file = tmp_path / 'example.zone'
+        zone_file.write_text('$ORIGIN example.com.\n'
+                             'www 300 IN TXT "a  b" "(c;\td)"\n'
+                             'mail 300 IN TXT ( "one   two"\n'
+                             '                  three )\n')
+        zone = read_zone(str(zone_file))[1]
+        assert zone['www'] == [(300, 'IN', 'TXT', '"a  b" "(c;\td)"')]
+        assert zone['mail'] == [(300, 'IN', 'TXT', '"one   two" three')]
+        store = load_zones([str(zone_file)])
+        assert self.ask(store, 'www.example.com', 16).endswith(b'\x04a  b\x06(c;\td)')
+        assert self.ask(store, 'mail.example.com', 16).endswith(b'\x09one   two\x05three')
+
+    def test_compile_record_types(self, tmp_path):
+        '''NS, MX, CNAME and TXT are encoded; a type that cannot be is rejected'''
+        store = ZoneStore()
+        store.load('cs430.zone')
+        response = self.ask(store, 'cs430.luther.edu', 15)
+        assert response[6:8] == b'\x00\x02'
+        assert b'\x00\x0a' + encode_name('mail.cs430.luther.edu') in response
+        assert encode_name('ns.cs430.luther.edu') in self.ask(store, 'cs430.luther.edu', 2)
+        assert self.ask(store, 'www.cs430.luther.edu', 16).endswith(b'\x14This is a web server')
+        response = self.ask(store, 'www.cs430.luther.edu')
+        assert response[6:8] == b'\x00\x01'
+        assert response.endswith(b'\x00\x05\x00\x01' + struct.pack('!IH', 86400, 18) + encode_name('cs430.luther.edu'))
+        with pytest.raises(ValueError):
+            compile_zone({'www': [(300, 'IN', 'HINFO', 'PC Linux')]}, 'example.com')
+
 
 if __name__ == '__main__':
     pytest.main(['test_nameserver.py'])